@@ -29,13 +29,22 @@ setup(
         'Flask',
         'lxml',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
     fetch-users = presence_analyzer.script:fetch_users_file
+    compile-snapshot = presence_analyzer.script:compile_snapshot
+    benchmark-generate = presence_analyzer.benchmark.generator:main
+    benchmark-run = presence_analyzer.benchmark.harness:main
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
     debug = presence_analyzer.script:make_debug
+
+    [paste.server_runner]
+    prefork = presence_analyzer.prefork:serve
     """,
 )
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of loading and serving presence data.
+
+ - bin/benchmark-generate writes synthetic DATA_CSV and USERS_XML files
+   of given size (see presence_analyzer.benchmark.generator),
+ - bin/benchmark-run times loading and every /api/v1 endpoint on given
+   files and writes results as JSON (see
+   presence_analyzer.benchmark.harness).
+"""
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Generator of synthetic presence data.
+
+Files follow the layout of the intranet exports: DATA_CSV holds one
+line per user and day, written day by day like an export that only
+gains rows at the end, and USERS_XML lists every user with a name and an
+avatar. A small share of CSV lines is mangled the ways real exports are:
+impossible times, truncated lines and stray text.
+"""
+
+import argparse
+import random
+from datetime import date, timedelta
+from xml.sax.saxutils import escape
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+FIRST_DAY = date(2011, 1, 3)
+HEADER = 'user_id,date,start,end\n'
+NAMES = ['Adam', 'Agata', 'Anna', 'Bartosz', 'Ewa', 'Jan', 'Kamil',
+         'Katarzyna', 'Marek', 'Monika', 'Piotr', 'Zofia']
+# chance of presence on a given weekday, Monday is 0
+PRESENCE = [0.92, 0.95, 0.95, 0.93, 0.85, 0.04, 0.01]
+
+
+def mangle(line, rand):
+    """
+    Returns broken version of presence line.
+    """
+    kind = rand.randrange(3)
+    if kind == 0:
+        user_id, day, _ = line.split(',', 2)
+        return '{0},{1},25:61:61,09:00:00\n'.format(user_id, day)
+    elif kind == 1:
+        # cut in the middle of end time
+        return line[:-rand.randint(7, 9)] + '\n'
+    return 'Report generated on {0}\n'.format(FIRST_DAY.isoformat())
+
+
+def generate_lines(rows, users, mangled=0.001, seed=0):
+    """
+    Yields lines of presence CSV file.
+
+    Users are present mostly on working days, start around 9:00 and stay
+    around 8 hours. Number of days covered follows from number of rows
+    and users.
+    :param rows: number of presence rows to generate
+    :param users: number of users, ids are 1 to users
+    :param mangled: share of malformed lines added on top of rows
+    :param seed: random seed, equal arguments give equal files
+    """
+    rand = random.Random(seed)
+    yield HEADER
+    habits = dict(
+        (user_id, (rand.gauss(9 * 3600, 2700), rand.gauss(8 * 3600, 1800)))
+        for user_id in range(1, users + 1)
+    )
+    day = FIRST_DAY
+    generated = 0
+    while generated < rows:
+        chance = PRESENCE[day.weekday()]
+        iso_day = day.isoformat()
+        for user_id in range(1, users + 1):
+            if generated >= rows:
+                break
+            if rand.random() >= chance:
+                continue
+            start, length = habits[user_id]
+            start = int(min(max(rand.gauss(start, 1200), 5 * 3600),
+                            14 * 3600))
+            end = int(min(start + max(rand.gauss(length, 2400), 600),
+                          86399))
+            line = '{0},{1},{2:02d}:{3:02d}:{4:02d},' \
+                '{5:02d}:{6:02d}:{7:02d}\n'.format(
+                    user_id, iso_day,
+                    start // 3600, start // 60 % 60, start % 60,
+                    end // 3600, end // 60 % 60, end % 60
+                )
+            if mangled and rand.random() < mangled:
+                yield mangle(line, rand)
+            yield line
+            generated += 1
+        day += timedelta(days=1)
+
+
+def generate_data(path, rows, users, mangled=0.001, seed=0):
+    """
+    Writes presence CSV file, see generate_lines().
+    """
+    with open(path, 'wb') as csvfile:
+        csvfile.writelines(generate_lines(rows, users, mangled, seed))
+
+
+def generate_users(path, users, seed=0):
+    """
+    Writes users XML file with users of ids 1 to users.
+    """
+    rand = random.Random(seed)
+    with open(path, 'wb') as xmlfile:
+        xmlfile.write(
+            '<?xml version="1.0" encoding="UTF-8" ?>\n'
+            '<intranet>\n'
+            '    <server>\n'
+            '        <host>example.com</host>\n'
+            '        <port>80</port>\n'
+            '        <protocol>http</protocol>\n'
+            '    </server>\n'
+            '    <users>\n'
+        )
+        for user_id in range(1, users + 1):
+            name = '{0} {1}.'.format(rand.choice(NAMES),
+                                     chr(ord('A') + rand.randrange(26)))
+            xmlfile.write(
+                '        <user id="{0}">\n'
+                '            <avatar>/api/images/users/{0}</avatar>\n'
+                '            <name>{1}</name>\n'
+                '        </user>\n'.format(user_id, escape(name))
+            )
+        xmlfile.write('    </users>\n</intranet>\n')
+
+
+def main(argv=None):
+    """
+    Generates DATA_CSV and USERS_XML files of given size.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__.strip())
+    parser.add_argument('data_csv', help='presence CSV file to write')
+    parser.add_argument('users_xml', help='users XML file to write')
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='number of presence rows (default: 10000)')
+    parser.add_argument('--users', type=int, default=10,
+                        help='number of users (default: 10)')
+    parser.add_argument('--mangled', type=float, default=0.001,
+                        help='share of malformed lines (default: 0.001)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default: 0)')
+    args = parser.parse_args(argv)
+
+    generate_data(args.data_csv, args.rows, args.users, args.mangled,
+                  args.seed)
+    generate_users(args.users_xml, args.users, args.seed)
+    print 'Generated {0} rows of {1} users'.format(args.rows, args.users)
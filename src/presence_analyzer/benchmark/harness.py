@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark harness timing data loading and /api/v1 endpoints.
+
+Every measurement is repeated and summarized with its minimum, median,
+mean and maximum time in seconds. Results, along with the environment
+and input files they were measured on, are written as JSON so runs can
+be compared over time.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+from datetime import date
+from timeit import default_timer
+
+from presence_analyzer import app, utils
+from presence_analyzer.lazy import IndexLoader
+from presence_analyzer.loader import CsvLoader, ShardedLoader, XmlLoader, \
+    shard_paths
+from presence_analyzer.snapshot import SnapshotLoader
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# (name, URL template), filled in with user_id, user_ids, first and last
+ENDPOINTS = [
+    ('users', '/api/v1/users'),
+    ('mean_time_weekday', '/api/v1/mean_time_weekday/{user_id}'),
+    ('presence_weekday', '/api/v1/presence_weekday/{user_id}'),
+    ('presence_start_end', '/api/v1/presence_start_end/{user_id}'),
+    ('presence_weekday_range',
+     '/api/v1/presence_weekday/{user_id}?from={first}&to={last}'),
+    ('rollup_month', '/api/v1/rollup/{user_id}?period=month'),
+    ('rollup_week', '/api/v1/rollup/{user_id}?period=week'),
+    ('batch_stats', '/api/v1/batch_stats?user_ids={user_ids}'),
+    ('export_stats', '/api/v1/export?kind=stats'),
+    ('export_rows', '/api/v1/export?kind=rows&format=csv'),
+]
+
+
+def summary(timings):
+    """
+    Summarizes list of timings in seconds.
+    """
+    timings = sorted(timings)
+    middle = len(timings) // 2
+    if len(timings) % 2:
+        median = timings[middle]
+    else:
+        median = (timings[middle - 1] + timings[middle]) / 2.0
+    return {
+        'runs': len(timings),
+        'min': timings[0],
+        'median': median,
+        'mean': sum(timings) / len(timings),
+        'max': timings[-1],
+    }
+
+
+def measure(function, repeat, setup=None):
+    """
+    Times function, calling setup before every run.
+
+    :return: summary() of timings
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = default_timer()
+        function()
+        timings.append(default_timer() - start)
+    return summary(timings)
+
+
+def peak_rss():
+    """
+    Returns peak resident set size of this process in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_loaders():
+    """
+    Drops all loaded and cached data, so next get_data() starts cold.
+    """
+    utils.DATA_LOADER = CsvLoader()
+    utils.SHARDS_LOADER = ShardedLoader()
+    utils.SNAPSHOT_LOADER = SnapshotLoader()
+    utils.INDEX_LOADER = IndexLoader()
+    utils.USERS_LOADER = XmlLoader()
+    utils.get_data.cache_invalidate()
+    utils.encode_response.cache_clear()
+
+
+def get(client, url):
+    """
+    Requests URL and reads whole response.
+    """
+    resp = client.get(url)
+    if resp.status_code != 200:
+        raise RuntimeError(
+            '{0} returned {1}'.format(url, resp.status_code)
+        )
+    return resp.data
+
+
+def endpoint_params(data):
+    """
+    Chooses parameters of benchmarked URLs, see ENDPOINTS.
+
+    User with most entries is benchmarked, ranges cover the last quarter
+    of their history.
+    """
+    user_ids = sorted(data, key=lambda i: len(data[i]), reverse=True)
+    if not user_ids:
+        raise RuntimeError('No presence data')
+    presence = data[user_ids[0]]
+    return {
+        'user_id': user_ids[0],
+        'user_ids': ','.join(str(i) for i in sorted(user_ids[:50])),
+        'first': date.fromordinal(
+            presence.days[len(presence) * 3 // 4]
+        ).isoformat(),
+        'last': date.fromordinal(presence.days[-1]).isoformat(),
+    }
+
+
+def describe_input(data_csv, users_xml, data):
+    """
+    Describes benchmarked input files and data loaded from them.
+    """
+    paths = shard_paths(data_csv)
+    return {
+        'data_csv': data_csv,
+        'data_csv_files': [os.path.abspath(path) for path in paths],
+        'data_csv_bytes': sum(os.path.getsize(path) for path in paths),
+        'users_xml': os.path.abspath(users_xml),
+        'users': len(data),
+        'rows': sum(len(presence) for presence in data.itervalues()),
+    }
+
+
+def run(data_csv, users_xml, repeat=5, workers=1):
+    """
+    Runs all benchmarks on given files.
+
+    :param data_csv: DATA_CSV option value, a file, a glob pattern or a
+        list of files
+    :return: results dictionary, see main()
+    """
+    app.config.update({
+        'DATA_CSV': data_csv,
+        'USERS_XML': users_xml,
+        'DATA_WORKERS': workers,
+    })
+    app.config.pop('DATA_SNAPSHOT', None)
+    # every get_data() call checks the file instead of trusting the cache
+    utils.get_data.cache_duration = -1
+    utils.get_data.cache_stale_while_revalidate = False
+
+    results = {}
+    rss_before = peak_rss()
+    results['load_cold'] = measure(utils.get_data, repeat, reset_loaders)
+    rss_after = peak_rss()
+    # file is checked, but has not changed
+    results['load_unchanged'] = measure(utils.get_data, repeat)
+    utils.get_data.cache_duration = 3600
+    results['load_cached'] = measure(utils.get_data, repeat)
+    utils.get_data.cache_duration = -1
+    results['users_cold'] = measure(utils.get_user_data, repeat,
+                                    reset_loaders)
+
+    data = utils.get_data()
+    params = endpoint_params(data)
+    client = app.test_client()
+    for name, template in ENDPOINTS:
+        url = template.format(**params)
+
+        def request(url=url):
+            """
+            Requests benchmarked URL.
+            """
+            get(client, url)
+
+        results['api_{0}_cold'.format(name)] = measure(
+            request, repeat, utils.encode_response.cache_clear
+        )
+        results['api_{0}_warm'.format(name)] = measure(request, repeat)
+
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'engine': app.config.get('PRESENCE_ENGINE', 'python'),
+            'workers': workers,
+        },
+        'input': describe_input(data_csv, users_xml, data),
+        'memory': {
+            'peak_rss_bytes': rss_after,
+            'peak_rss_load_increase_bytes': rss_after - rss_before,
+            'data_bytes': utils.approximate_size(data),
+        },
+        'timings': results,
+    }
+
+
+def main(argv=None):
+    """
+    Times loading of presence data and every /api/v1 endpoint.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__.strip())
+    parser.add_argument('data_csv', help='presence CSV file or glob '
+                        'pattern of many, like monthly exports')
+    parser.add_argument('users_xml', help='users XML file')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of runs of every benchmark '
+                        '(default: 5)')
+    parser.add_argument('--engine', default='python',
+                        help='aggregation engine (default: python)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes parsing CSV file (default: 1)')
+    parser.add_argument('--output', default='-',
+                        help='JSON file to write results to (default: '
+                        'standard output)')
+    args = parser.parse_args(argv)
+
+    app.config['PRESENCE_ENGINE'] = args.engine
+    results = run(args.data_csv, args.users_xml, args.repeat, args.workers)
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Aggregation engines computing weekday totals of loaded presence data.
+
+Engine is selected with PRESENCE_ENGINE configuration option:
+ - 'python' (default): pure Python loop over every user,
+ - 'numpy': grouped reductions over all users at once, requires numpy.
+"""
+
+from presence_analyzer.store import WeekdayStats
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # pylint: disable=invalid-name
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+DEFAULT_ENGINE = 'python'
+
+
+def aggregate_python(data):
+    """
+    Computes weekday totals user by user.
+
+    :return: {user_id: WeekdayStats} dictionary
+    """
+    return dict(
+        (user_id, WeekdayStats(presence.rows()))
+        for user_id, presence in data.iteritems()
+    )
+
+
+def aggregate_numpy(data):
+    """
+    Computes weekday totals of all users with a single set of bincounts.
+
+    :return: {user_id: WeekdayStats} dictionary
+    """
+    user_ids = data.keys()
+    if not user_ids:
+        return {}
+
+    def column(name):
+        """
+        Concatenates given column of all users into one array.
+        """
+        return numpy.concatenate([
+            numpy.frombuffer(getattr(data[user_id], name), dtype=numpy.int32)
+            for user_id in user_ids
+        ]).astype(numpy.int64)
+
+    days, starts, ends = column('days'), column('starts'), column('ends')
+    users = numpy.repeat(
+        numpy.arange(len(user_ids)),
+        [len(data[user_id]) for user_id in user_ids]
+    )
+    # one bucket for every (user, weekday) pair
+    buckets = users * 7 + (days + 6) % 7
+    size = len(user_ids) * 7
+
+    def totals(weights=None):
+        """
+        Sums weights in every bucket.
+        """
+        # pylint: disable=no-member
+        result = numpy.bincount(buckets, weights=weights, minlength=size)
+        if weights is not None:
+            # float64 sums of integers stay exact far beyond any real data
+            result = result.round().astype(numpy.int64)
+        return result.reshape(len(user_ids), 7).tolist()
+
+    counts = totals()
+    intervals = totals(ends - starts)
+    start_totals = totals(starts)
+    end_totals = totals(ends)
+    return dict(
+        (user_id, WeekdayStats.from_totals(
+            counts[i], intervals[i], start_totals[i], end_totals[i]
+        ))
+        for i, user_id in enumerate(user_ids)
+    )
+
+
+ENGINES = {
+    'python': aggregate_python,
+    'numpy': aggregate_numpy,
+}
+
+
+def aggregate(data, engine=DEFAULT_ENGINE):
+    """
+    Fills in weekday totals of every user in data using given engine.
+
+    Cumulative weekday totals (see store.PrefixSums), which only date
+    range queries need, are left to be built on first access. Falls back
+    to pure Python engine when numpy is not available.
+    """
+    if engine == 'numpy' and numpy is None:
+        log.warning('numpy is not installed, using pure Python engine')
+        engine = 'python'
+    try:
+        aggregate_func = ENGINES[engine]
+    except KeyError:
+        raise ValueError('Unknown presence engine: {0}'.format(engine))
+
+    for user_id, stats in aggregate_func(data).iteritems():
+        # pylint: disable=protected-access
+        data[user_id]._set_aggregates(stats=stats)
+    return data
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+On-demand loading of presence data of single users.
+
+Exports grouped by user, like sample_data.csv, keep rows of every user
+in one run of lines (or a few). Index of these runs, found by scanning
+the file for user ids only, is enough to list users; rows of a user are
+parsed when they are asked for, by reading just the user's runs, and
+kept in a small LRU. Memory use then follows the number of active users
+rather than the length of the history. Files which are not grouped by
+user still work, their users just have many short runs.
+
+Index can be stored in a sidecar file (DATA_INDEX), so processes do not
+have to scan the CSV file again. It is used only while size and mtime
+recorded in it match the CSV file.
+
+File layout, all values little-endian:
+ - header: magic, format version, number of runs, size and mtime of the
+   source CSV file,
+ - runs: user id, offset and length in bytes of every run of lines.
+"""
+
+import os
+import sys
+import struct
+from collections import Mapping, OrderedDict
+from threading import Lock
+
+from presence_analyzer.engine import DEFAULT_ENGINE, aggregate
+from presence_analyzer.parsing import parse_fast, parse_lenient, \
+    parse_lines
+from presence_analyzer.store import PresenceBuilder, same
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+MAGIC = 'PRESIDX\0'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<8sIIQd')
+RUN = struct.Struct('<qQQ')
+DEFAULT_MAX_USERS = 128
+
+
+class IndexFileError(Exception):
+    """
+    Index file is malformed.
+    """
+
+
+def user_id_of(line):
+    """
+    Returns user id of presence line or None if line has none.
+    """
+    try:
+        return int(line[:line.index(',')])
+    except ValueError:
+        return None
+
+
+def is_row(line):
+    """
+    Checks whether parser accepts line as a presence row.
+    """
+    if parse_fast(line) is not None:
+        return True
+    try:
+        return parse_lenient(line) is not None
+    except (ValueError, TypeError):
+        return False
+
+
+def build_index(csvfile):
+    """
+    Finds runs of lines of every user.
+
+    Lines without user id (header, footer, garbage) are attached to the
+    run they are in; parser rejects them later anyway. Runs without a
+    single valid row are left out, so users with malformed rows only are
+    not listed, just like when the whole file is parsed. Lines of a run
+    are only checked until the first valid one.
+    :return: {user_id: [(offset, length), ...]} dictionary, runs in file
+        order
+    """
+    runs = {}
+    csvfile.seek(0)
+    offset = 0
+    current = None
+    begin = 0
+    valid = False
+    for line in csvfile:
+        user_id = user_id_of(line)
+        if user_id is not None and user_id != current:
+            if valid:
+                runs.setdefault(current, []).append((begin, offset - begin))
+            current, begin, valid = user_id, offset, False
+        if not valid and user_id is not None:
+            valid = is_row(line)
+        offset += len(line)
+    if valid:
+        runs.setdefault(current, []).append((begin, offset - begin))
+    return runs
+
+
+def write_index(path, runs, size, mtime):
+    """
+    Writes index file.
+
+    Index is written to a temporary file first and renamed, so processes
+    never see partially written index.
+    """
+    count = sum(len(user_runs) for user_runs in runs.itervalues())
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as index:
+        index.write(HEADER.pack(MAGIC, FORMAT_VERSION, count, size, mtime))
+        for user_id in sorted(runs):
+            index.writelines(
+                RUN.pack(user_id, offset, length)
+                for offset, length in runs[user_id]
+            )
+    os.rename(tmp_path, path)
+
+
+def read_index(path):
+    """
+    Reads index file.
+
+    :return: (size, mtime, runs) tuple, see build_index() for runs
+    :raise: IndexFileError if file is malformed
+    """
+    with open(path, 'rb') as index:
+        buf = index.read()
+    if len(buf) < HEADER.size:
+        raise IndexFileError('Index {0} is truncated'.format(path))
+    magic, version, count, size, mtime = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise IndexFileError('Unsupported index {0}'.format(path))
+    if len(buf) != HEADER.size + count * RUN.size:
+        raise IndexFileError('Index {0} is truncated'.format(path))
+
+    runs = {}
+    for i in xrange(count):
+        user_id, offset, length = RUN.unpack_from(
+            buf, HEADER.size + i * RUN.size
+        )
+        runs.setdefault(user_id, []).append((offset, length))
+    return size, mtime, runs
+
+
+class LazyPresenceData(Mapping):
+    """
+    Presence of all users, {user_id: UserPresence}, parsed on demand.
+
+    Listing users does not parse anything. Up to max_users users
+    recently asked for are kept parsed. version attribute identifies
+    state of the source the data was read from, as in
+    store.PresenceData.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, path, runs, engine=DEFAULT_ENGINE,
+                 max_users=DEFAULT_MAX_USERS):
+        self.path = path
+        self.runs = runs
+        self.engine = engine
+        self.max_users = max_users
+        self.lock = Lock()
+        self.parsed = OrderedDict()
+        self.user_loads = 0
+        self.version = None
+
+    def __getitem__(self, user_id):
+        runs = self.runs[user_id]
+        with self.lock:
+            presence = self.parsed.pop(user_id, None)
+            if presence is not None:
+                self.parsed[user_id] = presence
+                return presence
+
+        presence = self.read_user(user_id, runs)
+        if presence is None:
+            raise KeyError(user_id)
+        with self.lock:
+            self.parsed[user_id] = presence
+            self.user_loads += 1
+            while len(self.parsed) > self.max_users:
+                self.parsed.popitem(last=False)
+        return presence
+
+    def __contains__(self, user_id):
+        return user_id in self.runs
+
+    __copy__ = __deepcopy__ = same
+
+    def __iter__(self):
+        return iter(self.runs)
+
+    def __len__(self):
+        return len(self.runs)
+
+    def read_user(self, user_id, runs):
+        """
+        Parses rows of given user.
+
+        Rows of other users, which may show up when the file changed
+        since it was indexed, are dropped.
+        :return: UserPresence instance or None when no rows are left
+        """
+        builder = PresenceBuilder()
+        with open(self.path, 'rb') as csvfile:
+            for offset, length in runs:
+                csvfile.seek(offset)
+                parse_lines(csvfile.read(length).splitlines(True), builder)
+        columns = builder.columns.get(user_id)
+        builder.columns = {user_id: columns} if columns else {}
+        data = aggregate(builder.build(), self.engine)
+        return data.get(user_id)
+
+    def loaded(self):
+        """
+        Returns list of currently parsed users' presence.
+        """
+        with self.lock:
+            return self.parsed.values()
+
+    def nbytes(self):
+        """
+        Returns approximate memory held by index and parsed users.
+        """
+        size = sys.getsizeof(self.runs) + sum(
+            sys.getsizeof(user_runs) + len(user_runs) * (
+                sys.getsizeof((0, 0)) + 2 * sys.getsizeof(0)
+            )
+            for user_runs in self.runs.itervalues()
+        )
+        return size + sum(presence.nbytes() for presence in self.loaded())
+
+
+class IndexLoader(object):
+    """
+    Indexes presence CSV file and keeps the index up to date.
+
+    File is indexed again whenever its path, inode, size or mtime
+    changes; parsed users are then dropped as well.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.data = None
+        self.index_loads = 0
+        self.index_builds = 0
+
+    def load(self, path, index_path=None, engine=DEFAULT_ENGINE,
+             max_users=DEFAULT_MAX_USERS):
+        """
+        Returns lazily loaded data of path.
+
+        :param index_path: sidecar index file, read if it matches the CSV
+            file and written otherwise
+        """
+        with self.lock:
+            stat = os.stat(path)
+            version = (path, (stat.st_dev, stat.st_ino), stat.st_size,
+                       stat.st_mtime)
+            data = self.data
+            if data is not None and (data.version, data.engine,
+                                     data.max_users) == (version, engine,
+                                                         max_users):
+                return data
+
+            runs = None
+            if index_path:
+                runs = self.read_sidecar(index_path, stat)
+            if runs is None:
+                log.info('Indexing %s', path)
+                with open(path, 'rb') as csvfile:
+                    runs = build_index(csvfile)
+                self.index_builds += 1
+                if index_path:
+                    try:
+                        write_index(index_path, runs, stat.st_size,
+                                    stat.st_mtime)
+                    except (IOError, OSError):
+                        log.exception('Cannot write index %s', index_path)
+
+            data = LazyPresenceData(path, runs, engine, max_users)
+            data.version = version
+            self.data = data
+            return data
+
+    def read_sidecar(self, index_path, stat):
+        """
+        Returns runs from index file or None if it is missing or stale.
+        """
+        try:
+            size, mtime, runs = read_index(index_path)
+        except (IOError, OSError):
+            log.info('Index %s does not exist', index_path)
+            return None
+        except IndexFileError:
+            log.exception('Cannot read index %s', index_path)
+            return None
+        if (size, mtime) != (stat.st_size, stat.st_mtime):
+            log.info('Index %s is stale', index_path)
+            return None
+        self.index_loads += 1
+        return runs
@@ -0,0 +1,552 @@
+# -*- coding: utf-8 -*-
+"""
+Loading of presence CSV and users XML files.
+"""
+
+import os
+import glob
+from array import array
+from itertools import chain
+from threading import Lock
+from timeit import default_timer
+
+from lxml import etree
+
+from presence_analyzer.engine import DEFAULT_ENGINE, aggregate
+from presence_analyzer.parsing import parse_lines, parse_parallel, \
+    parse_files
+from presence_analyzer.store import PresenceBuilder, PresenceData, \
+    TYPECODE, compact, merge
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class CsvLoader(object):  # pylint: disable=too-many-instance-attributes
+    """
+    Loads presence CSV file and keeps it up to date.
+
+    The export only ever gains rows at the end, so after the first load
+    only appended bytes are parsed and merged into the data. The file is
+    parsed from scratch when it was truncated or rewritten, i.e. when its
+    size shrinks, its inode changes, or its first line or the last line
+    consumed differ from what was read before.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.data = PresenceData()
+        self.path = None
+        self.inode = None
+        self.size = None
+        self.mtime = None
+        self.offset = 0
+        self.header = ''
+        self.guard = ''
+        # {user_id: (days, starts, ends)} rows parsed by last tail load
+        self.appended = {}
+        self.full_loads = 0
+        self.tail_loads = 0
+        self.load_time = 0.0
+        self.last_load_time = 0.0
+        self.parsed_rows = 0
+        self.rejected_lines = 0
+
+    def load(self, path, engine=DEFAULT_ENGINE, workers=1):
+        """
+        Returns data from path, reading only what changed since last call.
+
+        Weekday totals of new and updated users are computed with given
+        aggregation engine (see presence_analyzer.engine). When workers is
+        more than one, whole file is parsed by a pool of that many
+        processes (see parsing.parse_parallel); appended lines are always
+        parsed in the current process.
+        """
+        with self.lock:
+            stat = os.stat(path)
+            inode = (stat.st_dev, stat.st_ino)
+            if (path, inode, stat.st_size, stat.st_mtime) == (
+                    self.path, self.inode, self.size, self.mtime):
+                return self.data
+
+            started = default_timer()
+            with open(path, 'rb') as csvfile:
+                if self.can_append(path, inode, stat.st_size, csvfile):
+                    parsed, rejected = self.read_tail(csvfile, engine)
+                elif workers > 1:
+                    parsed, rejected = self.read_parallel(
+                        csvfile, engine, workers, stat.st_size
+                    )
+                else:
+                    parsed, rejected = self.read_full(csvfile, engine)
+            self.loaded(path, stat, parsed, rejected,
+                        default_timer() - started)
+            return self.data
+
+    def load_parsed(self, path, stat, builder, result, engine):
+        """
+        Replaces data with whole file parsed elsewhere, see
+        parsing.parse_files().
+
+        :param stat: os.stat() result of the file from before it was parsed
+        :param result: (parsed, rejected, offset, guard) tuple
+        """
+        # pylint: disable=too-many-arguments
+        with self.lock:
+            started = default_timer()
+            with open(path, 'rb') as csvfile:
+                self.header = csvfile.readline()
+            parsed, rejected, self.offset, self.guard = result
+            self.data = aggregate(builder.build(), engine)
+            self.appended = {}
+            self.full_loads += 1
+            self.loaded(path, stat, parsed, rejected,
+                        default_timer() - started)
+
+    def loaded(self, path, stat, parsed, rejected, duration):
+        """
+        Records state of the file data was loaded from.
+        """
+        # pylint: disable=too-many-arguments
+        self.last_load_time = duration
+        self.load_time += duration
+        self.parsed_rows += parsed
+        self.rejected_lines += rejected
+
+        self.path = path
+        self.inode = (stat.st_dev, stat.st_ino)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.data.version = (path, self.inode, stat.st_size, stat.st_mtime)
+
+    def needs_full_load(self, path, stat):
+        """
+        Checks whether file has to be parsed from scratch.
+        """
+        if (path, (stat.st_dev, stat.st_ino)) != (self.path, self.inode):
+            return True
+        return stat.st_size < self.size or (
+            stat.st_size == self.size and stat.st_mtime != self.mtime
+        )
+
+    def can_append(self, path, inode, size, csvfile):
+        """
+        Checks whether file only gained new bytes since last load.
+        """
+        if path != self.path or inode != self.inode or size <= self.size:
+            return False
+        if csvfile.read(len(self.header)) != self.header:
+            return False
+        csvfile.seek(self.offset - len(self.guard))
+        return csvfile.read(len(self.guard)) == self.guard
+
+    def read_full(self, csvfile, engine):
+        """
+        Parses whole file and replaces data.
+
+        :return: (parsed rows, rejected lines) tuple
+        """
+        log.info('Loading %s', csvfile.name)
+        csvfile.seek(0)
+        self.header = csvfile.readline()
+        csvfile.seek(0)
+        self.offset = 0
+        self.guard = ''
+        builder = PresenceBuilder()
+        result = parse_lines(self.lines(csvfile), builder)
+        self.data = aggregate(builder.build(), engine)
+        self.appended = {}
+        self.full_loads += 1
+        return result
+
+    def read_parallel(self, csvfile, engine, workers, size):
+        """
+        Parses first size bytes of file in worker processes and replaces
+        data.
+
+        :return: (parsed rows, rejected lines) tuple
+        """
+        log.info('Loading %s with %d processes', csvfile.name, workers)
+        csvfile.seek(0)
+        self.header = csvfile.readline()
+        builder = PresenceBuilder()
+        parsed, rejected, self.offset, self.guard = parse_parallel(
+            csvfile.name, size, builder, workers
+        )
+        self.data = aggregate(builder.build(), engine)
+        self.appended = {}
+        self.full_loads += 1
+        return parsed, rejected
+
+    def read_tail(self, csvfile, engine):
+        """
+        Parses lines appended since last load and merges them into data.
+
+        :return: (parsed rows, rejected lines) tuple
+        """
+        log.debug('Loading %s from offset %d', csvfile.name, self.offset)
+        csvfile.seek(self.offset)
+        builder = PresenceBuilder()
+        result = parse_lines(self.lines(csvfile), builder)
+
+        updated = aggregate(dict(
+            (user_id, merge(self.data.get(user_id), *columns))
+            for user_id, columns in builder.columns.iteritems()
+        ), engine)
+
+        # data is read-only and may still be used by other threads, so
+        # updated users are swapped in with a fresh copy
+        self.data = PresenceData(
+            chain(self.data.iteritems(), updated.iteritems())
+        )
+        self.appended = builder.columns
+        self.tail_loads += 1
+        return result
+
+    def lines(self, csvfile):
+        """
+        Yields lines of file and advances consumed offset.
+
+        Last line without line terminator may still be being written. It
+        is yielded, but the offset stays before it, so it is parsed again
+        on the next load and its row replaces the one parsed now.
+        """
+        offset, guard = self.offset, self.guard
+        try:
+            for line in csvfile:
+                if line[-1:] == '\n':
+                    offset += len(line)
+                    guard = line
+                yield line
+        finally:
+            self.offset, self.guard = offset, guard
+
+
+def is_sharded(spec):
+    """
+    Checks whether DATA_CSV option value names more than a single file.
+    """
+    return not isinstance(spec, basestring) or glob.has_magic(spec)
+
+
+def shard_paths(spec):
+    """
+    Expands DATA_CSV option value into list of files.
+
+    :param spec: path, glob pattern or list of paths and patterns
+    :return: list of paths, matches of every pattern sorted by name
+    """
+    paths = []
+    for pattern in [spec] if isinstance(spec, basestring) else spec:
+        if glob.has_magic(pattern):
+            paths.extend(sorted(glob.glob(pattern)))
+        else:
+            paths.append(pattern)
+    return paths
+
+
+def first_day(data):
+    """
+    Returns the earliest day in presence data.
+    """
+    return min(presence.days[0] for presence in data.itervalues()
+               if len(presence))
+
+
+def concatenate(presences, name):
+    """
+    Concatenates given column of many UserPresence instances.
+    """
+    result = array(TYPECODE)
+    for presence in presences:
+        result.extend(getattr(presence, name))
+    return result
+
+
+def merge_users(parts, engine):
+    """
+    Merges entries of users spread over many shards.
+
+    Users present in one shard only keep their data as it is. When a day
+    of a user occurs in more than one shard, the later shard wins.
+    :param parts: {user_id: list of UserPresence instances in
+        chronological order of their shards}
+    :return: {user_id: UserPresence} dictionary
+    """
+    merged = dict(
+        (user_id, presences[0]) for user_id, presences in parts.iteritems()
+        if len(presences) == 1
+    )
+    merged.update(aggregate(dict(
+        (user_id, compact(concatenate(presences, 'days'),
+                          concatenate(presences, 'starts'),
+                          concatenate(presences, 'ends')))
+        for user_id, presences in parts.iteritems() if len(presences) > 1
+    ), engine))
+    return merged
+
+
+def changed_users(current, previous):
+    """
+    Yields users whose data differs between two states of shards.
+
+    Loaders replace data of changed users only, so data of a user is
+    compared by identity.
+    :param current: {path: PresenceData} dictionary
+    :param previous: {path: PresenceData} dictionary
+    :return: iterator of (user_id, list of paths it changed in) tuples
+    """
+    changed = {}
+    for path in set(current).union(previous):
+        new, old = current.get(path, {}), previous.get(path, {})
+        if new is old:
+            continue
+        for user_id in set(new).union(old):
+            if new.get(user_id) is not old.get(user_id):
+                changed.setdefault(user_id, []).append(path)
+    return changed.iteritems()
+
+
+class ShardedLoader(object):  # pylint: disable=too-many-instance-attributes
+    """
+    Loads presence data split into many CSV files, like monthly exports.
+
+    Every file (shard) has its own CsvLoader, so only files which changed
+    since the last call are read again, and appended rows are read just
+    like for a single file. With more than one worker, files parsed from
+    scratch are parsed all at once by a pool of worker processes;
+    otherwise they are parsed one after another in the current process.
+    Merged data is updated user by user when shards change, see merge().
+    """
+    # statistics summed over all shards
+    COUNTERS = ('full_loads', 'tail_loads', 'load_time', 'parsed_rows',
+                'rejected_lines')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.loaders = {}
+        self.data = PresenceData()
+        self.data.version = ((), 0)
+        # non-empty shards merged into data, in chronological order
+        self.order = []
+        self.shards = {}
+        self.full_loads = 0
+        self.tail_loads = 0
+        self.load_time = 0.0
+        self.last_load_time = 0.0
+        self.parsed_rows = 0
+        self.rejected_lines = 0
+
+    def load(self, paths, engine=DEFAULT_ENGINE, workers=1):
+        """
+        Returns merged data of given files.
+
+        version attribute of returned data is a tuple of versions of all
+        shards and the latest of their mtimes.
+        """
+        with self.lock:
+            started = default_timer()
+            loaders = dict(
+                (path, self.loaders.get(path) or CsvLoader())
+                for path in paths
+            )
+            self.loaders = loaders
+            before = self.counters()
+            if workers > 1:
+                self.load_new(paths, engine, workers)
+            shards = [loaders[path].load(path, engine, workers)
+                      for path in paths]
+            for name, old, new in zip(self.COUNTERS, before,
+                                      self.counters()):
+                setattr(self, name, getattr(self, name) + new - old)
+
+            version = tuple(shard.version for shard in shards)
+            if version == self.data.version[0]:
+                return self.data
+
+            log.info('Merging %d presence files', len(shards))
+            data = self.merge(paths, shards, engine)
+            data.version = (version, max(
+                [shard.version[-1] for shard in shards] or [0]
+            ))
+            self.data = data
+            self.last_load_time = default_timer() - started
+            return data
+
+    def merge(self, paths, shards, engine):
+        """
+        Merges data of shards into data of previous merge.
+
+        Shards are taken in chronological order of their first days. Only
+        users whose data changed in any shard are merged again: rows
+        appended to the last shard of a user are merged into the user's
+        merged data, like CsvLoader.read_tail() does, other changes merge
+        all shards of the user again. Everything is merged again when
+        shards swap places.
+        :param shards: list of PresenceData instances loaded from paths
+        :return: PresenceData instance
+        """
+        current = dict(item for item in zip(paths, shards) if item[1])
+        order = sorted((path for path in paths if path in current),
+                       key=lambda path: first_day(current[path]))
+        previous, data = self.shards, dict(self.data)
+        if [path for path in self.order if path in current] != \
+                [path for path in order if path in previous]:
+            previous, data = {}, {}
+
+        parts, appended = {}, {}
+        for user_id, changed_paths in changed_users(current, previous):
+            data.pop(user_id, None)
+            user_paths = [path for path in order if user_id in current[path]]
+            rows = self.loaders[user_paths[-1]].appended.get(user_id) \
+                if user_paths else None
+            if len(user_paths) > 1 and rows is not None and \
+                    changed_paths == user_paths[-1:]:
+                appended[user_id] = merge(self.data[user_id], *rows)
+            elif user_paths:
+                parts[user_id] = [current[path][user_id]
+                                  for path in user_paths]
+        data.update(merge_users(parts, engine))
+        data.update(aggregate(appended, engine))
+
+        self.order, self.shards = order, current
+        return PresenceData(data)
+
+    def counters(self):
+        """
+        Returns counters of all shard loaders, see COUNTERS.
+        """
+        return [
+            sum(getattr(loader, name) for loader in self.loaders.itervalues())
+            for name in self.COUNTERS
+        ]
+
+    def load_new(self, paths, engine, workers):
+        """
+        Parses shards which cannot be appended to in worker processes.
+
+        Chunks of all such shards, be it one or many, are parsed by one
+        pool, see parsing.parse_files().
+        """
+        files = []
+        for path in paths:
+            stat = os.stat(path)
+            if self.loaders[path].needs_full_load(path, stat):
+                files.append((path, stat, PresenceBuilder()))
+        if not files:
+            return
+        log.info('Loading %d presence files with %d processes', len(files),
+                 workers)
+        results = parse_files(
+            [(path, stat.st_size, builder) for path, stat, builder in files],
+            workers
+        )
+        for (path, stat, builder), result in zip(files, results):
+            self.loaders[path].load_parsed(path, stat, builder, result,
+                                           engine)
+
+
+class UserData(dict):
+    """
+    Users directory, {user_id: {'name': ..., 'avatar': ...}}.
+
+    version attribute identifies state of the file the data was read
+    from, so it changes whenever the data does.
+    """
+    __slots__ = ('version',)
+
+    def __init__(self, *args, **kwargs):
+        super(UserData, self).__init__(*args, **kwargs)
+        self.version = None
+
+
+def parse_users(xmlfile):
+    """
+    Extracts user data from XML file and groups it by user_id.
+
+    File is parsed incrementally and processed elements are dropped, so
+    memory use does not depend on the number of users.
+    :return: UserData instance
+    """
+    server = {}
+    users = []
+    for _, elem in etree.iterparse(xmlfile, events=('end',)):
+        if elem.tag in ('host', 'port', 'protocol') and \
+                elem.getparent().tag == 'server':
+            server[elem.tag] = elem.text
+        elif elem.tag == 'user':
+            avatar = elem.find('./avatar')
+            users.append((
+                int(elem.get('id')),
+                elem.find('./name').text,
+                avatar.text if avatar is not None else None,
+            ))
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+    avatar_prefix = None
+    if set(server) == set(['host', 'port', 'protocol']):
+        avatar_prefix = "%s://%s:%s" % (server['protocol'], server['host'],
+                                        server['port'])
+
+    data = UserData()
+    for user_id, name, avatar in users:
+        data[user_id] = {'name': name}
+        if avatar_prefix and avatar is not None:
+            data[user_id]['avatar'] = avatar_prefix + avatar
+    return data
+
+
+class XmlLoader(object):
+    """
+    Loads users XML file and keeps it up to date.
+
+    The file is parsed again only when its path, inode, size or mtime
+    changes. Listing of users merged with presence data is built once per
+    change of any of them.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.data = UserData()
+        self.listing = None
+        self.loads = 0
+        self.load_time = 0.0
+
+    def load(self, path):
+        """
+        Returns users directory read from path.
+        """
+        with self.lock:
+            stat = os.stat(path)
+            version = (path, (stat.st_dev, stat.st_ino), stat.st_size,
+                       stat.st_mtime)
+            if version != self.data.version:
+                log.info('Loading %s', path)
+                started = default_timer()
+                with open(path, 'rb') as xmlfile:
+                    data = parse_users(xmlfile)
+                data.version = version
+                self.data = data
+                self.loads += 1
+                self.load_time += default_timer() - started
+            return self.data
+
+    def users_listing(self, users, presence):
+        """
+        Returns listing of users present in presence data.
+
+        Users absent in the directory get a generic name and no avatar.
+        :param users: UserData instance returned by load()
+        """
+        version = (users.version, presence.version)
+        listing = self.listing
+        if listing is None or listing[0] != version:
+            listing = self.listing = (version, [
+                {'user_id': i,
+                 'name': users.get(i, {}).get('name', 'User {0}'.format(i)),
+                 'avatar': users.get(i, {}).get('avatar', '')}
+                for i in presence.keys()
+            ])
+        return listing[1]
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of request handling, caches and data loading.
+
+Collected values are exposed by /api/v1/_metrics view in Prometheus text
+exposition format. Every server process keeps its own values, so with
+pre-forked workers (see presence_analyzer.prefork) each scrape shows the
+worker which happened to handle it.
+"""
+
+from threading import Lock
+from timeit import default_timer
+
+from flask import g, request
+
+from presence_analyzer.main import app
+from presence_analyzer import utils
+from presence_analyzer.lazy import LazyPresenceData
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# upper bounds of request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observed values, per label value.
+    """
+
+    def __init__(self, buckets):
+        self.lock = Lock()
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, label, value):
+        """
+        Records single observation.
+        """
+        with self.lock:
+            try:
+                counts, total = self.values[label]
+            except KeyError:
+                counts, total = [0] * (len(self.buckets) + 1), 0.0
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self.values[label] = (counts, total + value)
+
+    def snapshot(self):
+        """
+        Returns {label: (bucket counts, sum)} copy of observations.
+
+        Last bucket count is the total number of observations.
+        """
+        with self.lock:
+            return dict(
+                (label, (list(counts), total))
+                for label, (counts, total) in self.values.iteritems()
+            )
+
+
+class Counter(object):
+    """
+    Counters, per label values.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.values = {}
+
+    def inc(self, key, value=1):
+        """
+        Increments counter of given tuple of label values.
+        """
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def snapshot(self):
+        """
+        Returns {labels: value} copy of counters.
+        """
+        with self.lock:
+            return dict(self.values)
+
+
+REQUESTS = Counter()
+REQUEST_LATENCY = Histogram(LATENCY_BUCKETS)
+
+
+@app.before_request
+def start_timer():
+    """
+    Remembers when handling of request started.
+    """
+    g.request_started = default_timer()
+
+
+@app.after_request
+def record_request(response):
+    """
+    Records request count and latency of matched route.
+
+    For streamed responses latency covers time until the first byte.
+    """
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        endpoint = request.endpoint or 'unmatched'
+        REQUESTS.inc((endpoint, request.method, str(response.status_code)))
+        REQUEST_LATENCY.observe(endpoint, default_timer() - started)
+    return response
+
+
+def escape(value):
+    """
+    Escapes label value.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def labels(**values):
+    """
+    Formats label set, like {endpoint="users_view"}.
+    """
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, escape(value))
+        for name, value in sorted(values.iteritems())
+    ) + '}'
+
+
+def metric(name, kind, description, samples):
+    """
+    Formats metric family.
+
+    :param samples: list of (name suffix, labels string, value) tuples
+    """
+    lines = [
+        '# HELP {0} {1}'.format(name, description),
+        '# TYPE {0} {1}'.format(name, kind),
+    ]
+    lines.extend(
+        '{0}{1}{2} {3}'.format(name, suffix, label_set, repr(float(value)))
+        for suffix, label_set, value in samples
+    )
+    return lines
+
+
+def request_metrics():
+    """
+    Formats request counters and latency histograms.
+    """
+    latency = []
+    for endpoint, (counts, total) in sorted(
+            REQUEST_LATENCY.snapshot().iteritems()):
+        bounds = [repr(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+        latency.extend(
+            ('_bucket', labels(endpoint=endpoint, le=bound), count)
+            for bound, count in zip(bounds, counts)
+        )
+        latency.append(('_sum', labels(endpoint=endpoint), total))
+        latency.append(('_count', labels(endpoint=endpoint), counts[-1]))
+
+    return metric(
+        'presence_requests_total', 'counter',
+        'Handled requests by endpoint, method and status.',
+        [
+            ('', labels(endpoint=endpoint, method=method, status=status),
+             value)
+            for (endpoint, method, status), value in sorted(
+                REQUESTS.snapshot().iteritems()
+            )
+        ]
+    ) + metric(
+        'presence_request_duration_seconds', 'histogram',
+        'Request handling time by endpoint.', latency
+    )
+
+
+# (metric name, kind, cache_info() key, description)
+CACHE_METRICS = [
+    ('presence_cache_hits_total', 'counter', 'hits',
+     'Calls served from cache.'),
+    ('presence_cache_misses_total', 'counter', 'misses',
+     'Calls which had to wait for value to be computed.'),
+    ('presence_cache_stale_total', 'counter', 'stale',
+     'Calls served with expired value while it was recomputed.'),
+    ('presence_cache_evictions_total', 'counter', 'evictions',
+     'Values evicted to stay within cache limits.'),
+    ('presence_cache_expired_total', 'counter', 'expired',
+     'Expired values purged from cache.'),
+    ('presence_cache_refreshes_total', 'counter', 'refreshes',
+     'Computations of cached values.'),
+    ('presence_cache_refresh_seconds_total', 'counter', 'refresh_time',
+     'Time spent computing cached values.'),
+    ('presence_cache_entries', 'gauge', 'entries',
+     'Number of cached values.'),
+    ('presence_cache_bytes', 'gauge', 'bytes',
+     'Approximate size of cached values, if cache has a memory limit.'),
+]
+
+
+def cache_metrics():
+    """
+    Formats statistics of every function decorated with utils.cache.
+    """
+    infos = sorted(
+        (func.__name__, func.cache_info()) for func in utils.CACHED
+    )
+    lines = []
+    for name, kind, key, description in CACHE_METRICS:
+        lines.extend(metric(name, kind, description, [
+            ('', labels(function=function), info[key])
+            for function, info in infos
+        ]))
+    return lines
+
+
+def ingest_metrics():
+    """
+    Formats statistics of presence and users files loading.
+    """
+    data_loader = utils.get_data_loader()
+    index_loader = utils.INDEX_LOADER
+    users_loader = utils.USERS_LOADER
+    return metric(
+        'presence_ingest_loads_total', 'counter',
+        'Loads of presence CSV files by kind.',
+        [('', labels(kind='full'), data_loader.full_loads),
+         ('', labels(kind='tail'), data_loader.tail_loads)]
+    ) + metric(
+        'presence_ingest_seconds_total', 'counter',
+        'Time spent loading presence CSV files.',
+        [('', '', data_loader.load_time)]
+    ) + metric(
+        'presence_ingest_last_seconds', 'gauge',
+        'Duration of the last load of presence CSV files.',
+        [('', '', data_loader.last_load_time)]
+    ) + metric(
+        'presence_ingest_rows_total', 'counter',
+        'Presence rows parsed.',
+        [('', '', data_loader.parsed_rows)]
+    ) + metric(
+        'presence_ingest_rejected_lines_total', 'counter',
+        'Malformed lines of presence CSV files skipped.',
+        [('', '', data_loader.rejected_lines)]
+    ) + metric(
+        'presence_index_loads_total', 'counter',
+        'Indexes of presence CSV file for lazy loading by source.',
+        [('', labels(source='scan'), index_loader.index_builds),
+         ('', labels(source='file'), index_loader.index_loads)]
+    ) + metric(
+        'presence_users_loads_total', 'counter',
+        'Loads of users XML file.',
+        [('', '', users_loader.loads)]
+    ) + metric(
+        'presence_users_seconds_total', 'counter',
+        'Time spent parsing users XML file.',
+        [('', '', users_loader.load_time)]
+    )
+
+
+def data_metrics():
+    """
+    Formats size of currently loaded presence data.
+
+    Data is not loaded if it was not loaded yet. Of lazily loaded data
+    only users parsed so far count as loaded.
+    """
+    data = utils.get_data.cache_peek()
+    if data is None:
+        return []
+    if isinstance(data, LazyPresenceData):
+        presences = data.loaded()
+    else:
+        presences = data.values()
+    return metric(
+        'presence_data_users', 'gauge', 'Users in loaded presence data.',
+        [('', '', len(data))]
+    ) + metric(
+        'presence_data_rows', 'gauge', 'Rows in loaded presence data.',
+        [('', '', sum(len(presence) for presence in presences))]
+    ) + metric(
+        'presence_data_bytes', 'gauge',
+        'Approximate memory held by loaded presence data.',
+        [('', '', utils.approximate_size(data))]
+    )
+
+
+def render_metrics():
+    """
+    Returns all metrics in Prometheus text exposition format.
+    """
+    lines = request_metrics() + cache_metrics() + ingest_metrics() + \
+        data_metrics()
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Parsing of presence CSV exports.
+
+Rows are expected in a fixed ``user_id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS``
+layout. Well-formed rows are decoded by slicing fixed offsets; anything
+else goes through the lenient csv/strptime path.
+
+Large files, or many files at once, can be parsed by a pool of
+processes, see parse_parallel() and parse_files().
+"""
+
+import csv
+from calendar import monthrange
+from datetime import date, datetime
+from itertools import islice
+
+from presence_analyzer.store import PresenceBuilder, time_to_seconds
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# 'YYYY-MM' -> (ordinal of the day before the 1st, days in month)
+_MONTHS = {}
+
+
+def _month(prefix):
+    """
+    Returns cached (ordinal offset, number of days) for 'YYYY-MM' prefix.
+
+    Raises ValueError for malformed or out of range prefixes.
+    """
+    try:
+        return _MONTHS[prefix]
+    except KeyError:
+        pass
+    if prefix[4] != '-' or not (prefix[:4] + prefix[5:]).isdigit():
+        raise ValueError(prefix)
+    year, month = int(prefix[:4]), int(prefix[5:])
+    first = date(year, month, 1).toordinal()
+    _MONTHS[prefix] = result = (first - 1, monthrange(year, month)[1])
+    return result
+
+
+def _seconds(value):
+    """
+    Converts 'HH:MM:SS' into seconds since midnight.
+
+    Raises ValueError for malformed or out of range values.
+    """
+    if len(value) != 8 or value[2] != ':' or value[5] != ':':
+        raise ValueError(value)
+    hours, minutes, seconds = value[:2], value[3:5], value[6:]
+    if not (hours + minutes + seconds).isdigit():
+        raise ValueError(value)
+    hours, minutes, seconds = int(hours), int(minutes), int(seconds)
+    if hours > 23 or minutes > 59 or seconds > 59:
+        raise ValueError(value)
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def parse_fast(line):
+    """
+    Parses well-formed presence line.
+
+    :return: (user_id, day ordinal, start, end) tuple or None when line
+        does not follow the fixed layout
+    """
+    fields = line.rstrip('\r\n').split(',')
+    if len(fields) != 4:
+        return None
+    user_id, day, start, end = fields
+    try:
+        if len(day) != 10 or day[7] != '-' or not day[8:].isdigit():
+            return None
+        offset, days_in_month = _month(day[:7])
+        day = int(day[8:])
+        if not 0 < day <= days_in_month:
+            return None
+        return (int(user_id), offset + day, _seconds(start), _seconds(end))
+    except ValueError:
+        return None
+
+
+def parse_lenient(line):
+    """
+    Parses presence line the slow way, using csv and strptime.
+
+    :return: (user_id, day ordinal, start, end) tuple or None for header
+        and footer lines
+    :raise: ValueError or TypeError for malformed lines
+    """
+    rows = list(csv.reader([line], delimiter=','))
+    if len(rows) != 1 or len(rows[0]) != 4:
+        # ignore header and footer lines
+        return None
+    row = rows[0]
+    user_id = int(row[0])
+    day = datetime.strptime(row[1], '%Y-%m-%d').toordinal()
+    start = datetime.strptime(row[2], '%H:%M:%S').time()
+    end = datetime.strptime(row[3], '%H:%M:%S').time()
+    return (user_id, day, time_to_seconds(start), time_to_seconds(end))
+
+
+def parse_lines(lines, builder):
+    """
+    Feeds presence rows found in lines into PresenceBuilder.
+
+    :return: (number of parsed rows, number of rejected lines) tuple
+    """
+    parsed = rejected = 0
+    add = builder.add
+    for i, line in enumerate(lines):
+        row = parse_fast(line)
+        if row is None:
+            try:
+                row = parse_lenient(line)
+            except (ValueError, TypeError):
+                log.debug('Problem with line %d: ', i, exc_info=True)
+                rejected += 1
+                continue
+            if row is None:
+                continue
+        add(*row)
+        parsed += 1
+    return parsed, rejected
+
+
+# chunks smaller than this are not worth sending to another process
+MIN_CHUNK_SIZE = 1 << 20
+
+
+def chunk_ranges(csvfile, size, chunks):
+    """
+    Splits file into byte ranges starting and ending on line boundaries.
+
+    :param size: number of bytes of the file to split
+    :param chunks: requested number of ranges, fewer are returned for
+        small files
+    :return: list of (begin, end) offsets covering whole file in order
+    """
+    chunks = max(1, min(chunks, size // MIN_CHUNK_SIZE))
+    ranges = []
+    begin = 0
+    for i in range(1, chunks + 1):
+        if i == chunks:
+            end = size
+        else:
+            csvfile.seek(max(begin, size * i // chunks))
+            csvfile.readline()
+            end = min(csvfile.tell(), size)
+        if end > begin:
+            ranges.append((begin, end))
+            begin = end
+    return ranges
+
+
+def parse_chunk(args):
+    """
+    Parses one byte range of a file, run in pool worker processes.
+
+    :param args: (path, begin, end) tuple
+    :return: ({user_id: (days, starts, ends)}, parsed, rejected, offset,
+        guard) tuple, where columns are array.tostring() bytes in file
+        order and offset and guard are end and contents of the last
+        complete line in the range (None if there is none)
+    """
+    path, begin, end = args
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(begin)
+        lines = csvfile.read(end - begin).splitlines(True)
+    builder = PresenceBuilder()
+    parsed, rejected = parse_lines(lines, builder)
+
+    offset = guard = None
+    if lines:
+        if lines[-1][-1:] == '\n':
+            offset, guard = end, lines[-1]
+        elif len(lines) > 1:
+            offset, guard = end - len(lines[-1]), lines[-2]
+    columns = dict(
+        (user_id, tuple(column.tostring() for column in user_columns))
+        for user_id, user_columns in builder.columns.iteritems()
+    )
+    return columns, parsed, rejected, offset, guard
+
+
+def parse_parallel(path, size, builder, workers):
+    """
+    Feeds presence rows of first size bytes of file into PresenceBuilder,
+    parsing newline aligned chunks in a pool of worker processes.
+
+    Partial results are merged in file order, so when a day of a user
+    occurs more than once the last line still wins, just like with
+    parse_lines(). Falls back to parsing in the current process when the
+    file is too small to split or the pool cannot be started.
+    :return: (parsed, rejected, offset, guard) tuple, see parse_chunk()
+    """
+    return parse_files([(path, size, builder)], workers)[0]
+
+
+def parse_files(files, workers):
+    """
+    Parses many files at once in one pool of worker processes, see
+    parse_parallel().
+
+    Chunks of all files are parsed concurrently, so many small files
+    keep the workers as busy as a single large one.
+    :param files: list of (path, size, PresenceBuilder) tuples
+    :return: list of (parsed, rejected, offset, guard) tuples, one for
+        every file
+    """
+    tasks = []
+    counts = []
+    for path, size, _ in files:
+        with open(path, 'rb') as csvfile:
+            ranges = chunk_ranges(csvfile, size, workers * 4)
+        tasks.extend((path, begin, end) for begin, end in ranges)
+        counts.append(len(ranges))
+    log.debug('Parsing %d files in %d chunks', len(files), len(tasks))
+
+    results = iter(map_tasks(tasks, workers))
+    return [
+        collect(builder, islice(results, count))
+        for (_, _, builder), count in zip(files, counts)
+    ]
+
+
+def collect(builder, results):
+    """
+    Feeds results of parse_chunk() for chunks of one file, in file order,
+    into PresenceBuilder.
+
+    :return: (parsed, rejected, offset, guard) tuple
+    """
+    parsed = rejected = 0
+    offset, guard = 0, ''
+    for columns, chunk_parsed, chunk_rejected, end, line in results:
+        for user_id, user_columns in columns.iteritems():
+            builder.extend(user_id, *user_columns)
+        parsed += chunk_parsed
+        rejected += chunk_rejected
+        if end is not None:
+            offset, guard = end, line
+    return parsed, rejected, offset, guard
+
+
+def map_tasks(tasks, workers):
+    """
+    Runs parse_chunk() for every (path, begin, end) task, in worker
+    processes if possible.
+
+    :return: list of results in order of tasks
+    """
+    if len(tasks) > 1 and workers > 1:
+        try:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(workers, len(tasks)))
+        except (ImportError, OSError):
+            log.warning('Cannot start worker processes', exc_info=True)
+        else:
+            try:
+                return pool.map(parse_chunk, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+    return [parse_chunk(task) for task in tasks]
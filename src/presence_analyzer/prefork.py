@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-forking multi-process WSGI server.
+
+Request handling is CPU-bound Python, so threads of a single process
+cannot use more than one core. This server binds one listening socket,
+loads data in the parent process and forks worker processes which share
+the socket and, copy-on-write, the loaded data.
+
+Signals handled by parent process:
+ - SIGTERM, SIGINT: stop workers and exit,
+ - SIGHUP: graceful restart, i.e. reload data, start new workers and let
+   old ones finish their current request and exit.
+"""
+
+import os
+import time
+import errno
+import select
+import signal
+import socket
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def preload_data():
+    """
+    Loads data files and primes caches before workers are forked.
+
+    Data is loaded in the calling thread, so no background refresh thread
+    (which could hold a lock while forking) is started.
+    """
+    from presence_analyzer.warmup import warm_up
+    warm_up(reload_data=True)
+
+
+class RequestHandler(WSGIRequestHandler):
+    """
+    Request handler logging through logging module.
+    """
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        log.info('%s - %s', self.address_string(), format % args)
+
+
+class WorkerServer(WSGIServer):
+    """
+    WSGI server of a single worker, accepting on inherited socket.
+    """
+
+    def __init__(self, sock, app):
+        # pylint: disable=non-parent-init-called
+        WSGIServer.__init__(self, sock.getsockname(), RequestHandler,
+                            bind_and_activate=False)
+        self.socket = sock
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+        self.setup_environ()
+        self.set_app(app)
+        self.handled = 0
+
+    def process_request(self, request, client_address):
+        self.handled += 1
+        WSGIServer.process_request(self, request, client_address)
+
+
+class PreforkServer(object):
+    """
+    Pre-forking server.
+    :param app: WSGI application
+    :param processes: number of worker processes
+    :param max_requests: number of requests after which worker is
+        replaced with a fresh one, 0 for no limit
+    :param preload: function called in parent before workers are forked
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, app, host='0.0.0.0', port=8080, processes=4,
+                 max_requests=0, preload=preload_data):
+        # pylint: disable=too-many-arguments
+        self.app = app
+        self.address = (host, int(port))
+        self.processes = int(processes)
+        self.max_requests = int(max_requests)
+        self.preload = preload
+        self.socket = None
+        self.workers = set()
+        self.running = False
+        self.restarting = False
+
+    def bind(self):
+        """
+        Creates listening socket shared by all workers.
+        """
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.address)
+        self.socket.listen(128)
+        # idle workers woken up for a connection somebody else accepted
+        # must not block in accept()
+        self.socket.setblocking(0)
+        self.address = self.socket.getsockname()
+        return self.address
+
+    def serve_forever(self):
+        """
+        Runs parent process loop until stopped with a signal.
+        """
+        if self.socket is None:
+            self.bind()
+        self.running = True
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_restart)
+        log.info('Serving on %s:%d with %d processes',
+                 self.address[0], self.address[1], self.processes)
+        if self.preload is not None:
+            self.preload()
+        try:
+            while self.running:
+                if self.restarting:
+                    self.restart()
+                while len(self.workers) < self.processes:
+                    self.spawn()
+                self.reap()
+                time.sleep(0.5)
+        finally:
+            self.stop()
+
+    def handle_stop(self, signum, frame):
+        # pylint: disable=unused-argument
+        """
+        Stops server.
+        """
+        self.running = False
+
+    def handle_restart(self, signum, frame):
+        # pylint: disable=unused-argument
+        """
+        Schedules graceful restart.
+        """
+        self.restarting = True
+
+    def restart(self):
+        """
+        Reloads data and replaces all workers.
+        """
+        log.info('Restarting workers')
+        self.restarting = False
+        old_workers = list(self.workers)
+        if self.preload is not None:
+            self.preload()
+        for _ in range(self.processes):
+            self.spawn()
+        for pid in old_workers:
+            self.kill(pid)
+        # old workers do not count, they are already finishing
+        self.workers.difference_update(old_workers)
+
+    def spawn(self):
+        """
+        Forks new worker process.
+        """
+        pid = os.fork()
+        if not pid:
+            self.worker_main()
+        self.workers.add(pid)
+        return pid
+
+    def worker_main(self):
+        """
+        Runs worker and exits worker process, never returns.
+        """
+        exit_code = 0
+        try:
+            self.run_worker()
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Worker %d failed', os.getpid())
+            exit_code = 1
+        finally:
+            os._exit(exit_code)  # pylint: disable=protected-access
+
+    def reap(self):
+        """
+        Collects exited worker processes.
+        """
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                if exc.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            self.workers.discard(pid)
+
+    @staticmethod
+    def kill(pid):
+        """
+        Asks worker to finish its current request and exit.
+        """
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError as exc:
+            if exc.errno != errno.ESRCH:
+                raise
+
+    def stop(self):
+        """
+        Stops all workers and waits for them.
+        """
+        for pid in self.workers:
+            self.kill(pid)
+        for pid in self.workers:
+            try:
+                os.waitpid(pid, 0)
+            except OSError as exc:
+                if exc.errno != errno.ECHILD:
+                    raise
+        self.workers.clear()
+        self.running = False
+
+    def run_worker(self):
+        """
+        Serves requests until asked to stop or max_requests is reached.
+        """
+        state = {'stopping': False}
+
+        def handle_stop(signum, frame):  # pylint: disable=unused-argument
+            """
+            Stops after current request.
+            """
+            state['stopping'] = True
+
+        signal.signal(signal.SIGTERM, handle_stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        server = WorkerServer(self.socket, self.app)
+        while not state['stopping']:
+            if self.max_requests and server.handled >= self.max_requests:
+                log.debug('Worker %d reached max_requests', os.getpid())
+                break
+            try:
+                server.handle_request()
+            except (select.error, socket.error) as exc:
+                if exc.args[0] != errno.EINTR:
+                    raise
+
+
+# [paste.server_runner] entry point
+def serve(wsgi_app, global_conf, host='0.0.0.0', port=8080, processes=4,
+          max_requests=0):
+    """
+    Runs pre-forking server for paste.deploy configuration.
+    """
+    # pylint: disable=unused-argument, too-many-arguments
+    PreforkServer(wsgi_app, host, port, processes,
+                  max_requests).serve_forever()
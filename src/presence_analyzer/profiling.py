@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in request profiler and slow request log.
+
+Profiling is enabled with PROFILE_ENABLED option and then done only for
+requests asking for it with X-Profile header or _profile query
+parameter. Profile of every such request is written to PROFILE_DIR as
+a .pstats file, readable with pstats module or tools like snakeviz.
+
+Requests taking longer than SLOW_REQUEST_THRESHOLD seconds (1 by
+default, 0 disables the log) are logged with their route, arguments and
+time spent in each phase recorded with timed(): loading data ('load'),
+computing the response ('aggregation') and encoding it
+('serialization').
+"""
+
+import os
+import errno
+from contextlib import contextmanager
+from cProfile import Profile
+from timeit import default_timer
+
+from flask import g, request, has_request_context
+
+from presence_analyzer.main import app
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+DEFAULT_PROFILE_DIR = os.path.join('var', 'profiles')
+DEFAULT_SLOW_REQUEST_THRESHOLD = 1.0
+PHASES = ('load', 'aggregation', 'serialization')
+
+
+@contextmanager
+def timed(phase):
+    """
+    Adds time spent in the block to given phase of current request.
+    """
+    started = default_timer()
+    try:
+        yield
+    finally:
+        if has_request_context():
+            timings = g.setdefault('timings', {})
+            timings[phase] = timings.get(phase, 0.0) + \
+                default_timer() - started
+
+
+def profile_requested():
+    """
+    Checks whether current request should be profiled.
+    """
+    if not app.config.get('PROFILE_ENABLED'):
+        return False
+    value = request.headers.get('X-Profile') or request.args.get('_profile')
+    return value not in (None, '', '0')
+
+
+@app.before_request
+def start_request():
+    """
+    Starts request timer and, if requested, profiler.
+    """
+    g.timings = {}
+    g.started = default_timer()
+    if profile_requested():
+        g.profiler = Profile()
+        g.profiler.enable()
+
+
+def dump_profile(profiler):
+    """
+    Writes profile of current request to PROFILE_DIR.
+
+    :return: path of written file
+    """
+    directory = app.config.get('PROFILE_DIR', DEFAULT_PROFILE_DIR)
+    try:
+        os.makedirs(directory)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    path = os.path.join(directory, '{0}-{1:.6f}-{2}.pstats'.format(
+        request.endpoint or 'unmatched', default_timer(), os.getpid()
+    ))
+    profiler.dump_stats(path)
+    log.info('Profile of %s written to %s', request.path, path)
+    return path
+
+
+def stop_profiler():
+    """
+    Stops profiler of current request, if any, and writes its profile.
+
+    :return: path of written file or None when request was not profiled
+    """
+    profiler = g.get('profiler')
+    if profiler is None:
+        return None
+    profiler.disable()
+    g.profiler = None
+    return dump_profile(profiler)
+
+
+@app.after_request
+def finish_request(response):
+    """
+    Stops profiler and logs request if it was slow.
+    """
+    path = stop_profiler()
+    if path is not None:
+        response.headers['X-Profile-File'] = os.path.basename(path)
+
+    started = g.get('started')
+    threshold = app.config.get('SLOW_REQUEST_THRESHOLD',
+                               DEFAULT_SLOW_REQUEST_THRESHOLD)
+    if started is None or not threshold:
+        return response
+    duration = default_timer() - started
+    if duration >= threshold:
+        timings = g.get('timings', {})
+        log.warning(
+            'Slow request %s %s (%s, view_args=%r, args=%r) took %.3fs: %s',
+            request.method, request.path,
+            request.url_rule.rule if request.url_rule else None,
+            request.view_args, request.args.to_dict(), duration,
+            ', '.join(
+                '{0} {1:.3f}s'.format(phase, timings.get(phase, 0.0))
+                for phase in PHASES
+            )
+        )
+    return response
+
+
+@app.teardown_request
+def teardown_profiler(exc):  # pylint: disable=unused-argument
+    """
+    Stops profiler of request which failed before after_request handlers.
+    """
+    stop_profiler()
@@ -26,10 +26,14 @@ del _buildout_path
 
 
 # bin/paster serve parts/etc/deploy.ini
-def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+def make_app(global_conf={}, config=DEPLOY_CFG, debug=False, warm_up=True):
+    """Configure the application, warm it up for serving if configured."""
     from presence_analyzer import app
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    if warm_up and app.config.get('WARMUP'):
+        from presence_analyzer import warmup
+        warmup.warm_up()
     return app
 
 
@@ -44,19 +48,21 @@ def make_debug(global_conf={}, **conf):
 def make_shell():
     """Interactive Flask Shell"""
     from flask import request
-    app = make_app()
+    app = make_app(warm_up=False)
     http = app.test_client()
     reqctx = app.test_request_context
     return locals()
 
 
-def _serve(action, debug=False, dry_run=False):
-    """Build paster command from 'action' and 'debug' flag."""
+def _serve(action, debug=False, dry_run=False, prefork=False):
+    """Build paster command from 'action', 'debug' and 'prefork' flags."""
     if debug:
         config = DEBUG_INI
     else:
         config = DEPLOY_INI
     argv = ['bin/paster', 'serve', config]
+    if prefork:
+        argv += ['--server-name=prefork']
     if action in ('start', 'restart'):
         argv += [action, '--daemon']
     elif action in ('', 'fg', 'foreground'):
@@ -82,8 +88,8 @@ def _serve(action, debug=False, dry_run=False):
 def run():
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
 
-    # bin/flask-ctl serve [fg|start|stop|restart|status]
-    def action_serve(action=('a', 'start'), dry_run=False):
+    # bin/flask-ctl serve [fg|start|stop|restart|status] [--prefork]
+    def action_serve(action=('a', 'start'), dry_run=False, prefork=False):
         """Serve the application.
 
         This command serves a web application that uses a paste.deploy
@@ -92,8 +98,10 @@ def run():
         Options:
          - 'action' is one of [fg|start|stop|restart|status]
          - '--dry-run' print the paster command and exit
+         - '--prefork' serve with pre-forked worker processes instead of
+           threads, see presence_analyzer.prefork
         """
-        _serve(action, debug=False, dry_run=dry_run)
+        _serve(action, debug=False, dry_run=dry_run, prefork=prefork)
 
     # bin/flask-ctl debug [fg|start|stop|restart|status]
     def action_debug(action=('a', 'start'), dry_run=False):
@@ -110,6 +118,11 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl snapshot
+    def action_snapshot():
+        """Compile DATA_CSV into DATA_SNAPSHOT binary snapshot."""
+        compile_snapshot()
+
     werkzeug.script.run()
 
 
@@ -118,9 +131,29 @@ def fetch_users_file():
     Fetch USERS_XML file from remote host.
     """
     import urllib
-    app = make_app()
+    app = make_app(warm_up=False)
 
     users_xml = app.config['USERS_XML']
     users_url = app.config['USERS_XML_URL']
 
     urllib.urlretrieve(users_url, users_xml)
+
+
+def compile_snapshot():
+    """
+    Compile DATA_CSV file into DATA_SNAPSHOT memory-mappable snapshot.
+    """
+    from presence_analyzer.loader import is_sharded
+    from presence_analyzer.snapshot import write_snapshot
+    app = make_app(warm_up=False)
+
+    data_csv = app.config['DATA_CSV']
+    data_snapshot = app.config.get('DATA_SNAPSHOT')
+    if not data_snapshot:
+        sys.exit('DATA_SNAPSHOT option is not set')
+    if is_sharded(data_csv):
+        sys.exit('Snapshot can be compiled from a single DATA_CSV file only')
+
+    users = write_snapshot(data_csv, data_snapshot)
+    print 'Compiled %d users from %s into %s' % (
+        users, data_csv, data_snapshot)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped binary snapshot of presence data.
+
+Snapshot is compiled from DATA_CSV (see script.compile_snapshot) and
+opened with mmap, so all worker processes share one page cache copy of
+it and startup does not need to parse CSV file.
+
+File layout, all values little-endian:
+ - header: magic, format version, number of users, size, mtime and sha1
+   checksum of the source CSV file,
+ - index: one entry per user with user id, offset and number of its
+   records and its weekday totals (see store.WeekdayStats),
+ - records: for every user three int32 columns, days, starts and ends.
+"""
+
+import os
+import mmap
+import struct
+import hashlib
+from threading import Lock
+
+from presence_analyzer.loader import CsvLoader
+from presence_analyzer.store import PresenceData, UserPresence, \
+    WeekdayStats
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+MAGIC = 'PRESNAP\0'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIIQd20s')
+INDEX_ENTRY = struct.Struct('<qQI28q')
+RECORD = struct.Struct('<i')
+
+
+class SnapshotError(Exception):
+    """
+    Snapshot file is malformed or does not match its source.
+    """
+
+
+def checksum(path):
+    """
+    Returns sha1 digest of file contents.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(1 << 20), ''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def write_snapshot(csv_path, snapshot_path):
+    """
+    Compiles CSV file into snapshot file.
+
+    Snapshot is written to a temporary file first and renamed, so
+    processes never see partially written snapshot.
+    :return: number of users written
+    """
+    stat = os.stat(csv_path)
+    digest = checksum(csv_path)
+    data = CsvLoader().load(csv_path)
+    user_ids = sorted(data)
+
+    offset = HEADER.size + INDEX_ENTRY.size * len(user_ids)
+    index = []
+    for user_id in user_ids:
+        presence = data[user_id]
+        stats = presence.stats
+        index.append(INDEX_ENTRY.pack(
+            user_id, offset, len(presence),
+            *(stats.counts + stats.intervals + stats.starts + stats.ends)
+        ))
+        offset += 3 * RECORD.size * len(presence)
+
+    tmp_path = '{0}.{1}.tmp'.format(snapshot_path, os.getpid())
+    with open(tmp_path, 'wb') as snapshot:
+        snapshot.write(HEADER.pack(
+            MAGIC, FORMAT_VERSION, len(user_ids), stat.st_size,
+            stat.st_mtime, digest
+        ))
+        snapshot.writelines(index)
+        for user_id in user_ids:
+            presence = data[user_id]
+            for column in (presence.days, presence.starts, presence.ends):
+                snapshot.write(struct.pack(
+                    '<{0}i'.format(len(column)), *column
+                ))
+    os.rename(tmp_path, snapshot_path)
+    return len(user_ids)
+
+
+class MappedColumn(object):
+    """
+    Read-only sequence of int32 values stored in mapped snapshot.
+    """
+    __slots__ = ('buf', 'offset', 'length')
+
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(self.length))]
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return RECORD.unpack_from(self.buf, self.offset + i * RECORD.size)[0]
+
+    def __iter__(self):
+        return iter(struct.unpack_from(
+            '<{0}i'.format(self.length), self.buf, self.offset
+        ))
+
+
+class MappedUserPresence(UserPresence):
+    """
+    Presence entries of a single user read from mapped snapshot.
+
+    Columns are read directly from the mapping, nothing is copied, and
+    weekday totals come from snapshot index.
+    """
+    __slots__ = ()
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, buf, offset, length, stats):
+        self.days = MappedColumn(buf, offset, length)
+        self.starts = MappedColumn(buf, offset + length * RECORD.size,
+                                   length)
+        self.ends = MappedColumn(buf, offset + 2 * length * RECORD.size,
+                                 length)
+        self._stats = stats
+        self._prefix = None
+
+
+def read_snapshot(path):
+    """
+    Opens snapshot file.
+
+    :return: (header fields, PresenceData instance) tuple
+    :raise: SnapshotError if file is malformed
+    """
+    with open(path, 'rb') as snapshot:
+        if os.fstat(snapshot.fileno()).st_size < HEADER.size:
+            raise SnapshotError('Snapshot {0} is truncated'.format(path))
+        buf = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if len(buf) < HEADER.size:
+        raise SnapshotError('Snapshot {0} is truncated'.format(path))
+    header = HEADER.unpack_from(buf, 0)
+    magic, version, users = header[:3]
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise SnapshotError('Unsupported snapshot {0}'.format(path))
+    if len(buf) < HEADER.size + users * INDEX_ENTRY.size:
+        raise SnapshotError('Snapshot {0} is truncated'.format(path))
+
+    presences = []
+    for i in xrange(users):
+        entry = INDEX_ENTRY.unpack_from(
+            buf, HEADER.size + i * INDEX_ENTRY.size
+        )
+        user_id, offset, length = entry[:3]
+        if offset + 3 * RECORD.size * length > len(buf):
+            raise SnapshotError('Snapshot {0} is truncated'.format(path))
+        totals = entry[3:]
+        stats = WeekdayStats.from_totals(
+            totals[0:7], totals[7:14], totals[14:21], totals[21:28]
+        )
+        presences.append(
+            (user_id, MappedUserPresence(buf, offset, length, stats))
+        )
+    return header, PresenceData(presences)
+
+
+class SnapshotLoader(object):
+    """
+    Opens snapshot file and keeps it up to date.
+
+    Snapshot is used only if it was compiled from current contents of the
+    CSV file: its size and mtime must match those recorded in snapshot,
+    otherwise file checksum is compared.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.snapshot_version = None
+        self.header = None
+        self.data = None
+        self.verified = {}
+
+    def load(self, path, csv_path):
+        """
+        Returns data from snapshot or None if it is missing or stale.
+        """
+        with self.lock:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                log.warning('Snapshot %s does not exist', path)
+                return None
+
+            version = (path, (stat.st_dev, stat.st_ino), stat.st_size,
+                       stat.st_mtime)
+            if version != self.snapshot_version:
+                log.info('Opening snapshot %s', path)
+                self.snapshot_version = version
+                self.verified = {}
+                try:
+                    self.header, self.data = read_snapshot(path)
+                except SnapshotError:
+                    log.exception('Cannot open snapshot %s', path)
+                    self.header = self.data = None
+
+            if self.data is None:
+                return None
+            if not self.is_current(csv_path):
+                log.warning('Snapshot %s is stale', path)
+                return None
+            return self.data
+
+    def is_current(self, csv_path):
+        """
+        Checks whether snapshot was compiled from current CSV contents.
+        """
+        stat = os.stat(csv_path)
+        source = (csv_path, stat.st_size, stat.st_mtime)
+        if source not in self.verified:
+            _, _, _, size, mtime, digest = self.header
+            current = (size, mtime) == (stat.st_size, stat.st_mtime)
+            # only a touched file of the same size is worth reading through
+            if not current and size == stat.st_size:
+                current = digest == checksum(csv_path)
+            self.verified = {source: current}
+            if current:
+                self.data.version = source
+        return self.verified[source]
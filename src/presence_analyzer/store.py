@@ -0,0 +1,547 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, array-backed storage of presence entries.
+
+Loaded data is read-only: columns are FrozenArray instances, weekday
+totals are tuples, PresenceData rejects item assignment and attributes
+cannot be reassigned once set. Any attempt to modify shared data raises
+TypeError, so cached data can be handed
+out to every caller as it is; copy and deepcopy return the very same
+objects.
+"""
+
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import izip, islice
+from datetime import date, time
+
+# 32-bit signed integers are enough for both day ordinals (~735000 today)
+# and seconds since midnight (< 86400).
+TYPECODE = 'i'
+
+
+def read_only(self, *args, **kwargs):
+    """
+    Rejects modification of read-only presence data.
+    """
+    # pylint: disable=unused-argument
+    raise TypeError('{0} is read-only'.format(type(self).__name__))
+
+
+def set_once(self, name, value):
+    """
+    Sets attribute of read-only object, only while it is not set yet.
+
+    Lets constructors fill in slots and rejects any later assignment.
+    """
+    if isinstance(getattr(type(self), name, None), property) or \
+            hasattr(self, name):
+        read_only(self)
+    object.__setattr__(self, name, value)
+
+
+def same(self, *args):
+    """
+    Returns object itself as its copy, read-only objects need no copies.
+    """
+    # pylint: disable=unused-argument
+    return self
+
+
+class FrozenArray(array):
+    """
+    Typed array which cannot be modified after creation.
+
+    Slices and concatenations are ordinary arrays.
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __new__(cls, typecode, initializer=()):
+        if isinstance(initializer, array) and \
+                initializer.typecode == typecode:
+            # copying raw bytes is much faster than iterating over items
+            initializer = initializer.tostring()
+        return array.__new__(cls, typecode, initializer)
+
+    append = extend = insert = pop = remove = reverse = byteswap = \
+        fromfile = fromlist = fromstring = fromunicode = __setitem__ = \
+        __delitem__ = __setslice__ = __delslice__ = __iadd__ = \
+        __imul__ = read_only
+    __copy__ = __deepcopy__ = same
+
+
+def weekday(day):
+    """
+    Returns weekday (Monday is 0) of given day ordinal.
+
+    Ordinal 1 is Monday, 1 January of year 1, so no datetime.date
+    instance is needed.
+    """
+    return (day + 6) % 7
+
+
+def seconds_to_time(seconds):
+    """
+    Converts seconds since midnight to datetime.time object.
+    """
+    return time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def time_to_seconds(dtime):
+    """
+    Converts datetime.time object to seconds since midnight.
+    """
+    return dtime.hour * 3600 + dtime.minute * 60 + dtime.second
+
+
+class WeekdayStats(object):
+    """
+    Presence totals of a single user grouped by weekday.
+
+    Each attribute is a tuple with one value for every day in week:
+     - counts: number of days with presence,
+     - intervals: sum of presence intervals in seconds,
+     - starts: sum of start times in seconds since midnight,
+     - ends: sum of end times in seconds since midnight.
+    """
+    __slots__ = ('counts', 'intervals', 'starts', 'ends')
+    __setattr__ = set_once
+
+    def __init__(self, rows=()):
+        counts, intervals, starts, ends = [0] * 7, [0] * 7, [0] * 7, [0] * 7
+        for day, start, end in rows:
+            day = weekday(day)
+            counts[day] += 1
+            intervals[day] += end - start
+            starts[day] += start
+            ends[day] += end
+        self.counts = tuple(counts)
+        self.intervals = tuple(intervals)
+        self.starts = tuple(starts)
+        self.ends = tuple(ends)
+
+    @classmethod
+    def from_totals(cls, counts, intervals, starts, ends):
+        """
+        Creates stats from already computed weekday totals.
+        """
+        stats = cls.__new__(cls)
+        stats.counts = tuple(counts)
+        stats.intervals = tuple(intervals)
+        stats.starts = tuple(starts)
+        stats.ends = tuple(ends)
+        return stats
+
+    __copy__ = __deepcopy__ = same
+
+    def total_intervals(self):
+        """
+        Returns total presence time for every weekday.
+        """
+        return list(self.intervals)
+
+    def mean_intervals(self):
+        """
+        Returns mean presence time for every weekday, zero if no entries.
+        """
+        return [
+            float(total) / count if count else 0
+            for total, count in izip(self.intervals, self.counts)
+        ]
+
+    def mean_start_end(self):
+        """
+        Returns [weekday, mean start, mean end] for weekdays with entries.
+        """
+        return [
+            [day, self.starts[day] // count, self.ends[day] // count]
+            for day, count in enumerate(self.counts)
+            if count
+        ]
+
+    def nbytes(self):
+        """
+        Approximate amount of memory held by this object, in bytes.
+        """
+        return sys.getsizeof(self) + sum(
+            sys.getsizeof(column) + sum(sys.getsizeof(i) for i in column)
+            for column in (self.counts, self.intervals, self.starts,
+                           self.ends)
+        )
+
+
+# 64-bit (on LP64 platforms) for cumulative sums of seconds
+SUM_TYPECODE = 'l'
+
+
+class PrefixSums(object):
+    """
+    Cumulative weekday totals of a single user.
+
+    Entries are split by weekday. For every weekday there is a sorted
+    array of its days and arrays of cumulative sums of presence intervals,
+    start times and end times, one element longer than days, so that
+    totals of entries days[i:j] are sums[j] - sums[i]. Number of entries
+    is j - i. Totals of any range of days therefore take two binary
+    searches and a subtraction per weekday, no matter how long the range.
+    """
+    __slots__ = ('days', 'intervals', 'starts', 'ends')
+    __setattr__ = set_once
+
+    def __init__(self, rows=()):
+        days = [array(TYPECODE) for _ in range(7)]
+        intervals = [array(SUM_TYPECODE, [0]) for _ in range(7)]
+        starts = [array(SUM_TYPECODE, [0]) for _ in range(7)]
+        ends = [array(SUM_TYPECODE, [0]) for _ in range(7)]
+        for day, start, end in rows:
+            i = weekday(day)
+            days[i].append(day)
+            intervals[i].append(intervals[i][-1] + end - start)
+            starts[i].append(starts[i][-1] + start)
+            ends[i].append(ends[i][-1] + end)
+        self.days = tuple(FrozenArray(TYPECODE, a) for a in days)
+        self.intervals = tuple(
+            FrozenArray(SUM_TYPECODE, a) for a in intervals
+        )
+        self.starts = tuple(FrozenArray(SUM_TYPECODE, a) for a in starts)
+        self.ends = tuple(FrozenArray(SUM_TYPECODE, a) for a in ends)
+
+    __copy__ = __deepcopy__ = same
+
+    def totals(self, first=None, last=None):
+        """
+        Returns weekday totals of entries from first to last day ordinal.
+
+        Both boundaries are inclusive, None means no bound.
+        :return: WeekdayStats instance
+        """
+        counts, intervals, starts, ends = [0] * 7, [0] * 7, [0] * 7, [0] * 7
+        for i, days in enumerate(self.days):
+            begin = 0 if first is None else bisect_left(days, first)
+            stop = len(days) if last is None else bisect_right(days, last)
+            if stop <= begin:
+                continue
+            counts[i] = stop - begin
+            intervals[i] = self.intervals[i][stop] - self.intervals[i][begin]
+            starts[i] = self.starts[i][stop] - self.starts[i][begin]
+            ends[i] = self.ends[i][stop] - self.ends[i][begin]
+        return WeekdayStats.from_totals(counts, intervals, starts, ends)
+
+    def nbytes(self):
+        """
+        Approximate amount of memory held by this object, in bytes.
+        """
+        return sys.getsizeof(self) + sum(
+            sys.getsizeof(columns) + sum(sys.getsizeof(c) for c in columns)
+            for columns in (self.days, self.intervals, self.starts,
+                            self.ends)
+        )
+
+
+def periods(first, last, period):
+    """
+    Yields (label, first day, last day) of periods covering given days.
+
+    :param first: first day ordinal
+    :param last: last day ordinal
+    :param period: 'month' (labels like 2013-09) or 'week' (ISO weeks,
+        labels like 2013-W37)
+    """
+    if period == 'week':
+        day = first - weekday(first)
+        while day <= last:
+            year, week, _ = date.fromordinal(day).isocalendar()
+            yield '{0}-W{1:02d}'.format(year, week), day, day + 6
+            day += 7
+    elif period == 'month':
+        current = date.fromordinal(first).replace(day=1)
+        while current.toordinal() <= last:
+            year, month = current.year, current.month
+            following = date(year + month // 12, month % 12 + 1, 1)
+            yield ('{0}-{1:02d}'.format(year, month), current.toordinal(),
+                   following.toordinal() - 1)
+            current = following
+    else:
+        raise ValueError('Unknown period: {0}'.format(period))
+
+
+class UserPresence(object):
+    """
+    Presence entries of a single user.
+
+    Entries are kept in three parallel read-only arrays sorted by day:
+     - days: proleptic Gregorian ordinals (see date.toordinal()),
+     - starts: start of presence in seconds since midnight,
+     - ends: end of presence in seconds since midnight.
+
+    Weekday totals (see WeekdayStats) are computed once and kept in stats
+    attribute. They are filled in by the aggregation engine right after
+    data is loaded (see presence_analyzer.engine) or computed on first
+    access otherwise. Cumulative ones (see PrefixSums), kept in prefix
+    attribute, are always computed on first access.
+    """
+    __slots__ = ('days', 'starts', 'ends', '_stats', '_prefix')
+    __setattr__ = set_once
+
+    def __init__(self, days=(), starts=(), ends=()):
+        self.days = FrozenArray(TYPECODE, days)
+        self.starts = FrozenArray(TYPECODE, starts)
+        self.ends = FrozenArray(TYPECODE, ends)
+        self._stats = None
+        self._prefix = None
+
+    __copy__ = __deepcopy__ = same
+
+    @property
+    def stats(self):
+        """
+        Weekday totals of this user.
+        """
+        if self._stats is None:
+            self._set_aggregates(stats=WeekdayStats(self.rows()))
+        return self._stats
+
+    @property
+    def prefix(self):
+        """
+        Cumulative weekday totals of this user.
+        """
+        if self._prefix is None:
+            self._set_aggregates(prefix=PrefixSums(self.rows()))
+        return self._prefix
+
+    def _set_aggregates(self, stats=None, prefix=None):
+        """
+        Caches weekday totals, left out ones are kept as they are.
+
+        Aggregates are derived from entries, so filling them in does not
+        change the data; only the aggregation engine and this class do
+        that.
+        """
+        if stats is not None:
+            object.__setattr__(self, '_stats', stats)
+        if prefix is not None:
+            object.__setattr__(self, '_prefix', prefix)
+
+    def __len__(self):
+        return len(self.days)
+
+    def rows(self):
+        """
+        Iterates over (day, start, end) tuples in chronological order.
+        """
+        return izip(self.days, self.starts, self.ends)
+
+    def index(self, day):
+        """
+        Returns position of given day ordinal or -1 if it is absent.
+        """
+        i = bisect_left(self.days, day)
+        if i < len(self.days) and self.days[i] == day:
+            return i
+        return -1
+
+    def stats_between(self, first=None, last=None):
+        """
+        Returns weekday totals of entries from first to last day ordinal,
+        both inclusive.
+
+        Totals are taken from prefix sums, no entries are copied or even
+        visited, see PrefixSums.totals(). Use between() when the entries
+        themselves are needed.
+        :param first: first day ordinal, None for no lower bound
+        :param last: last day ordinal, None for no upper bound
+        :return: WeekdayStats instance, stats when range is not bounded
+        """
+        if first is None and last is None:
+            return self.stats
+        return self.prefix.totals(first, last)
+
+    def between(self, first=None, last=None):
+        """
+        Returns entries from first to last day ordinal, both inclusive.
+
+        Range boundaries are found by binary search over sorted days, so
+        only entries inside the range are copied. Weekday totals of the
+        result are taken from prefix sums, not computed from its entries.
+        :param first: first day ordinal, None for no lower bound
+        :param last: last day ordinal, None for no upper bound
+        :return: UserPresence instance, self when range is not bounded
+        """
+        if first is None and last is None:
+            return self
+        begin = 0 if first is None else bisect_left(self.days, first)
+        stop = len(self.days) if last is None else \
+            bisect_right(self.days, last)
+        stop = max(begin, stop)
+        presence = UserPresence(
+            self.days[begin:stop], self.starts[begin:stop],
+            self.ends[begin:stop]
+        )
+        # pylint: disable=protected-access
+        presence._set_aggregates(stats=self.stats_between(first, last))
+        return presence
+
+    def rollup(self, period):
+        """
+        Returns weekday totals of every month or week with entries.
+
+        :param period: 'month' or 'week', see periods()
+        :return: list of (label, first day, last day, WeekdayStats)
+        """
+        if not self.days:
+            return []
+        prefix = self.prefix
+        result = []
+        for label, first, last in periods(self.days[0], self.days[-1],
+                                          period):
+            stats = prefix.totals(first, last)
+            if any(stats.counts):
+                result.append((label, first, last, stats))
+        return result
+
+    def nbytes(self):
+        """
+        Approximate amount of memory held by this object, in bytes.
+        """
+        size = sys.getsizeof(self) + sum(
+            sys.getsizeof(column)
+            for column in (self.days, self.starts, self.ends)
+        )
+        if self._stats is not None:
+            size += self._stats.nbytes()
+        if self._prefix is not None:
+            size += self._prefix.nbytes()
+        return size
+
+    # Read-only, date-keyed access kept for interactive use (flask-ctl
+    # shell) and debugging. Aggregations should use rows() instead.
+    def __contains__(self, day):
+        return self.index(day.toordinal()) >= 0
+
+    def __getitem__(self, day):
+        i = self.index(day.toordinal())
+        if i < 0:
+            raise KeyError(day)
+        return {
+            'start': seconds_to_time(self.starts[i]),
+            'end': seconds_to_time(self.ends[i]),
+        }
+
+    def __iter__(self):
+        return (date.fromordinal(day) for day in self.days)
+
+
+def compact(days, starts, ends):
+    """
+    Sorts parallel columns by day and drops duplicated days.
+
+    When a day occurs more than once the entry added last wins.
+    :return: UserPresence instance
+    """
+    if all(a < b for a, b in izip(days, islice(days, 1, None))):
+        return UserPresence(days, starts, ends)
+
+    # sorted() is stable, so among equal days the latest entry comes last
+    order = sorted(xrange(len(days)), key=days.__getitem__)
+    columns = (array(TYPECODE), array(TYPECODE), array(TYPECODE))
+    sorted_days, sorted_starts, sorted_ends = columns
+    for i in order:
+        if sorted_days and sorted_days[-1] == days[i]:
+            sorted_starts[-1] = starts[i]
+            sorted_ends[-1] = ends[i]
+        else:
+            sorted_days.append(days[i])
+            sorted_starts.append(starts[i])
+            sorted_ends.append(ends[i])
+    return UserPresence(*columns)
+
+
+def merge(presence, days, starts, ends):
+    """
+    Merges new entries into existing user presence.
+
+    Existing UserPresence is left untouched. New entries win over existing
+    ones for the same day.
+    :param presence: UserPresence instance or None
+    :return: new UserPresence instance
+    """
+    if presence is None:
+        return compact(days, starts, ends)
+    return compact(
+        presence.days + days,
+        presence.starts + starts,
+        presence.ends + ends,
+    )
+
+
+class PresenceData(dict):
+    """
+    Presence of all users, {user_id: UserPresence}.
+
+    Users are given at creation, afterwards the dictionary is read-only.
+    version attribute identifies state of the source the data was read
+    from, so it changes whenever the data does.
+    """
+    __slots__ = ('version',)
+
+    def __init__(self, *args, **kwargs):
+        super(PresenceData, self).__init__(*args, **kwargs)
+        self.version = None
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = read_only
+    __copy__ = __deepcopy__ = same
+
+    def __reduce__(self):
+        return (PresenceData, (dict(self),))
+
+
+class PresenceBuilder(object):
+    """
+    Accumulates presence rows in file order and builds compact storage.
+    """
+
+    def __init__(self):
+        self.columns = {}
+
+    def add(self, user_id, day, start, end):
+        """
+        Appends single presence entry of given user.
+        """
+        try:
+            days, starts, ends = self.columns[user_id]
+        except KeyError:
+            days, starts, ends = self.columns[user_id] = (
+                array(TYPECODE), array(TYPECODE), array(TYPECODE)
+            )
+        days.append(day)
+        starts.append(start)
+        ends.append(end)
+
+    def extend(self, user_id, days, starts, ends):
+        """
+        Appends entries of given user, columns as array.tostring() bytes.
+        """
+        try:
+            columns = self.columns[user_id]
+        except KeyError:
+            columns = self.columns[user_id] = (
+                array(TYPECODE), array(TYPECODE), array(TYPECODE)
+            )
+        for column, values in zip(columns, (days, starts, ends)):
+            column.fromstring(values)
+
+    def build(self):
+        """
+        Creates structure like this:
+        data = {
+            'user_id': UserPresence(...),
+        }
+        :return: PresenceData instance
+        """
+        return PresenceData(
+            (user_id, compact(*columns))
+            for user_id, columns in self.columns.iteritems()
+        )
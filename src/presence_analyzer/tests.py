@@ -2,13 +2,30 @@
 """
 Presence analyzer unit tests.
 """
+# pylint: disable=too-many-lines
+import os
 import os.path
+import copy
+import gzip
+import pstats
+import logging
+import signal
+import sys
+import urllib2
 import json
+import pickle
+import shutil
 import datetime
+import tempfile
+import threading
+import time
 import unittest
+from StringIO import StringIO
 
-from presence_analyzer import main, utils
+from presence_analyzer import main, utils, store, parsing, loader, engine, \
+    snapshot, lazy, prefork, metrics, profiling, warmup, watcher
 from presence_analyzer import views  # pylint: disable=unused-import
+from presence_analyzer.benchmark import generator, harness
 
 
 TEST_DATA_CSV = os.path.join(
@@ -18,6 +35,9 @@ TEST_DATA_MANGLED_W_HEADER_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data',
     'test_data_mangled_w_header.csv'
 )
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'sample_data.csv'
+)
 TEST_USERS_XML = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_users.xml'
 )
@@ -36,6 +56,7 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
         main.app.config.update({'USERS_XML': TEST_USERS_XML})
         utils.get_data.cache_duration = -1
+        utils.get_data.cache_stale_while_revalidate = False
         self.client = main.app.test_client()
 
     def tearDown(self):
@@ -121,6 +142,236 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         resp = self.client.get('/api/v1/presence_start_end/9000')
         self.assertEqual(resp.status_code, 404)
 
+    def test_date_range(self):
+        """
+        Test per-user views limited to range of days.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10?from=2013-09-11&to=2013-09-11'
+        )
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertListEqual(
+            [[day, interval] for day, interval in data if interval > 0],
+            [[u'Weekday', u'Presence (s)'], [u'Wed', 24465]]
+        )
+
+        resp = self.client.get('/api/v1/presence_start_end/10?from=2013-09-11')
+        self.assertListEqual(json.loads(resp.data),
+                             [[u'Wed', 33592, 58057],
+                              [u'Thu', 38926, 62631]])
+
+        resp = self.client.get('/api/v1/mean_time_weekday/10?to=2013-09-10')
+        self.assertListEqual(
+            [[day, interval]
+             for day, interval in json.loads(resp.data) if interval > 0],
+            [[u'Tue', 30047]]
+        )
+
+        resp = self.client.get('/api/v1/mean_time_weekday/10?from=2014-01-01')
+        self.assertEqual(resp.status_code, 200)
+        self.assertListEqual(
+            [interval for _, interval in json.loads(resp.data)], [0] * 7
+        )
+
+        # empty parameters mean no bound
+        resp = self.client.get('/api/v1/presence_start_end/10?from=&to=')
+        self.assertEqual(len(json.loads(resp.data)), 3)
+
+        resp = self.client.get('/api/v1/presence_weekday/10?from=yesterday')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/presence_weekday/9000?to=2013-09-11')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_rollup(self):
+        """
+        Test monthly and weekly rollups.
+        """
+        resp = self.client.get('/api/v1/rollup/11')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['period'], '2013-09')
+        self.assertEqual(data[0]['from'], '2013-09-01')
+        self.assertEqual(data[0]['to'], '2013-09-30')
+        self.assertEqual(data[0]['days'], 6)
+
+        resp = self.client.get('/api/v1/rollup/11?period=week')
+        data = json.loads(resp.data)
+        self.assertListEqual([entry['period'] for entry in data],
+                             ['2013-W36', '2013-W37'])
+        self.assertListEqual([entry['days'] for entry in data], [1, 5])
+        self.assertListEqual(data[0]['weekdays'][3], [u'Thu', 1, 22999])
+        totals = json.loads(
+            self.client.get('/api/v1/presence_weekday/11').data
+        )[1:]
+        self.assertEqual(sum(entry['presence'] for entry in data),
+                         sum(interval for _, interval in totals))
+
+        resp = self.client.get('/api/v1/rollup/11?period=year')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/rollup/9000')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_batch_stats(self):
+        """
+        Test statistics of many users in one request.
+        """
+        resp = self.client.get('/api/v1/batch_stats?user_ids=10,9000,11')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertListEqual([entry['user_id'] for entry in data],
+                             [10, 9000, 11])
+        self.assertDictEqual(data[1],
+                             {u'user_id': 9000, u'error': u'User not found'})
+        for entry in (data[0], data[2]):
+            for metric in ('mean_time_weekday', 'presence_weekday',
+                           'presence_start_end'):
+                resp = self.client.get(
+                    '/api/v1/{0}/{1}'.format(metric, entry['user_id'])
+                )
+                self.assertEqual(entry[metric], json.loads(resp.data))
+
+        resp = self.client.get(
+            '/api/v1/batch_stats?user_ids=10&metrics=presence_start_end'
+        )
+        data = json.loads(resp.data)
+        self.assertItemsEqual(data[0].keys(),
+                              ['user_id', 'presence_start_end'])
+
+        for query in ('', 'user_ids=', 'user_ids=1,x',
+                      'user_ids=10&metrics=foo'):
+            resp = self.client.get('/api/v1/batch_stats?' + query)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_export(self):
+        """
+        Test streaming export of all users.
+        """
+        resp = self.client.get('/api/v1/export')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/x-ndjson')
+        lines = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertListEqual([line['user_id'] for line in lines], [10, 11])
+        weekdays = lines[0]['weekdays']
+        self.assertEqual(len(weekdays), 7)
+        self.assertDictEqual(weekdays[1], {
+            u'weekday': u'Tue', u'days': 1, u'presence': 30047,
+            u'mean_presence': 30047, u'mean_start': 34745,
+            u'mean_end': 64792,
+        })
+
+        resp = self.client.get('/api/v1/export?format=csv')
+        self.assertEqual(resp.content_type.split(';')[0], 'text/csv')
+        lines = resp.data.splitlines()
+        self.assertEqual(len(lines), 1 + 2 * 7)
+        self.assertEqual(lines[2], '10,Tue,1,30047,30047.0,34745,64792')
+
+        resp = self.client.get('/api/v1/export?kind=rows&format=csv')
+        with open(TEST_DATA_CSV) as csvfile:
+            self.assertListEqual(resp.data.splitlines(),
+                                 csvfile.read().splitlines())
+
+        resp = self.client.get('/api/v1/export?kind=rows')
+        lines = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(len(lines), 9)
+        self.assertDictEqual(lines[0], {
+            u'user_id': 10, u'date': u'2013-09-10', u'start': 34745,
+            u'end': 64792,
+        })
+
+        for query in ('kind=foo', 'format=xml'):
+            resp = self.client.get('/api/v1/export?' + query)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_conditional_requests(self):
+        """
+        Test ETag and Last-Modified based conditional responses.
+        """
+        for url in ('/api/v1/users', '/api/v1/mean_time_weekday/10',
+                    '/api/v1/presence_weekday/10',
+                    '/api/v1/presence_start_end/10'):
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            etag = resp.headers['ETag']
+            last_modified = resp.headers['Last-Modified']
+
+            resp = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, '')
+            self.assertEqual(resp.headers['ETag'], etag)
+
+            resp = self.client.get(
+                url, headers={'If-Modified-Since': last_modified}
+            )
+            self.assertEqual(resp.status_code, 304)
+
+            resp = self.client.get(url, headers={'If-None-Match': '"x"'})
+            self.assertEqual(resp.status_code, 200)
+            resp = self.client.get(
+                url,
+                headers={'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'}
+            )
+            self.assertEqual(resp.status_code, 200)
+
+        # invalid requests fail even when data has not changed
+        last_modified = resp.headers['Last-Modified']
+        for url, status in [('/api/v1/mean_time_weekday/9999', 404),
+                            ('/api/v1/presence_weekday/10?from=bad', 400),
+                            ('/api/v1/rollup/10?period=year', 400),
+                            ('/api/v1/rollup/9999', 404),
+                            ('/api/v1/batch_stats?user_ids=x', 400)]:
+            resp = self.client.get(
+                url, headers={'If-Modified-Since': last_modified}
+            )
+            self.assertEqual(resp.status_code, status)
+
+        first = self.client.get('/api/v1/presence_weekday/10')
+        second = self.client.get('/api/v1/presence_weekday/11')
+        self.assertNotEqual(first.headers['ETag'], second.headers['ETag'])
+
+        main.app.config.update({'DATA_CSV': SAMPLE_DATA_CSV})
+        third = self.client.get('/api/v1/presence_weekday/10')
+        self.assertNotEqual(first.headers['ETag'], third.headers['ETag'])
+
+    def test_response_cache(self):
+        """
+        Test cached and compressed JSON responses.
+        """
+        utils.encode_response.cache_clear()
+        misses = utils.encode_response.cache_info()['misses']
+        plain = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        resp = self.client.get('/api/v1/mean_time_weekday/10',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertNotEqual(resp.headers['ETag'], plain.headers['ETag'])
+        body = gzip.GzipFile(fileobj=StringIO(resp.data)).read()
+        self.assertEqual(body, plain.data)
+        self.assertEqual(utils.encode_response.cache_info()['entries'], 1)
+        self.assertEqual(
+            utils.encode_response.cache_info()['misses'], misses + 1
+        )
+
+        resp = self.client.get(
+            '/api/v1/mean_time_weekday/10',
+            headers={'Accept-Encoding': 'gzip',
+                     'If-None-Match': resp.headers['ETag']}
+        )
+        self.assertEqual(resp.status_code, 304)
+
+        self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(utils.encode_response.cache_info()['entries'], 2)
+
+        main.app.config.update({'DATA_CSV': SAMPLE_DATA_CSV})
+        self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(utils.encode_response.cache_info()['entries'], 1)
+
     def test_templates(self):
         """
         Test templates renderers
@@ -145,6 +396,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
         main.app.config.update({'USERS_XML': TEST_USERS_XML})
         utils.get_data.cache_duration = -1
+        utils.get_data.cache_stale_while_revalidate = False
 
     def tearDown(self):
         """
@@ -183,6 +435,35 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
             datetime.time(9, 19, 50)
         )
 
+    def test_weekday_aggregates(self):
+        """
+        Test that precomputed aggregates match grouped intervals.
+        """
+        main.app.config.update({'DATA_CSV': SAMPLE_DATA_CSV})
+        for items in utils.get_data().itervalues():
+            weekdays = utils.group_by_weekday(items)
+            self.assertListEqual(
+                utils.mean_by_weekday(items),
+                [utils.mean(intervals) for intervals in weekdays]
+            )
+            self.assertListEqual(
+                utils.total_by_weekday(items),
+                [sum(intervals) for intervals in weekdays]
+            )
+
+        presence = store.UserPresence(
+            [735000, 735007, 735001], [100, 200, 300], [1000, 2001, 900]
+        )
+        self.assertListEqual(
+            utils.mean_start_end_by_weekday(presence),
+            sorted([[store.weekday(735000), 150, 1500],
+                    [store.weekday(735001), 300, 900]])
+        )
+        self.assertEqual(
+            utils.mean_by_weekday(presence)[store.weekday(735000)],
+            1350.5
+        )
+
     def test_get_user_data(self):
         """
         Test parsing of user XML file.
@@ -193,6 +474,55 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertIn('name', data[11])
         self.assertEqual(data[11]['name'], u'Nowak B.')
 
+    def test_get_user_data_cached(self):
+        """
+        Test that users XML is parsed again only when it changes.
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'users.xml')
+            shutil.copy(TEST_USERS_XML, path)
+            main.app.config.update({'USERS_XML': path})
+            data = utils.get_user_data()
+            self.assertIs(utils.get_user_data(), data)
+            listing = utils.get_users_listing()
+            self.assertIs(utils.get_users_listing(), listing)
+
+            with open(path, 'w') as xmlfile:
+                xmlfile.write(
+                    '<intranet><users>'
+                    '<user id="10"><avatar>/a/10</avatar>'
+                    '<name>Nowy C.</name></user>'
+                    '<user id="12"><name>Inny D.</name></user>'
+                    '</users></intranet>'
+                )
+            os.utime(path, (0, 0))
+            data = utils.get_user_data()
+            self.assertDictEqual(data, {
+                10: {'name': 'Nowy C.'},
+                12: {'name': 'Inny D.'},
+            })
+            self.assertListEqual(utils.get_users_listing(), [
+                {'user_id': 10, 'name': 'Nowy C.', 'avatar': ''},
+                {'user_id': 11, 'name': 'User 11', 'avatar': ''},
+            ])
+        finally:
+            main.app.config.update({'USERS_XML': TEST_USERS_XML})
+            shutil.rmtree(tmpdir)
+
+    def test_parse_users(self):
+        """
+        Test incremental parsing of users XML file.
+        """
+        with open(TEST_USERS_XML) as xmlfile:
+            data = loader.parse_users(xmlfile)
+        self.assertDictEqual(data, {
+            10: {'name': 'Kowalski A.',
+                 'avatar': 'http://example.com:80/api/images/users/10'},
+            11: {'name': 'Nowak B.',
+                 'avatar': 'http://example.com:80/api/images/users/11'},
+        })
+
     def test_cache(self):
         """
         Test caching.
@@ -219,6 +549,1727 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         f().append('test')
         self.assertListEqual(f(), [])
 
+    def test_cache_stats(self):
+        """
+        Test caching statistics.
+        """
+        # pylint: disable=missing-docstring
+
+        @utils.cache()
+        def func(arg):
+            return arg
+
+        func(1)
+        func(1)
+        func(2)
+        func.cache_duration = -1
+        func(1)
+        stats = func.cache_stats
+        self.assertEqual(
+            (stats['hits'], stats['misses'], stats['stale']),
+            (1, 3, 0)
+        )
+        self.assertEqual(stats['refreshes'], 3)
+        self.assertGreaterEqual(stats['refresh_time'], 0)
+
+    def test_cache_bounds(self):
+        """
+        Test LRU eviction and memory budget of cache.
+        """
+        # pylint: disable=missing-docstring
+
+        @utils.cache(max_entries=2)
+        def func(arg):
+            func.calls += 1
+            return arg
+        func.calls = 0
+
+        func(1)
+        func(2)
+        func(1)
+        func(3)
+        self.assertEqual(func.cache_info()['entries'], 2)
+        self.assertEqual(func.cache_info()['evictions'], 1)
+        func(1)
+        self.assertEqual(func.calls, 3)
+        func(2)
+        self.assertEqual(func.calls, 4)
+
+        @utils.cache(max_bytes=2000)
+        def big(arg):
+            return [arg] * 100
+
+        big(1)
+        big(2)
+        big(3)
+        info = big.cache_info()
+        self.assertEqual(info['entries'], 2)
+        self.assertLessEqual(info['bytes'], 2000)
+        self.assertGreater(info['bytes'], 0)
+
+    def test_cache_purge(self):
+        """
+        Test purging, invalidation and clearing of cache.
+        """
+        # pylint: disable=missing-docstring
+
+        @utils.cache()
+        def func(arg):
+            return arg
+
+        func(1)
+        func(2)
+        func.cache_duration = -1
+        func(3)
+        self.assertEqual(func.cache_info()['entries'], 1)
+        self.assertEqual(func.cache_info()['expired'], 2)
+
+        func.cache_duration = 600
+        func(1)
+        func(2)
+        func.cache_invalidate(1)
+        self.assertEqual(func.cache_info()['entries'], 2)
+        func.cache_clear()
+        self.assertEqual(func.cache_info()['entries'], 0)
+        self.assertEqual(func.cache_info()['bytes'], 0)
+
+    def test_approximate_size(self):
+        """
+        Test approximation of memory held by objects.
+        """
+        presence = store.UserPresence([1, 2], [3, 4], [5, 6])
+        self.assertEqual(utils.approximate_size(presence), presence.nbytes())
+        self.assertGreater(
+            utils.approximate_size({1: [presence, 'abc']}),
+            presence.nbytes()
+        )
+
+    def test_cache_single_flight(self):
+        """
+        Test that concurrent callers share single computation.
+        """
+        # pylint: disable=missing-docstring
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        @utils.cache()
+        def func(arg):
+            calls.append(arg)
+            if arg == 'slow':
+                started.set()
+                release.wait(5)
+            return arg
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(func('slow')))
+            for _ in range(5)
+        ]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+
+        # other keys are not blocked by ongoing computation
+        self.assertEqual(func('fast'), 'fast')
+
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertListEqual(results, ['slow'] * 5)
+        self.assertListEqual(sorted(calls), ['fast', 'slow'])
+
+    def test_cache_stale_while_revalidate(self):
+        """
+        Test serving stale value while it is refreshed in background.
+        """
+        # pylint: disable=missing-docstring
+        release = threading.Event()
+        refreshed = threading.Event()
+
+        @utils.cache(stale_while_revalidate=True)
+        def func():
+            func.calls += 1
+            if func.calls > 1:
+                release.wait(5)
+                refreshed.set()
+            return func.calls
+        func.calls = 0
+
+        self.assertEqual(func(), 1)
+        func.cache_duration = -1
+        self.assertEqual(func(), 1)
+        self.assertEqual(func(), 1)
+        release.set()
+        refreshed.wait(5)
+        func.cache_duration = 600
+        for _ in range(100):
+            if func() == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(func(), 2)
+        self.assertEqual(func.calls, 2)
+        self.assertEqual(func.cache_stats['stale'], 2)
+
+
+class PresenceAnalyzerStoreTestCase(unittest.TestCase):
+    """
+    Compact presence storage tests.
+    """
+
+    def test_weekday(self):
+        """
+        Test weekday computation from day ordinals.
+        """
+        day = datetime.date(2013, 9, 1)
+        for offset in range(14):
+            current = day + datetime.timedelta(days=offset)
+            self.assertEqual(
+                store.weekday(current.toordinal()),
+                current.weekday()
+            )
+
+    def test_time_conversions(self):
+        """
+        Test conversions between datetime.time and seconds.
+        """
+        self.assertEqual(
+            store.time_to_seconds(datetime.time(9, 39, 5)),
+            34745
+        )
+        self.assertEqual(
+            store.seconds_to_time(34745),
+            datetime.time(9, 39, 5)
+        )
+
+    def test_between(self):
+        """
+        Test selecting entries from range of days.
+        """
+        presence = store.UserPresence(
+            [735000, 735002, 735004], [10, 20, 30], [40, 50, 60]
+        )
+        self.assertIs(presence.between(), presence)
+        self.assertListEqual(
+            list(presence.between(735001, 735004).rows()),
+            [(735002, 20, 50), (735004, 30, 60)]
+        )
+        self.assertListEqual(
+            list(presence.between(last=735002).days), [735000, 735002]
+        )
+        self.assertListEqual(
+            list(presence.between(first=735003).days), [735004]
+        )
+        empty = presence.between(735005, 735001)
+        self.assertEqual(len(empty), 0)
+        self.assertTupleEqual(empty.stats.counts, (0,) * 7)
+
+        self.assertIs(presence.stats_between(), presence.stats)
+        for first, last in [(735001, 735004), (None, 735002), (735005, None)]:
+            self.assertTupleEqual(
+                presence.stats_between(first, last).intervals,
+                presence.between(first, last).stats.intervals
+            )
+
+    def test_prefix_sums(self):
+        """
+        Test weekday totals of ranges computed from prefix sums.
+        """
+        presence = store.UserPresence(
+            range(735000, 735030, 2), range(100, 130, 2), range(200, 260, 4)
+        )
+        for first, last in [(None, None), (735003, 735017),
+                            (None, 735010), (735011, None),
+                            (735100, None), (735010, 735001)]:
+            expected = store.WeekdayStats(
+                row for row in presence.rows()
+                if (first is None or row[0] >= first) and
+                (last is None or row[0] <= last)
+            )
+            stats = presence.prefix.totals(first, last)
+            for name in ('counts', 'intervals', 'starts', 'ends'):
+                self.assertTupleEqual(getattr(stats, name),
+                                      getattr(expected, name))
+
+    def test_periods(self):
+        """
+        Test month and week periods.
+        """
+        first = datetime.date(2012, 11, 30).toordinal()
+        last = datetime.date(2013, 1, 1).toordinal()
+        months = list(store.periods(first, last, 'month'))
+        self.assertListEqual([label for label, _, _ in months],
+                             ['2012-11', '2012-12', '2013-01'])
+        self.assertEqual(months[1][1:], (
+            datetime.date(2012, 12, 1).toordinal(),
+            datetime.date(2012, 12, 31).toordinal(),
+        ))
+        weeks = list(store.periods(first, last, 'week'))
+        self.assertEqual(weeks[0][0], '2012-W48')
+        self.assertEqual(weeks[-1][0], '2013-W01')
+        self.assertEqual(store.weekday(weeks[0][1]), 0)
+        self.assertRaises(ValueError, list,
+                          store.periods(first, last, 'year'))
+
+    def test_builder(self):
+        """
+        Test building of sorted, deduplicated storage.
+        """
+        builder = store.PresenceBuilder()
+        builder.add(10, 735000, 100, 200)
+        builder.add(10, 734999, 300, 400)
+        builder.add(10, 735000, 500, 600)
+        builder.add(11, 735000, 10, 20)
+        data = builder.build()
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertListEqual(
+            list(data[10].rows()),
+            [(734999, 300, 400), (735000, 500, 600)]
+        )
+        self.assertEqual(len(data[11]), 1)
+        self.assertEqual(data[10].index(735000), 1)
+        self.assertEqual(data[10].index(735001), -1)
+        self.assertGreater(data[10].nbytes(), 0)
+
+    def test_read_only(self):
+        """
+        Test that loaded data cannot be modified and is never copied.
+        """
+        builder = store.PresenceBuilder()
+        builder.add(10, 735000, 100, 200)
+        data = builder.build()
+        presence = data[10]
+        with self.assertRaises(TypeError):
+            data[11] = presence
+        for method, args in [('update', ({},)), ('pop', (10,)),
+                             ('setdefault', (11, None)), ('clear', ()),
+                             ('popitem', ()), ('__delitem__', (10,))]:
+            self.assertRaises(TypeError, getattr(data, method), *args)
+        self.assertItemsEqual(data.keys(), [10])
+
+        for column in (presence.days, presence.prefix.days[0],
+                       presence.prefix.intervals[0]):
+            self.assertRaises(TypeError, column.append, 1)
+            self.assertRaises(TypeError, column.__setitem__, 0, 1)
+            self.assertRaises(TypeError, column.extend, [1])
+            with self.assertRaises(TypeError):
+                column += column
+        with self.assertRaises(TypeError):
+            presence.stats.counts[0] += 1
+        for obj, name in [(presence, 'days'), (presence, 'stats'),
+                          (presence, 'prefix'), (presence, '_stats'),
+                          (presence.stats, 'counts'),
+                          (presence.prefix, 'days')]:
+            self.assertRaises(TypeError, setattr, obj, name, ())
+        self.assertEqual(presence.stats.counts[6], 1)
+        self.assertEqual(list(presence.days), [735000])
+        self.assertEqual(list(presence.days[:1] + presence.days), [735000] * 2)
+        self.assertEqual(presence.between(735000, 735000).days[0], 735000)
+
+        self.assertIs(copy.deepcopy(data), data)
+        self.assertIs(copy.copy(presence), presence)
+        self.assertIs(copy.deepcopy({'data': data})['data'], data)
+
+        @utils.cache(copy=True)
+        def func():
+            """
+            Returns read-only data.
+            """
+            return data
+        self.assertIs(func(), func())
+
+        restored = pickle.loads(pickle.dumps(data, 2))
+        self.assertIsInstance(restored, store.PresenceData)
+        self.assertListEqual(list(restored[10].rows()),
+                             list(presence.rows()))
+
+    def test_date_access(self):
+        """
+        Test date-keyed access to user presence.
+        """
+        presence = store.UserPresence([735000], [34745], [64792])
+        sample_date = datetime.date.fromordinal(735000)
+        self.assertIn(sample_date, presence)
+        self.assertNotIn(sample_date + datetime.timedelta(days=1), presence)
+        self.assertListEqual(list(presence), [sample_date])
+        self.assertEqual(
+            presence[sample_date],
+            {'start': datetime.time(9, 39, 5),
+             'end': datetime.time(17, 59, 52)}
+        )
+        self.assertRaises(
+            KeyError,
+            presence.__getitem__, sample_date + datetime.timedelta(days=1)
+        )
+
+
+class PresenceAnalyzerParsingTestCase(unittest.TestCase):
+    """
+    CSV parsing tests.
+    """
+
+    def test_parse_fast(self):
+        """
+        Test fixed-layout parsing of well-formed lines.
+        """
+        self.assertEqual(
+            parsing.parse_fast('10,2013-09-10,09:39:05,17:59:52\r\n'),
+            (10, datetime.date(2013, 9, 10).toordinal(), 34745, 64792)
+        )
+        for line in ('#header\n',
+                     '10,2000-01-01,00:00:00,25:61:61\n',
+                     '10,2013-02-29,09:39:05,17:59:52\n',
+                     '10,2013-13-01,09:39:05,17:59:52\n',
+                     '10,2013-9-10,09:39:05,17:59:52\n',
+                     '10,2013-09-10,9:39:05,17:59:52\n',
+                     '"10",2013-09-10,09:39:05,17:59:52\n',
+                     'x,2013-09-10,09:39:05,17:59:52\n'):
+            self.assertIsNone(parsing.parse_fast(line), line)
+
+    def test_parse_lenient(self):
+        """
+        Test fallback parsing of lines rejected by the fast path.
+        """
+        expected = (10, datetime.date(2013, 9, 10).toordinal(), 34745, 64792)
+        self.assertEqual(
+            parsing.parse_lenient('10,2013-9-10,9:39:5,17:59:52\n'),
+            expected
+        )
+        self.assertEqual(
+            parsing.parse_lenient('"10",2013-09-10,09:39:05,17:59:52\n'),
+            expected
+        )
+        self.assertIsNone(parsing.parse_lenient('#header\n'))
+        self.assertRaises(
+            ValueError,
+            parsing.parse_lenient, '10,2000-01-01,00:00:00,25:61:61\n'
+        )
+
+    def test_parse_lines(self):
+        """
+        Test parsing of mixed lines into builder.
+        """
+        builder = store.PresenceBuilder()
+        parsed, rejected = parsing.parse_lines([
+            '#header\n',
+            '10,2000-01-01,00:00:00,25:61:61\n',
+            '11,2013-09-10,09:19:50,13:55:54\n',
+            '11,2013-9-11,9:19:50,13:55:54\n',
+            'footer\n',
+        ], builder)
+        self.assertEqual((parsed, rejected), (2, 1))
+        data = builder.build()
+        self.assertItemsEqual(data.keys(), [11])
+        self.assertEqual(len(data[11]), 2)
+
+
+class PresenceAnalyzerLoaderTestCase(unittest.TestCase):
+    """
+    Incremental CSV loader tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        self.loader = loader.CsvLoader()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, content, mode='w'):
+        """
+        Writes content to test CSV file.
+        """
+        with open(self.path, mode) as csvfile:
+            csvfile.write(content)
+
+    def test_append(self):
+        """
+        Test that only appended lines are parsed.
+        """
+        self.write('#header\n10,2013-09-10,09:39:05,17:59:52\n')
+        data = self.loader.load(self.path)
+        self.assertItemsEqual(data.keys(), [10])
+        self.assertIs(self.loader.load(self.path), data)
+
+        self.write('10,2013-09-11,09:19:52,16:07:37\n'
+                   '11,2013-09-05,09:28:08,15:5', mode='a')
+        data = self.loader.load(self.path)
+        self.assertEqual((self.loader.full_loads, self.loader.tail_loads),
+                         (1, 1))
+        self.assertItemsEqual(data.keys(), [10])
+        self.assertEqual(len(data[10]), 2)
+
+        self.write('1:27\n10,2013-09-11,08:00:00,16:00:00\n', mode='a')
+        data = self.loader.load(self.path)
+        self.assertEqual((self.loader.full_loads, self.loader.tail_loads),
+                         (1, 2))
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertListEqual(list(data[10].starts), [34745, 28800])
+        self.assertEqual(self.loader.offset, os.path.getsize(self.path))
+
+    def test_unterminated_line(self):
+        """
+        Test that last line without line terminator is parsed.
+        """
+        self.write('10,2013-09-10,09:39:05,17:59:52')
+        data = self.loader.load(self.path)
+        self.assertItemsEqual(data.keys(), [10])
+        self.assertEqual(self.loader.offset, 0)
+
+        self.write('\n11,2013-09-05,09:28:08,15:51:27\n', mode='a')
+        data = self.loader.load(self.path)
+        self.assertEqual(self.loader.tail_loads, 1)
+        self.assertItemsEqual(data.keys(), [10, 11])
+        self.assertEqual(len(data[10]), 1)
+
+    def test_rewrite(self):
+        """
+        Test full reload of truncated and rewritten files.
+        """
+        self.write('10,2013-09-10,09:39:05,17:59:52\n'
+                   '10,2013-09-11,09:19:52,16:07:37\n')
+        self.loader.load(self.path)
+
+        self.write('11,2013-09-10,09:39:05,17:59:52\n')
+        data = self.loader.load(self.path)
+        self.assertEqual(self.loader.full_loads, 2)
+        self.assertItemsEqual(data.keys(), [11])
+
+        self.write('12,2013-09-10,09:39:05,17:59:52\n'
+                   '12,2013-09-11,09:19:52,16:07:37\n')
+        data = self.loader.load(self.path)
+        self.assertEqual(self.loader.full_loads, 3)
+        self.assertItemsEqual(data.keys(), [12])
+
+        other = os.path.join(self.tmpdir, 'other.csv')
+        shutil.copy(self.path, other)
+        self.loader.load(other)
+        self.assertEqual(self.loader.full_loads, 4)
+        self.assertEqual(self.loader.tail_loads, 0)
+
+    def test_rewrite_then_append(self):
+        """
+        Test that rows appended after a full reload are loaded as tail.
+        """
+        self.write('user_id,date,start,end\n'
+                   '10,2013-09-10,09:39:05,17:59:52\n')
+        self.loader.load(self.path)
+
+        # grown, but rewritten: header matches, last consumed line not
+        self.write('user_id,date,start,end\n'
+                   '11,2013-09-10,09:39:05,17:59:52\n'
+                   '11,2013-09-11,09:19:52,16:07:37\n')
+        self.loader.load(self.path)
+        self.assertEqual(self.loader.full_loads, 2)
+        self.assertEqual(self.loader.header, 'user_id,date,start,end\n')
+
+        self.write('11,2013-09-12,10:48:46,17:23:51\n', mode='a')
+        data = self.loader.load(self.path)
+        self.assertEqual((self.loader.full_loads, self.loader.tail_loads),
+                         (2, 1))
+        self.assertEqual(len(data[11]), 3)
+
+    def test_parallel(self):
+        """
+        Test parsing file in chunks by worker processes.
+        """
+        with open(SAMPLE_DATA_CSV) as csvfile:
+            sample = csvfile.read()
+        # later duplicate of an early day has to win after merge
+        self.write('user_id,date,start,end\n' + sample +
+                   '10,2011-06-01,10:00:00,11:00:00\n'
+                   'garbage\n'
+                   '11,2013-09-05,09:28:08,15:5')
+        min_chunk_size = parsing.MIN_CHUNK_SIZE
+        parsing.MIN_CHUNK_SIZE = 16 * 1024
+        try:
+            data = self.loader.load(self.path, workers=4)
+        finally:
+            parsing.MIN_CHUNK_SIZE = min_chunk_size
+        expected_loader = loader.CsvLoader()
+        expected = expected_loader.load(self.path)
+
+        self.assertItemsEqual(data.keys(), expected.keys())
+        for user_id in expected:
+            self.assertListEqual(list(data[user_id].rows()),
+                                 list(expected[user_id].rows()))
+        self.assertEqual(data[10].index(734289), 0)
+        self.assertEqual(data[10].starts[0], 36000)
+        self.assertEqual(
+            (self.loader.header, self.loader.offset, self.loader.guard),
+            (expected_loader.header, expected_loader.offset,
+             expected_loader.guard)
+        )
+
+        self.write('1:00\n', mode='a')
+        data = self.loader.load(self.path, workers=4)
+        self.assertEqual(self.loader.tail_loads, 1)
+        i = data[11].index(datetime.date(2013, 9, 5).toordinal())
+        self.assertEqual(data[11].ends[i], 15 * 3600 + 51 * 60)
+
+    def write_shards(self):
+        """
+        Splits sample data into one file per month.
+
+        :return: list of written paths
+        """
+        shards = {}
+        with open(SAMPLE_DATA_CSV) as csvfile:
+            for line in csvfile:
+                month = line.split(',')[1][:7]
+                shards.setdefault(month, ['user_id,date,start,end\n'])
+                shards[month].append(line)
+        paths = []
+        for month, lines in sorted(shards.iteritems()):
+            path = os.path.join(self.tmpdir, month + '.csv')
+            with open(path, 'w') as csvfile:
+                csvfile.writelines(lines)
+            paths.append(path)
+        return paths
+
+    def test_shard_paths(self):
+        """
+        Test expanding DATA_CSV option into list of files.
+        """
+        paths = self.write_shards()
+        pattern = os.path.join(self.tmpdir, '*.csv')
+        self.assertFalse(loader.is_sharded(self.path))
+        self.assertTrue(loader.is_sharded(pattern))
+        self.assertTrue(loader.is_sharded([self.path]))
+        self.assertListEqual(loader.shard_paths(self.path), [self.path])
+        self.assertListEqual(loader.shard_paths(pattern), paths)
+        self.assertListEqual(
+            loader.shard_paths([paths[-1], pattern + '.missing', pattern]),
+            paths[-1:] + paths
+        )
+
+    def test_shards(self):
+        """
+        Test loading data split into many files.
+        """
+        paths = self.write_shards()
+        self.assertGreater(len(paths), 2)
+        expected = loader.CsvLoader().load(SAMPLE_DATA_CSV)
+        for workers in (1, 4):
+            shards_loader = loader.ShardedLoader()
+            data = shards_loader.load(paths, workers=workers)
+            self.assertItemsEqual(data.keys(), expected.keys())
+            for user_id in expected:
+                self.assertListEqual(list(data[user_id].rows()),
+                                     list(expected[user_id].rows()))
+                self.assertTupleEqual(data[user_id].stats.intervals,
+                                      expected[user_id].stats.intervals)
+                self.assertTupleEqual(
+                    data[user_id].prefix.totals(734300, 734400).counts,
+                    expected[user_id].prefix.totals(734300, 734400).counts
+                )
+            self.assertEqual(shards_loader.full_loads, len(paths))
+            self.assertEqual(shards_loader.parsed_rows,
+                             sum(len(p) for p in expected.itervalues()))
+        self.assertIs(shards_loader.load(paths), data)
+        self.assertEqual(data.version[-1],
+                         max(os.stat(path).st_mtime for path in paths))
+
+        # only the changed shard is read again
+        shards = dict(
+            (path, shards_loader.loaders[path].data) for path in paths
+        )
+        with open(paths[-1], 'a') as csvfile:
+            csvfile.write('99,2013-09-30,09:39:05,17:59:52\n')
+        data = shards_loader.load(paths)
+        self.assertIn(99, data)
+        self.assertEqual((shards_loader.full_loads, shards_loader.tail_loads),
+                         (len(paths), 1))
+        for path in paths[:-1]:
+            self.assertIs(shards_loader.loaders[path].data, shards[path])
+
+        # chronologically later shard wins, whatever the file names
+        self.write('10,2013-09-11,10:00:00,11:00:00\n'
+                   '10,2013-09-12,10:00:00,11:00:00\n')
+        earlier = os.path.join(self.tmpdir, 'earlier.txt')
+        with open(earlier, 'w') as csvfile:
+            csvfile.write('10,2013-09-10,09:00:00,17:00:00\n'
+                          '10,2013-09-11,09:00:00,17:00:00\n'
+                          '11,2013-09-11,09:00:00,17:00:00\n')
+        for shard_paths in ([self.path, earlier], [earlier, self.path]):
+            data = shards_loader.load(shard_paths)
+            self.assertListEqual(list(data[10].starts), [32400, 36000, 36000])
+            self.assertEqual(len(data[11]), 1)
+
+    def assert_merged(self, data, paths):
+        """
+        Checks that data equals data of given shards merged from scratch.
+        """
+        expected = loader.ShardedLoader().load(paths)
+        self.assertItemsEqual(data.keys(), expected.keys())
+        for user_id in expected:
+            self.assertListEqual(list(data[user_id].rows()),
+                                 list(expected[user_id].rows()))
+            self.assertTupleEqual(data[user_id].stats.intervals,
+                                  expected[user_id].stats.intervals)
+
+    def test_shards_pool(self):
+        """
+        Test that even a single rewritten shard is parsed by worker pool.
+        """
+        paths = self.write_shards()
+        shards_loader = loader.ShardedLoader()
+        shards_loader.load(paths, workers=4)
+        with open(paths[0]) as csvfile:
+            lines = csvfile.readlines()
+        with open(paths[0], 'w') as csvfile:
+            csvfile.writelines(lines[:-1])
+
+        parse_files = loader.parse_files
+        parsed = []
+
+        def record_files(files, workers):
+            """
+            Records paths of files parsed by worker processes.
+            """
+            parsed.append([path for path, _, _ in files])
+            return parse_files(files, workers)
+        loader.parse_files = record_files
+        try:
+            data = shards_loader.load(paths, workers=4)
+        finally:
+            loader.parse_files = parse_files
+        self.assertListEqual(parsed, [paths[:1]])
+        self.assert_merged(data, paths)
+
+    def test_shards_merge(self):
+        """
+        Test that only users whose data changed are merged again.
+        """
+        paths = self.write_shards()
+        shards_loader = loader.ShardedLoader()
+        before = shards_loader.load(paths)
+
+        # appended to the last shard: 10 is in every shard, 178 in the
+        # last one only, day of 11 is replaced
+        with open(paths[-1], 'a') as csvfile:
+            csvfile.write('10,2013-09-30,09:39:05,17:59:52\n'
+                          '11,2013-09-10,10:00:00,11:00:00\n'
+                          '178,2013-09-13,09:00:00,17:00:00\n')
+        data = shards_loader.load(paths)
+        self.assert_merged(data, paths)
+        self.assertEqual(shards_loader.tail_loads, 1)
+        for user_id in data:
+            if user_id not in (10, 11, 178):
+                self.assertIs(data[user_id], before[user_id])
+        self.assertIs(data[178], shards_loader.loaders[paths[-1]].data[178])
+
+        # rewritten earliest shard, users 12 and 13 removed from it
+        before = data
+        with open(paths[0]) as csvfile:
+            lines = [line for line in csvfile
+                     if line.split(',')[0] not in ('12', '13')]
+        with open(paths[0], 'w') as csvfile:
+            csvfile.writelines(lines)
+        data = shards_loader.load(paths)
+        self.assert_merged(data, paths)
+        for user_id in (28, 101, 178):
+            self.assertIs(data[user_id], before[user_id])
+
+        # removed shard
+        before = data
+        data = shards_loader.load(paths[1:])
+        self.assert_merged(data, paths[1:])
+        self.assertEqual(data[21].days[0],
+                         datetime.date(2011, 7, 1).toordinal())
+        self.assertIs(data[101], before[101])
+
+    def test_get_sharded_data(self):
+        """
+        Test that get_data loads DATA_CSV given as a glob pattern.
+        """
+        self.write_shards()
+        main.app.config.update({
+            'DATA_CSV': os.path.join(self.tmpdir, '*.csv'),
+            'USERS_XML': TEST_USERS_XML,
+        })
+        utils.get_data.cache_duration = -1
+        utils.get_data.cache_stale_while_revalidate = False
+        try:
+            data = utils.get_data()
+            self.assertItemsEqual(
+                data.keys(), loader.CsvLoader().load(SAMPLE_DATA_CSV).keys()
+            )
+            self.assertIs(utils.get_data_loader(), utils.SHARDS_LOADER)
+            resp = main.app.test_client().get('/api/v1/presence_weekday/10')
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+
+    def test_chunk_ranges(self):
+        """
+        Test splitting file on line boundaries.
+        """
+        self.write('a' * 10 + '\n' + 'b' * 10 + '\n' + 'c' * 10)
+        size = os.path.getsize(self.path)
+        min_chunk_size = parsing.MIN_CHUNK_SIZE
+        parsing.MIN_CHUNK_SIZE = 1
+        try:
+            with open(self.path, 'rb') as csvfile:
+                self.assertListEqual(parsing.chunk_ranges(csvfile, size, 3),
+                                     [(0, 11), (11, 22), (22, 32)])
+                self.assertListEqual(parsing.chunk_ranges(csvfile, size, 8),
+                                     [(0, 11), (11, 22), (22, 32)])
+                self.assertListEqual(parsing.chunk_ranges(csvfile, size, 1),
+                                     [(0, 32)])
+        finally:
+            parsing.MIN_CHUNK_SIZE = min_chunk_size
+
+
+class PresenceAnalyzerEngineTestCase(unittest.TestCase):
+    """
+    Aggregation engines tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': SAMPLE_DATA_CSV})
+        utils.get_data.cache_duration = -1
+        utils.get_data.cache_stale_while_revalidate = False
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.pop('PRESENCE_ENGINE', None)
+
+    @staticmethod
+    def totals(stats):
+        """
+        Returns weekday totals as comparable tuple.
+        """
+        return (stats.counts, stats.intervals, stats.starts, stats.ends)
+
+    def test_parity(self):
+        """
+        Test that numpy engine gives the same totals as pure Python one.
+        """
+        data = utils.get_data()
+        python = engine.aggregate_python(data)
+        numpy = engine.aggregate_numpy(data)
+        self.assertItemsEqual(python.keys(), numpy.keys())
+        for user_id in python:
+            self.assertEqual(
+                self.totals(python[user_id]),
+                self.totals(numpy[user_id])
+            )
+            self.assertListEqual(
+                python[user_id].mean_intervals(),
+                numpy[user_id].mean_intervals()
+            )
+        self.assertEqual(engine.aggregate_numpy({}), {})
+
+    def test_config(self):
+        """
+        Test selection of engine with PRESENCE_ENGINE option.
+        """
+        main.app.config.update({'PRESENCE_ENGINE': 'numpy'})
+        utils.DATA_LOADER.path = None
+        data = utils.get_data()
+        for presence in data.itervalues():
+            # pylint: disable=protected-access
+            self.assertIsNotNone(presence._stats)
+            # prefix sums are only built for date range queries
+            self.assertIsNone(presence._prefix)
+        self.assertEqual(
+            self.totals(data[10].stats),
+            self.totals(store.WeekdayStats(data[10].rows()))
+        )
+
+        self.assertRaises(ValueError, engine.aggregate, data, 'fortran')
+
+
+class PresenceAnalyzerSnapshotTestCase(unittest.TestCase):
+    """
+    Memory-mapped snapshot tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, 'data.csv')
+        self.path = os.path.join(self.tmpdir, 'data.snapshot')
+        shutil.copy(SAMPLE_DATA_CSV, self.csv_path)
+        main.app.config.update({'DATA_CSV': self.csv_path})
+        main.app.config.update({'USERS_XML': TEST_USERS_XML})
+        utils.get_data.cache_duration = -1
+        utils.get_data.cache_stale_while_revalidate = False
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.pop('DATA_SNAPSHOT', None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        """
+        Test that snapshot holds the same data as CSV file.
+        """
+        self.assertEqual(
+            snapshot.write_snapshot(self.csv_path, self.path),
+            len(utils.get_data())
+        )
+        header, data = snapshot.read_snapshot(self.path)
+        self.assertEqual(header[0], snapshot.MAGIC)
+        expected = loader.CsvLoader().load(self.csv_path)
+        self.assertItemsEqual(data.keys(), expected.keys())
+        for user_id, presence in expected.iteritems():
+            mapped = data[user_id]
+            self.assertIsInstance(mapped, snapshot.MappedUserPresence)
+            self.assertListEqual(list(mapped.rows()), list(presence.rows()))
+            self.assertListEqual(mapped.stats.mean_start_end(),
+                                 presence.stats.mean_start_end())
+            self.assertListEqual(mapped.stats.mean_intervals(),
+                                 presence.stats.mean_intervals())
+            self.assertEqual(mapped.days[-1], presence.days[-1])
+            self.assertEqual(mapped.days[1:3], list(presence.days[1:3]))
+            day = presence.days[len(presence) // 2]
+            self.assertEqual(mapped.index(day), presence.index(day))
+            self.assertEqual(mapped.index(day + 1000000), -1)
+
+    def test_get_data(self):
+        """
+        Test that get_data uses snapshot only while it matches CSV file.
+        """
+        main.app.config.update({'DATA_SNAPSHOT': self.path})
+        self.assertNotIsInstance(utils.get_data()[10],
+                                 snapshot.MappedUserPresence)
+
+        snapshot.write_snapshot(self.csv_path, self.path)
+        data = utils.get_data()
+        self.assertIsInstance(data[10], snapshot.MappedUserPresence)
+        resp = main.app.test_client().get('/api/v1/presence_start_end/10')
+        self.assertEqual(resp.status_code, 200)
+
+        # touched but unchanged file is recognized by checksum
+        os.utime(self.csv_path, (0, 0))
+        self.assertIsInstance(utils.get_data()[10],
+                              snapshot.MappedUserPresence)
+
+        with open(self.csv_path, 'a') as csvfile:
+            csvfile.write('99,2013-09-10,09:39:05,17:59:52\n')
+        # file of other size is not read through to compute its checksum
+        checksum = snapshot.checksum
+        snapshot.checksum = None
+        try:
+            data = utils.get_data()
+        finally:
+            snapshot.checksum = checksum
+        self.assertNotIsInstance(data[10], snapshot.MappedUserPresence)
+        self.assertIn(99, data)
+
+        with open(self.path, 'w') as snapshot_file:
+            snapshot_file.write('garbage')
+        self.assertIsNone(
+            snapshot.SnapshotLoader().load(self.path, self.csv_path)
+        )
+
+
+class PresenceAnalyzerLazyTestCase(unittest.TestCase):
+    """
+    On-demand loading tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, 'data.csv')
+        self.path = os.path.join(self.tmpdir, 'data.index')
+        shutil.copy(SAMPLE_DATA_CSV, self.csv_path)
+        main.app.config.update({'DATA_CSV': self.csv_path})
+        main.app.config.update({'USERS_XML': TEST_USERS_XML})
+        utils.get_data.cache_duration = -1
+        utils.get_data.cache_stale_while_revalidate = False
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        for option in ('DATA_LAZY', 'DATA_INDEX', 'DATA_LAZY_USERS'):
+            main.app.config.pop(option, None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_build_index(self):
+        """
+        Test finding runs of lines of every user.
+        """
+        csvfile = StringIO(
+            'user_id,date,start,end\n'
+            '10,2013-09-10,09:39:05,17:59:52\n'
+            '10,2013-09-11,09:19:52,16:07:37\n'
+            'garbage\n'
+            '11,2013-09-10,09:00:00,17:00:00\n'
+            '10,2013-09-12,10:48:46,17:23:51'
+        )
+        self.assertDictEqual(lazy.build_index(csvfile), {
+            10: [(23, 72), (127, 31)],
+            11: [(95, 32)],
+        })
+
+        with open(self.csv_path, 'rb') as csvfile:
+            runs = lazy.build_index(csvfile)
+        expected = loader.CsvLoader().load(self.csv_path)
+        self.assertItemsEqual(runs.keys(), expected.keys())
+        # sample data is grouped by user
+        self.assertTrue(all(len(user_runs) == 1
+                            for user_runs in runs.itervalues()))
+
+    def test_lazy_data(self):
+        """
+        Test parsing users on demand.
+        """
+        with open(self.csv_path, 'rb') as csvfile:
+            runs = lazy.build_index(csvfile)
+        data = lazy.LazyPresenceData(self.csv_path, runs, max_users=2)
+        expected = loader.CsvLoader().load(self.csv_path)
+        self.assertEqual(len(data), len(expected))
+        self.assertIn(10, data)
+        self.assertNotIn(1, data)
+        self.assertListEqual(data.loaded(), [])
+        with self.assertRaises(KeyError):
+            data[1]  # pylint: disable=pointless-statement
+
+        for user_id in sorted(expected)[:3]:
+            presence = data[user_id]
+            self.assertListEqual(list(presence.rows()),
+                                 list(expected[user_id].rows()))
+            self.assertListEqual(presence.stats.mean_intervals(),
+                                 expected[user_id].stats.mean_intervals())
+            self.assertIs(data[user_id], presence)
+        self.assertEqual(len(data.loaded()), 2)
+        self.assertEqual(data.user_loads, 3)
+        self.assertIn(sorted(expected)[0], data.keys())
+        self.assertIsNotNone(data[sorted(expected)[0]])
+        self.assertEqual(data.user_loads, 4)
+        self.assertGreater(data.nbytes(), 0)
+
+    def test_mangled_data(self):
+        """
+        Test that users with malformed rows only are unknown, as in eager
+        loading.
+        """
+        client = main.app.test_client()
+        main.app.config.update({'DATA_CSV': TEST_DATA_MANGLED_W_HEADER_CSV})
+        expected = {}
+        urls = ('/api/v1/mean_time_weekday/10',
+                '/api/v1/mean_time_weekday/11')
+        for url in urls:
+            resp = client.get(url)
+            expected[url] = (resp.status_code, resp.data)
+        keys = utils.get_data().keys()
+        self.assertListEqual(keys, [11])
+
+        main.app.config.update({'DATA_LAZY': True})
+        data = utils.get_data()
+        self.assertIsInstance(data, lazy.LazyPresenceData)
+        self.assertListEqual(data.keys(), keys)
+        self.assertNotIn(10, data)
+        utils.encode_response.cache_clear()
+        for url in urls:
+            resp = client.get(url)
+            self.assertEqual((resp.status_code, resp.data), expected[url])
+
+        # file changed since indexing, no rows of indexed user left
+        presence = lazy.LazyPresenceData(
+            TEST_DATA_MANGLED_W_HEADER_CSV, {10: [(9, 33)]}
+        )
+        with self.assertRaises(KeyError):
+            presence[10]  # pylint: disable=pointless-statement
+
+    def test_index_file(self):
+        """
+        Test storing index in sidecar file.
+        """
+        index_loader = lazy.IndexLoader()
+        data = index_loader.load(self.csv_path, self.path)
+        self.assertEqual((index_loader.index_builds,
+                          index_loader.index_loads), (1, 0))
+        self.assertIs(index_loader.load(self.csv_path, self.path), data)
+
+        index_loader = lazy.IndexLoader()
+        self.assertDictEqual(
+            index_loader.load(self.csv_path, self.path).runs, data.runs
+        )
+        self.assertEqual((index_loader.index_builds,
+                          index_loader.index_loads), (0, 1))
+
+        with open(self.csv_path, 'a') as csvfile:
+            csvfile.write('99,2013-09-10,09:39:05,17:59:52\n')
+        data = index_loader.load(self.csv_path, self.path)
+        self.assertIn(99, data)
+        self.assertEqual(index_loader.index_builds, 1)
+        self.assertEqual(lazy.read_index(self.path)[2], data.runs)
+
+        with open(self.path, 'w') as index_file:
+            index_file.write('garbage')
+        with self.assertRaises(lazy.IndexFileError):
+            lazy.read_index(self.path)
+        index_loader = lazy.IndexLoader()
+        self.assertIn(99, index_loader.load(self.csv_path, self.path))
+        self.assertEqual(index_loader.index_builds, 1)
+
+    def test_get_data(self):
+        """
+        Test that views answer from lazily loaded data.
+        """
+        client = main.app.test_client()
+        expected = {}
+        for url in ('/api/v1/users', '/api/v1/presence_weekday/10',
+                    '/api/v1/rollup/11?period=week'):
+            expected[url] = json.loads(client.get(url).data)
+
+        main.app.config.update({
+            'DATA_LAZY': True,
+            'DATA_INDEX': self.path,
+            'DATA_LAZY_USERS': 1,
+        })
+        data = utils.get_data()
+        self.assertIsInstance(data, lazy.LazyPresenceData)
+        self.assertTrue(os.path.exists(self.path))
+        utils.encode_response.cache_clear()
+        for url, result in expected.iteritems():
+            resp = client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(json.loads(resp.data), result)
+        self.assertEqual(len(data.loaded()), 1)
+        self.assertEqual(client.get('/api/v1/rollup/1').status_code, 404)
+        self.assertIn('presence_data_users',
+                      client.get('/api/v1/_metrics').data)
+
+
+class PresenceAnalyzerPreforkTestCase(unittest.TestCase):
+    """
+    Pre-forking server tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'USERS_XML': TEST_USERS_XML})
+        utils.get_data.cache_duration = -1
+        utils.get_data.cache_stale_while_revalidate = False
+        self.server = prefork.PreforkServer(
+            main.app, '127.0.0.1', 0, processes=2, max_requests=1,
+            preload=prefork.preload_data
+        )
+        self.address = self.server.bind()
+        self.pid = os.fork()
+        if not self.pid:
+            try:
+                self.server.serve_forever()
+            finally:
+                os._exit(0)  # pylint: disable=protected-access
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+        self.server.socket.close()
+
+    def test_serve(self):
+        """
+        Test requests served by recycled worker processes.
+        """
+        url = 'http://{0}:{1}/api/v1/users'.format(*self.address)
+        # every worker serves one request only, so later requests are
+        # handled by freshly forked workers
+        for _ in range(5):
+            resp = urllib2.urlopen(url, timeout=10)
+            self.assertEqual(resp.getcode(), 200)
+            data = json.loads(resp.read())
+            self.assertEqual(len(data), 2)
+
+    def test_restart(self):
+        """
+        Test graceful restart.
+        """
+        url = 'http://{0}:{1}/api/v1/users'.format(*self.address)
+        self.assertEqual(urllib2.urlopen(url, timeout=10).getcode(), 200)
+        os.kill(self.pid, signal.SIGHUP)
+        for _ in range(3):
+            resp = urllib2.urlopen(url, timeout=10)
+            self.assertEqual(resp.getcode(), 200)
+
+
+class PresenceAnalyzerMetricsTestCase(unittest.TestCase):
+    """
+    Metrics tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_MANGLED_W_HEADER_CSV, self.csv_path)
+        main.app.config.update({'DATA_CSV': self.csv_path})
+        main.app.config.update({'USERS_XML': TEST_USERS_XML})
+        utils.get_data.cache_duration = -1
+        utils.get_data.cache_stale_while_revalidate = False
+        utils.DATA_LOADER = loader.CsvLoader()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        utils.DATA_LOADER = loader.CsvLoader()
+        shutil.rmtree(self.tmpdir)
+
+    def scrape(self):
+        """
+        Returns {sample name with labels: value} from metrics endpoint.
+        """
+        resp = self.client.get('/api/v1/_metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        samples = {}
+        for line in resp.data.splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_metrics(self):
+        """
+        Test request, cache, ingest and data metrics.
+        """
+        before = self.scrape()
+        users = 'presence_requests_total{endpoint="users_view",' \
+            'method="GET",status="200"}'
+        self.client.get('/api/v1/users')
+        self.client.get('/api/v1/users')
+        self.client.get('/api/v1/presence_weekday/9000')
+        samples = self.scrape()
+
+        self.assertEqual(samples[users] - before.get(users, 0), 2)
+        self.assertIn(
+            'presence_requests_total{endpoint="presence_weekday_view",'
+            'method="GET",status="404"}', samples
+        )
+        count = 'presence_request_duration_seconds_count' \
+            '{endpoint="users_view"}'
+        self.assertEqual(
+            samples[count],
+            samples['presence_request_duration_seconds_bucket'
+                    '{endpoint="users_view",le="+Inf"}']
+        )
+        self.assertGreater(samples[count], 1)
+        for function in ('get_data', 'encode_response'):
+            self.assertIn(
+                'presence_cache_misses_total{{function="{0}"}}'.format(
+                    function
+                ), samples
+            )
+        self.assertEqual(samples['presence_ingest_rows_total'], 1)
+        self.assertEqual(samples['presence_ingest_rejected_lines_total'], 1)
+        self.assertEqual(samples['presence_ingest_loads_total{kind="full"}'],
+                         1)
+        self.assertGreater(samples['presence_ingest_seconds_total'], 0)
+        self.assertEqual(samples['presence_data_users'], 1)
+        self.assertEqual(samples['presence_data_rows'], 1)
+        self.assertGreater(samples['presence_data_bytes'], 0)
+
+    def test_histogram(self):
+        """
+        Test latency histogram buckets.
+        """
+        histogram = metrics.Histogram((0.1, 1.0))
+        histogram.observe('a', 0.05)
+        histogram.observe('a', 0.5)
+        histogram.observe('a', 5)
+        self.assertDictEqual(histogram.snapshot(), {'a': ([1, 2, 3], 5.55)})
+        self.assertEqual(metrics.labels(name='a"b\n'), '{name="a\\"b\\n"}')
+
+
+class PresenceAnalyzerProfilingTestCase(unittest.TestCase):
+    """
+    Request profiler and slow request log tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.profile_dir = os.path.join(self.tmpdir, 'profiles')
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'USERS_XML': TEST_USERS_XML,
+            'PROFILE_ENABLED': True,
+            'PROFILE_DIR': self.profile_dir,
+        })
+        utils.get_data.cache_duration = -1
+        utils.get_data.cache_stale_while_revalidate = False
+        self.client = main.app.test_client()
+
+        self.records = []
+        self.handler = logging.Handler()
+        self.handler.emit = self.records.append
+        profiling.log.addHandler(self.handler)
+        self.level = profiling.log.level
+        profiling.log.setLevel(logging.INFO)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        for name in ('PROFILE_ENABLED', 'PROFILE_DIR',
+                     'SLOW_REQUEST_THRESHOLD'):
+            main.app.config.pop(name, None)
+        profiling.log.removeHandler(self.handler)
+        profiling.log.setLevel(self.level)
+        shutil.rmtree(self.tmpdir)
+
+    def test_profile(self):
+        """
+        Test profiles written for requests asking for it.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertNotIn('X-Profile-File', resp.headers)
+        self.assertFalse(os.path.exists(self.profile_dir))
+
+        resp = self.client.get('/api/v1/presence_weekday/10',
+                               headers={'X-Profile': '1'})
+        self.assertEqual(resp.status_code, 200)
+        resp = self.client.get('/api/v1/presence_weekday/11?_profile=1')
+        self.assertEqual(resp.status_code, 200)
+        names = sorted(os.listdir(self.profile_dir))
+        self.assertEqual(len(names), 2)
+        self.assertIn(resp.headers['X-Profile-File'], names)
+        self.assertTrue(names[0].startswith('presence_weekday_view-'))
+        stats = pstats.Stats(os.path.join(self.profile_dir, names[0]))
+        self.assertGreater(stats.total_calls, 0)
+
+        main.app.config['PROFILE_ENABLED'] = False
+        resp = self.client.get('/api/v1/presence_weekday/10?_profile=1')
+        self.assertNotIn('X-Profile-File', resp.headers)
+        self.assertEqual(len(os.listdir(self.profile_dir)), 2)
+
+    def test_profile_error(self):
+        """
+        Test profiler stopped when profiled request fails.
+        """
+        main.app.config.update({'DATA_CSV': self.tmpdir})
+        resp = self.client.get('/api/v1/presence_weekday/10?_profile=1')
+        self.assertEqual(resp.status_code, 500)
+        self.assertIsNone(sys.getprofile())
+        self.assertEqual(len(os.listdir(self.profile_dir)), 1)
+
+    def test_slow_request_log(self):
+        """
+        Test logging of slow requests.
+        """
+        self.client.get('/api/v1/presence_weekday/10')
+        self.assertListEqual(
+            [r for r in self.records if r.levelno == logging.WARNING], []
+        )
+
+        main.app.config['SLOW_REQUEST_THRESHOLD'] = 1e-9
+        utils.encode_response.cache_clear()
+        self.client.get('/api/v1/presence_weekday/10?from=2013-09-11')
+        slow = [r for r in self.records if r.levelno == logging.WARNING]
+        self.assertEqual(len(slow), 1)
+        message = slow[0].getMessage()
+        self.assertIn('/api/v1/presence_weekday/<int:user_id>', message)
+        self.assertIn("'user_id': 10", message)
+        self.assertIn("'from': u'2013-09-11'", message)
+        for phase in profiling.PHASES:
+            self.assertIn(phase + ' ', message)
+
+        main.app.config['SLOW_REQUEST_THRESHOLD'] = 0
+        self.client.get('/api/v1/presence_weekday/11')
+        self.assertEqual(
+            len([r for r in self.records if r.levelno == logging.WARNING]),
+            1
+        )
+
+
+class PresenceAnalyzerWarmupTestCase(unittest.TestCase):
+    """
+    Warm-up and background refresh tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.csv_path)
+        main.app.config.update({'DATA_CSV': self.csv_path})
+        main.app.config.update({'USERS_XML': TEST_USERS_XML})
+        utils.get_data.cache_duration = -1
+        utils.get_data.cache_stale_while_revalidate = False
+        utils.get_data.cache_invalidate()
+        utils.encode_response.cache_clear()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        warmup.stop_refresher()
+        main.app.config.pop('REFRESH_INTERVAL', None)
+        main.app.config.pop('WATCH_FILES', None)
+        main.app.config.pop('WATCH_DEBOUNCE', None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_warm_up(self):
+        """
+        Test loading data and priming response cache.
+        """
+        warmup.warm_up()
+        self.assertItemsEqual(utils.get_data.cache_peek().keys(), [10, 11])
+        self.assertEqual(utils.encode_response.cache_info()['entries'], 1)
+
+        misses = utils.encode_response.cache_info()['misses']
+        resp = self.client.get('/api/v1/users')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(utils.encode_response.cache_info()['misses'],
+                         misses)
+
+        utils.get_data.cache_duration = 600
+        refreshes = utils.get_data.cache_info()['refreshes']
+        warmup.warm_up()
+        self.assertEqual(utils.get_data.cache_info()['refreshes'],
+                         refreshes)
+        warmup.warm_up(reload_data=True)
+        self.assertEqual(utils.get_data.cache_info()['refreshes'],
+                         refreshes + 1)
+
+    def test_warm_up_missing_files(self):
+        """
+        Test that warm-up logs data files it cannot read and goes on.
+        """
+        main.app.config.update({
+            'USERS_XML': os.path.join(self.tmpdir, 'missing.xml'),
+        })
+        warmup.warm_up()
+        self.assertItemsEqual(utils.get_data.cache_peek().keys(), [10, 11])
+        self.assertEqual(utils.encode_response.cache_info()['entries'], 0)
+
+        main.app.config.update({
+            'DATA_CSV': os.path.join(self.tmpdir, 'missing.csv'),
+        })
+        warmup.warm_up(reload_data=True)
+
+    def test_refresher(self):
+        """
+        Test background refresh of data files.
+        """
+        self.client.get('/api/v1/users')
+        self.assertIsNone(warmup.REFRESHER['thread'])
+        self.assertFalse(utils.BACKGROUND_REFRESH.is_set())
+
+        main.app.config['REFRESH_INTERVAL'] = 0.01
+        self.client.get('/api/v1/users')
+        thread = warmup.REFRESHER['thread']
+        self.assertTrue(thread.is_alive())
+        self.client.get('/api/v1/users')
+        self.assertIs(warmup.REFRESHER['thread'], thread)
+
+        with open(self.csv_path, 'a') as csvfile:
+            # last line of test data has no line terminator
+            csvfile.write('\n12,2013-09-10,09:39:05,17:59:52\n')
+        for _ in range(200):
+            if 12 in utils.get_data.cache_peek():
+                break
+            time.sleep(0.01)
+        self.assertIn(12, utils.get_data.cache_peek())
+        self.assertTrue(utils.BACKGROUND_REFRESH.is_set())
+        self.assertIs(utils.get_user_data(), utils.USERS_LOADER.data)
+
+        warmup.stop_refresher()
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(utils.BACKGROUND_REFRESH.is_set())
+
+    def test_watch_files(self):
+        """
+        Test reloading data files when they change.
+        """
+        utils.get_data.cache_duration = 600
+        main.app.config['WATCH_FILES'] = True
+        main.app.config['WATCH_DEBOUNCE'] = 0.05
+        self.client.get('/api/v1/users')
+        thread = warmup.REFRESHER['thread']
+        self.assertIsInstance(thread, watcher.Watcher)
+        self.assertTrue(utils.BACKGROUND_REFRESH.is_set())
+        refreshes = utils.get_data.cache_info()['refreshes']
+
+        with open(self.csv_path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-10,09:39:05,17:59:52\n')
+        for _ in range(300):
+            if 12 in utils.get_data.cache_peek():
+                break
+            time.sleep(0.01)
+        self.assertIn(12, utils.get_data.cache_peek())
+        self.assertEqual(utils.get_data.cache_info()['refreshes'],
+                         refreshes + 1)
+        resp = self.client.get('/api/v1/users')
+        self.assertIn(12, [user['user_id'] for user in json.loads(resp.data)])
+
+        warmup.stop_refresher()
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(utils.BACKGROUND_REFRESH.is_set())
+
+
+class PresenceAnalyzerWatcherTestCase(unittest.TestCase):
+    """
+    Data files watcher tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        with open(self.path, 'w') as csvfile:
+            csvfile.write('user_id,date,start,end\n')
+        self.calls = []
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def wait_for_calls(self, count):
+        """
+        Waits a while for callback to be called count times.
+        """
+        for _ in range(300):
+            if len(self.calls) >= count:
+                break
+            time.sleep(0.01)
+
+    def check_source(self, source):
+        """
+        Checks that source reports changes of watched file only.
+        """
+        try:
+            self.assertFalse(source.wait(0.01))
+            with open(os.path.join(self.tmpdir, 'other.csv'), 'w') as other:
+                other.write('other')
+            self.assertFalse(source.wait(0.01))
+            with open(self.path, 'a') as csvfile:
+                csvfile.write('10,2013-09-10,09:39:05,17:59:52\n')
+            self.assertTrue(source.wait(0.01))
+            self.assertFalse(source.wait(0.01))
+
+            # replacing file by rename
+            new_path = self.path + '.new'
+            shutil.copy(self.path, new_path)
+            os.rename(new_path, self.path)
+            self.assertTrue(source.wait(0.01))
+        finally:
+            source.close()
+
+    def test_polling_source(self):
+        """
+        Test detecting changes by polling.
+        """
+        self.check_source(watcher.PollingSource([self.path]))
+
+    def test_inotify_source(self):
+        """
+        Test detecting changes with inotify.
+        """
+        try:
+            source = watcher.InotifySource([self.path])
+        except OSError:
+            self.skipTest('inotify not available')
+        self.check_source(source)
+
+    def test_glob(self):
+        """
+        Test watching files matching glob pattern.
+        """
+        pattern = os.path.join(self.tmpdir, '*.csv')
+        factories = [watcher.PollingSource, watcher.InotifySource]
+        for i, factory in enumerate(factories):
+            try:
+                source = factory([pattern])
+            except OSError:
+                continue
+            try:
+                other = os.path.join(self.tmpdir, 'other.txt')
+                with open(other, 'w') as other_file:
+                    other_file.write('other')
+                self.assertFalse(source.wait(0.01))
+                path = os.path.join(self.tmpdir, '{0}.csv'.format(i))
+                with open(path, 'w') as csvfile:
+                    csvfile.write('user_id,date,start,end\n')
+                self.assertTrue(source.wait(0.01))
+            finally:
+                source.close()
+
+    def test_debounce(self):
+        """
+        Test calling callback once after series of writes.
+        """
+        for use_inotify in (True, False):
+            del self.calls[:]
+            thread = watcher.Watcher(
+                [self.path], lambda: self.calls.append(True),
+                debounce=0.2, poll_interval=0.01, use_inotify=use_inotify
+            )
+            thread.start()
+            try:
+                time.sleep(0.05)
+                for _ in range(5):
+                    with open(self.path, 'a') as csvfile:
+                        csvfile.write('10,2013-09-10,09:39:05,17:59:52\n')
+                    time.sleep(0.02)
+                self.wait_for_calls(1)
+                time.sleep(0.3)
+                self.assertEqual(len(self.calls), 1)
+            finally:
+                thread.stop()
+            self.assertFalse(thread.is_alive())
+
+    def test_callback_error(self):
+        """
+        Test that failing callback does not stop watching.
+        """
+        def callback():
+            """
+            Fails on the first call.
+            """
+            self.calls.append(True)
+            if len(self.calls) == 1:
+                raise ValueError('broken')
+
+        thread = watcher.Watcher([self.path], callback, debounce=0.01,
+                                 poll_interval=0.01)
+        thread.start()
+        try:
+            for count in (1, 2):
+                time.sleep(0.05)
+                with open(self.path, 'a') as csvfile:
+                    csvfile.write('10,2013-09-10,09:39:05,17:59:52\n')
+                self.wait_for_calls(count)
+                self.assertEqual(len(self.calls), count)
+        finally:
+            thread.stop()
+
+
+class PresenceAnalyzerBenchmarkTestCase(unittest.TestCase):
+    """
+    Benchmark data generator and harness tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, 'data.csv')
+        self.xml_path = os.path.join(self.tmpdir, 'users.xml')
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.pop('DATA_WORKERS', None)
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        harness.reset_loaders()
+        shutil.rmtree(self.tmpdir)
+
+    def test_generator(self):
+        """
+        Test generated data and users files.
+        """
+        generator.main([self.csv_path, self.xml_path, '--rows', '2000',
+                        '--users', '20', '--mangled', '0.05'])
+        with open(self.csv_path) as csvfile:
+            lines = csvfile.readlines()
+        builder = store.PresenceBuilder()
+        parsed, rejected = parsing.parse_lines(lines, builder)
+        self.assertEqual(parsed, 2000)
+        self.assertGreater(rejected, 1)
+        # header, footers and rejected lines
+        self.assertGreater(len(lines), 1 + parsed + rejected)
+        self.assertEqual(len(builder.build()), 20)
+
+        with open(self.xml_path) as xmlfile:
+            users = loader.parse_users(xmlfile)
+        self.assertItemsEqual(users.keys(), range(1, 21))
+        self.assertEqual(users[1]['avatar'],
+                         'http://example.com:80/api/images/users/1')
+
+        # equal seeds give equal files
+        other = os.path.join(self.tmpdir, 'other.csv')
+        generator.generate_data(other, 2000, 20, 0.05)
+        with open(other) as csvfile:
+            self.assertListEqual(csvfile.readlines(), lines)
+
+    def test_harness(self):
+        """
+        Test benchmark results.
+        """
+        generator.generate_data(self.csv_path, 500, 5)
+        generator.generate_users(self.xml_path, 5)
+        output = os.path.join(self.tmpdir, 'results.json')
+        harness.main([self.csv_path, self.xml_path, '--repeat', '2',
+                      '--output', output])
+        with open(output) as results_file:
+            results = json.load(results_file)
+        self.assertEqual(results['input']['rows'], 500)
+        self.assertEqual(results['input']['users'], 5)
+        self.assertGreater(results['memory']['data_bytes'], 0)
+        for name in ['load_cold', 'load_cached', 'api_users_cold',
+                     'api_rollup_week_warm', 'api_export_rows_cold']:
+            self.assertEqual(results['timings'][name]['runs'], 2)
+            self.assertLessEqual(results['timings'][name]['min'],
+                                 results['timings'][name]['max'])
+
+    def test_harness_shards(self):
+        """
+        Test benchmark of data split into many files.
+        """
+        paths = []
+        for month in range(1, 3):
+            path = os.path.join(self.tmpdir, '2013-0{0}.csv'.format(month))
+            generator.generate_data(path, 500, 5, seed=month)
+            paths.append(path)
+        generator.generate_users(self.xml_path, 5)
+        pattern = os.path.join(self.tmpdir, '*.csv')
+        results = harness.run(pattern, self.xml_path, repeat=2)
+        self.assertEqual(results['input']['data_csv'], pattern)
+        self.assertListEqual(results['input']['data_csv_files'], paths)
+        self.assertEqual(results['input']['data_csv_bytes'],
+                         sum(os.path.getsize(path) for path in paths))
+        # cold loads parse the files, not just check them
+        self.assertGreater(results['timings']['load_cold']['min'],
+                           results['timings']['load_unchanged']['max'])
+
 
 def suite():
     """
@@ -227,6 +2278,18 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStoreTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerParsingTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerLoaderTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerEngineTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerSnapshotTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerLazyTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerPreforkTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerMetricsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerProfilingTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerWarmupTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerWatcherTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerBenchmarkTestCase))
     return base_suite
 
 
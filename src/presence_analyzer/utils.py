@@ -3,29 +3,98 @@
 Helper functions used in views.
 """
 
-import csv
-from lxml import etree
-from json import dumps
-from functools import wraps
+import sys
+from collections import OrderedDict
 from datetime import datetime
-from threading import Lock
+from hashlib import sha1
+from gzip import GzipFile
+from cStringIO import StringIO
+from json import dumps
+from functools import partial, wraps
+from threading import Event, Lock, Thread
 from copy import deepcopy
 from time import time
 
-from flask import Response
+from flask import Response, request
 
 from presence_analyzer.main import app
+from presence_analyzer.engine import DEFAULT_ENGINE
+from presence_analyzer.lazy import DEFAULT_MAX_USERS, IndexLoader
+from presence_analyzer.loader import CsvLoader, ShardedLoader, XmlLoader, \
+    is_sharded, shard_paths
+from presence_analyzer.profiling import timed
+from presence_analyzer.snapshot import SnapshotLoader
+from presence_analyzer.store import time_to_seconds, weekday
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
+DATA_LOADER = CsvLoader()
+SHARDS_LOADER = ShardedLoader()
+USERS_LOADER = XmlLoader()
+SNAPSHOT_LOADER = SnapshotLoader()
+INDEX_LOADER = IndexLoader()
+# every function decorated with cache(), see presence_analyzer.metrics
+CACHED = []
+# set while presence_analyzer.warmup.Refresher keeps data files loaded
+BACKGROUND_REFRESH = Event()
+
+
+def approximate_size(obj, seen=None):
+    """
+    Approximates amount of memory held by object, in bytes.
+
+    Builtin containers are followed recursively, objects providing
+    nbytes() method (like UserPresence) report their own size.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    nbytes = getattr(obj, 'nbytes', None)
+    if callable(nbytes):
+        return nbytes()
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(
+            approximate_size(key, seen) + approximate_size(value, seen)
+            for key, value in obj.iteritems()
+        )
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approximate_size(item, seen) for item in obj)
+    return size
+
 
-def cache(duration=600, copy=False):
+# pylint: disable=too-many-arguments, too-many-statements, too-many-locals
+def cache(duration=600, copy=False, stale_while_revalidate=False,
+          max_entries=None, max_bytes=None):
     """
     Cache decorator
     :param duration: cache timeout in seconds
-    :param copy: should only deepcopies of function output be returned
+    :param copy: should only deepcopies of function output be returned;
+        read-only presence data (see presence_analyzer.store) is its own
+        deep copy, so it is shared without copying anyway
+    :param stale_while_revalidate: should expired value be returned while
+        it is recomputed in a background thread
+    :param max_entries: maximum number of cached values
+    :param max_bytes: approximate memory budget of cached values
     :return: cache decorator
+
+    Every call signature has its own lock, so only one caller recomputes
+    given value while others wait for it (or get the stale value) and
+    calls with other arguments are not blocked. Counters of hits, misses,
+    stale values served, refreshes and evictions are kept in cache_stats
+    attribute of cached function.
+
+    When cache exceeds max_entries or max_bytes least recently used
+    values are evicted. Expired values are purged whenever a new value is
+    stored, unless they can still be served stale. Use cache_invalidate()
+    and cache_clear() attributes to drop one or all values, cache_info()
+    to inspect cache size, cache_peek() to get cached value without
+    computing it and cache_refresh() to recompute it ahead of expiry.
+    Cached functions are listed in CACHED.
     """
     def cache_decorator(func):
         """
@@ -33,88 +102,412 @@ def cache(duration=600, copy=False):
         :return: cached function
         """
 
+        def count(name, value=1):
+            """
+            Increments cache statistics counter.
+            """
+            with cached_func.cache_lock:
+                cached_func.cache_stats[name] += value
+
+        def key_lock(call_signature):
+            """
+            Returns lock guarding recomputation of given call signature.
+            """
+            with cached_func.cache_lock:
+                return cached_func.cache_key_locks.setdefault(
+                    call_signature, Lock()
+                )
+
+        def is_fresh(hit):
+            """
+            Checks whether cache entry has not expired yet.
+            """
+            return hit is not None and \
+                hit[1] >= time()-cached_func.cache_duration
+
+        def is_bounded():
+            """
+            Checks whether cache needs LRU bookkeeping.
+            """
+            return cached_func.cache_max_entries is not None or \
+                cached_func.cache_max_bytes is not None
+
+        def lookup(call_signature):
+            """
+            Returns cache entry and marks it as most recently used.
+            """
+            if not is_bounded():
+                return cached_func.cache.get(call_signature, None)
+            with cached_func.cache_lock:
+                hit = cached_func.cache.pop(call_signature, None)
+                if hit is not None:
+                    cached_func.cache[call_signature] = hit
+                return hit
+
+        def forget(call_signature):
+            """
+            Removes cache entry. Must be called with cache lock held.
+            """
+            hit = cached_func.cache.pop(call_signature)
+            cached_func.cache_bytes -= hit[2]
+            lock = cached_func.cache_key_locks.get(call_signature)
+            if lock is not None and not lock.locked():
+                del cached_func.cache_key_locks[call_signature]
+
+        def store(call_signature, ret, timestamp):
+            """
+            Stores value in cache, purging expired and evicting old values.
+            """
+            size = 0
+            if cached_func.cache_max_bytes is not None:
+                size = approximate_size(ret)
+            with cached_func.cache_lock:
+                entries = cached_func.cache
+                if call_signature in entries:
+                    forget(call_signature)
+                entries[call_signature] = (ret, timestamp, size)
+                cached_func.cache_bytes += size
+
+                if not cached_func.cache_stale_while_revalidate:
+                    expired = [
+                        key for key, hit in entries.iteritems()
+                        if not is_fresh(hit) and key != call_signature
+                    ]
+                    for key in expired:
+                        forget(key)
+                    cached_func.cache_stats['expired'] += len(expired)
+
+                max_entries = cached_func.cache_max_entries
+                max_bytes = cached_func.cache_max_bytes
+                while len(entries) > 1 and (
+                        max_entries is not None and
+                        len(entries) > max_entries or
+                        max_bytes is not None and
+                        cached_func.cache_bytes > max_bytes):
+                    forget(next(iter(entries)))
+                    cached_func.cache_stats['evictions'] += 1
+
+        def refresh(call_signature, args, kwargs):
+            """
+            Computes value and stores it in cache.
+
+            Must be called with call signature lock held.
+            """
+            started = time()
+            ret = func(*args, **kwargs)
+            finished = time()
+            store(call_signature, ret, finished)
+            with cached_func.cache_lock:
+                stats = cached_func.cache_stats
+                stats['refreshes'] += 1
+                stats['refresh_time'] += finished - started
+                stats['last_refresh_time'] = finished - started
+            return ret
+
+        def refresh_in_background(call_signature, lock, args, kwargs):
+            """
+            Refreshes value and releases call signature lock afterwards.
+            """
+            try:
+                refresh(call_signature, args, kwargs)
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Refreshing %s failed', func.__name__)
+            finally:
+                lock.release()
+
+        @wraps(func)
         def cached_func(*args, **kwargs):
             """
             Cached function.
             """
             call_signature = (func.__name__, args, frozenset(kwargs.items()))
-            with cached_func.cache_lock:
-                hit = cached_func.cache.get(call_signature, None)
-                if hit is None or hit[1] < time()-cached_func.cache_duration:
-                    ret = func(*args, **kwargs)
-                    cached_func.cache[call_signature] = (ret, time())
-                else:
-                    ret = hit[0]
-
-                if cached_func.cache_copy is True:
-                    ret = deepcopy(ret)
+            hit = lookup(call_signature)
+            if is_fresh(hit):
+                count('hits')
+                ret = hit[0]
+            elif hit is not None and cached_func.cache_stale_while_revalidate:
+                lock = key_lock(call_signature)
+                if lock.acquire(False):
+                    thread = Thread(
+                        target=refresh_in_background,
+                        args=(call_signature, lock, args, kwargs),
+                    )
+                    thread.daemon = True
+                    thread.start()
+                count('stale')
+                ret = hit[0]
+            else:
+                with key_lock(call_signature):
+                    # somebody could have refreshed it while we waited
+                    hit = lookup(call_signature)
+                    if is_fresh(hit):
+                        count('hits')
+                        ret = hit[0]
+                    else:
+                        count('misses')
+                        ret = refresh(call_signature, args, kwargs)
+
+            if cached_func.cache_copy is True:
+                ret = deepcopy(ret)
             return ret
 
-        cached_func.cache = dict()
+        def cache_invalidate(*args, **kwargs):
+            """
+            Drops cached value of given call arguments.
+            """
+            call_signature = (func.__name__, args, frozenset(kwargs.items()))
+            with cached_func.cache_lock:
+                if call_signature in cached_func.cache:
+                    forget(call_signature)
+
+        def cache_clear():
+            """
+            Drops all cached values.
+            """
+            with cached_func.cache_lock:
+                for call_signature in list(cached_func.cache):
+                    forget(call_signature)
+
+        def cache_refresh(*args, **kwargs):
+            """
+            Recomputes value of given call arguments and stores it.
+
+            Current value, if any, is served to other callers until the
+            new one is ready.
+            """
+            call_signature = (func.__name__, args, frozenset(kwargs.items()))
+            with key_lock(call_signature):
+                return refresh(call_signature, args, kwargs)
+
+        def cache_peek(*args, **kwargs):
+            """
+            Returns cached value of given call arguments, even expired,
+            or None. Does not compute value nor count as cache hit.
+            """
+            call_signature = (func.__name__, args, frozenset(kwargs.items()))
+            hit = cached_func.cache.get(call_signature)
+            return hit[0] if hit is not None else None
+
+        def cache_info():
+            """
+            Returns current size, limits and statistics of cache.
+            """
+            with cached_func.cache_lock:
+                info = dict(cached_func.cache_stats)
+                info.update({
+                    'entries': len(cached_func.cache),
+                    'bytes': cached_func.cache_bytes,
+                    'max_entries': cached_func.cache_max_entries,
+                    'max_bytes': cached_func.cache_max_bytes,
+                })
+            return info
+
+        cached_func.cache = OrderedDict()
         cached_func.cache_lock = Lock()
+        cached_func.cache_key_locks = dict()
         cached_func.cache_copy = copy
         cached_func.cache_duration = duration
+        cached_func.cache_stale_while_revalidate = stale_while_revalidate
+        cached_func.cache_max_entries = max_entries
+        cached_func.cache_max_bytes = max_bytes
+        cached_func.cache_bytes = 0
+        cached_func.cache_stats = {
+            'hits': 0,
+            'misses': 0,
+            'stale': 0,
+            'refreshes': 0,
+            'refresh_time': 0.0,
+            'last_refresh_time': 0.0,
+            'evictions': 0,
+            'expired': 0,
+        }
+        cached_func.cache_invalidate = cache_invalidate
+        cached_func.cache_clear = cache_clear
+        cached_func.cache_info = cache_info
+        cached_func.cache_peek = cache_peek
+        cached_func.cache_refresh = cache_refresh
+        CACHED.append(cached_func)
 
         return cached_func
 
     return cache_decorator
 
 
-def jsonify(function):
+def data_version():
+    """
+    Returns (version, last modification time) of data behind API responses.
+
+    Version identifies loaded presence data and USERS_XML file, it changes
+    whenever any of them does. Last modification time is a naive UTC
+    datetime with seconds precision.
+    """
+    data = get_data()
+    users = get_user_data()
+    version = (data.version, users.version)
+    mtimes = [
+        source[-1] for source in version if source is not None
+    ]
+    return version, datetime.utcfromtimestamp(int(max(mtimes or [0])))
+
+
+def is_not_modified(etag, last_modified):
+    """
+    Checks conditional headers of current request.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def gzip_compress(body):
+    """
+    Compresses string with gzip. Output depends on input only.
+    """
+    buf = StringIO()
+    with GzipFile(fileobj=buf, mode='wb', mtime=0) as gzfile:
+        gzfile.write(body)
+    return buf.getvalue()
+
+
+@cache(duration=24*3600, max_entries=512, max_bytes=32*1024*1024)
+def encode_response(etag, function, args, kwargs):
+    """
+    Serializes function result to JSON and compresses it.
+
+    Cached by ETag, which covers data version and request URL, so repeated
+    requests for unchanged data are served from memory. jsonify() clears
+    the cache whenever data version changes.
+    :param kwargs: keyword arguments as tuple of items
+    :return: (JSON body, gzipped JSON body) tuple
+    """
+    # pylint: disable=unused-argument
+    with timed('aggregation'):
+        result = function(*args, **dict(kwargs))
+    with timed('serialization'):
+        body = dumps(result)
+        return body, gzip_compress(body)
+encode_response.data_version = None
+
+
+def jsonify(function=None, validate=None):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    Responses carry ETag and Last-Modified headers derived from data
+    version and request URL. Conditional requests for unchanged data get
+    304 Not Modified without calling wrapped function. Encoded responses
+    are cached until data changes and served gzipped to clients which
+    accept it.
+
+    Used as @jsonify or @jsonify(validate=...).
+    :param validate: function called with the same arguments before the
+        conditional request check, aborting requests with invalid
+        arguments or for missing resources, so they never get 304
     """
+    if function is None:
+        return partial(jsonify, validate=validate)
+
     @wraps(function)
     def inner(*args, **kwargs):
         """
         This docstring will be overridden by @wraps decorator.
         """
-        return Response(
-            dumps(function(*args, **kwargs)),
-            mimetype='application/json'
-        )
+        with timed('load'):
+            version, last_modified = data_version()
+        if version != encode_response.data_version:
+            encode_response.cache_clear()
+            encode_response.data_version = version
+        if validate is not None:
+            validate(*args, **kwargs)
+
+        key = sha1(repr((version, request.full_path))).hexdigest()
+        gzipped = request.accept_encodings['gzip'] > 0
+        # gzipped variant is a different representation, so needs its own
+        # strong ETag
+        etag = key + '-gzip' if gzipped else key
+        if is_not_modified(etag, last_modified):
+            response = Response(status=304)
+        else:
+            body, compressed = encode_response(
+                key, function, args, tuple(sorted(kwargs.items()))
+            )
+            response = Response(
+                compressed if gzipped else body,
+                mimetype='application/json'
+            )
+            if gzipped:
+                response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return response
     return inner
 
 
-@cache(600)
+@cache(600, stale_while_revalidate=True)
 def get_data():
     """
     Extracts presence data from CSV file and groups it by user_id.
 
     It creates structure like this:
     data = {
-        'user_id': {
-            datetime.date(2013, 10, 1): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(17, 30, 0),
-            },
-            datetime.date(2013, 10, 2): {
-                'start': datetime.time(8, 30, 0),
-                'end': datetime.time(16, 45, 0),
-            },
-        }
+        'user_id': UserPresence(
+            days=array('i', [734999, 735000]),
+            starts=array('i', [32400, 30600]),
+            ends=array('i', [63000, 60300]),
+        ),
     }
-    """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
+    See presence_analyzer.store for details of UserPresence. Only lines
+    appended to the file since previous call are parsed, see
+    presence_analyzer.loader.CsvLoader. Weekday totals are computed with
+    engine selected by PRESENCE_ENGINE option. Whole file is parsed by
+    DATA_WORKERS processes, one (no worker processes) by default.
+
+    When DATA_SNAPSHOT option is set and the snapshot file matches the CSV
+    file, data is read from memory-mapped snapshot instead (see
+    presence_analyzer.snapshot).
+
+    With DATA_LAZY option set, only an index of users' lines is built (or
+    read from DATA_INDEX file) and users are parsed when asked for, at
+    most DATA_LAZY_USERS of them kept in memory (see
+    presence_analyzer.lazy).
+
+    DATA_CSV may also be a glob pattern or a list of files, like monthly
+    exports. Every file is then loaded and cached on its own, files
+    parsed from scratch concurrently when DATA_WORKERS is more than one,
+    and their data is merged (see presence_analyzer.loader.ShardedLoader);
+    snapshot and lazy loading apply to a single file only.
+    """
+    data_csv = app.config['DATA_CSV']
+    engine = app.config.get('PRESENCE_ENGINE', DEFAULT_ENGINE)
+    workers = app.config.get('DATA_WORKERS', 1)
+    if is_sharded(data_csv):
+        return SHARDS_LOADER.load(shard_paths(data_csv), engine, workers)
+    snapshot = app.config.get('DATA_SNAPSHOT')
+    if snapshot:
+        data = SNAPSHOT_LOADER.load(snapshot, data_csv)
+        if data is not None:
+            return data
+    if app.config.get('DATA_LAZY'):
+        return INDEX_LOADER.load(
+            data_csv,
+            app.config.get('DATA_INDEX'),
+            engine,
+            app.config.get('DATA_LAZY_USERS', DEFAULT_MAX_USERS)
+        )
+    return DATA_LOADER.load(data_csv, engine, workers)
 
-                data.setdefault(user_id, {})[date] = {'start': start,
-                                                      'end': end}
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-    return data
+def get_data_loader():
+    """
+    Returns loader of presence CSV files selected by DATA_CSV option.
+    """
+    if is_sharded(app.config['DATA_CSV']):
+        return SHARDS_LOADER
+    return DATA_LOADER
 
 
 def get_user_data():
@@ -128,30 +521,26 @@ def get_user_data():
             'name': 'User Name',
         }
     }
-    """
-    data = {}
-    with open(app.config['USERS_XML'], 'r') as xmlfile:
-        users_xml = etree.parse(xmlfile)
-        server_info = users_xml.find('/server')
-        avatar_prefix = None
-        if server_info is not None:
-            host = server_info.find('./host')
-            port = server_info.find('./port')
-            protocol = server_info.find('./protocol')
-            if None not in (host, port, protocol):
-                avatar_prefix = "%s://%s:%s" % (protocol.text, host.text,
-                                                port.text)
 
-        for user in users_xml.find('/users').iterchildren('user'):
-            user_id = int(user.get('id'))
-            avatar = user.find('./avatar')
-            name = user.find('./name')
+    File is parsed again only when it changes, see
+    presence_analyzer.loader.XmlLoader. While background refresher runs
+    (see presence_analyzer.warmup), the file is not even checked and
+    last loaded data is returned.
+    """
+    path = app.config['USERS_XML']
+    if BACKGROUND_REFRESH.is_set():
+        data = USERS_LOADER.data
+        if data.version is not None and data.version[0] == path:
+            return data
+    return USERS_LOADER.load(path)
 
-            data[user_id] = {'name': name.text}
-            if avatar_prefix and avatar is not None:
-                data[user_id]['avatar'] = avatar_prefix + avatar.text
 
-    return data
+def get_users_listing():
+    """
+    Returns users present in presence data along with their names and
+    avatars.
+    """
+    return USERS_LOADER.users_listing(get_user_data(), get_data())
 
 
 def group_by_weekday(items):
@@ -159,10 +548,8 @@ def group_by_weekday(items):
     Groups presence entries by weekday.
     """
     result = [[], [], [], [], [], [], []]  # one list for every day in week
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()].append(interval(start, end))
+    for day, start, end in items.rows():
+        result[weekday(day)].append(end - start)
     return result
 
 
@@ -170,31 +557,28 @@ def mean_start_end_by_weekday(items):
     """
     Calculate mean start-end times by weekday.
     """
+    return items.stats.mean_start_end()
+
 
-    # [start, end, count] for every day in week
-    week_stats = [[0, 0, 0] for _ in range(7)]
-    for date, item in items.iteritems():
-        day_stats = week_stats[date.weekday()]
-        day_stats[0] += seconds_since_midnight(item['start'])
-        day_stats[1] += seconds_since_midnight(item['end'])
-        day_stats[2] += 1
+def total_by_weekday(items):
+    """
+    Calculate total presence time by weekday.
+    """
+    return items.stats.total_intervals()
 
-    results = []
-    for weekday, day_stats in enumerate(week_stats):
-        count = day_stats[2]
-        if count:
-            start = day_stats[0]/count
-            end = day_stats[1]/count
-            results.append([weekday, start, end])
 
-    return results
+def mean_by_weekday(items):
+    """
+    Calculate mean presence time by weekday. Zero for days without entries.
+    """
+    return items.stats.mean_intervals()
 
 
 def seconds_since_midnight(dtime):
     """
     Calculates amount of seconds since midnight.
     """
-    return dtime.hour * 3600 + dtime.minute * 60 + dtime.second
+    return time_to_seconds(dtime)
 
 
 def interval(start, end):
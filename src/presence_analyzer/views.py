@@ -4,14 +4,17 @@ Defines views.
 """
 
 import calendar
-from flask import redirect, abort
+from datetime import date, datetime
+from json import dumps
+from flask import redirect, abort, request
+from flask import Response, stream_with_context
 from flask import render_template
 from flask import url_for
 
 from presence_analyzer.main import app
-from presence_analyzer.utils import jsonify, get_data, get_user_data
-from presence_analyzer.utils import mean, group_by_weekday, \
-    mean_start_end_by_weekday
+from presence_analyzer.metrics import render_metrics
+from presence_analyzer.store import seconds_to_time
+from presence_analyzer.utils import jsonify, get_data, get_users_listing
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
@@ -31,77 +34,349 @@ def users_view():
     """
     Users listing for dropdown.
     """
-    data = get_data()
-    users = get_user_data()
+    return get_users_listing()
+
+
+def mean_time_weekday(stats):
+    """
+    Mean presence time of user's entries grouped by weekday.
+
+    :param stats: WeekdayStats instance of user's entries
+    """
     return [
-        {'user_id': i,
-         'name': users[i]['name'] if i in users else 'User {0}'.format(str(i)),
-         'avatar': users[i]['avatar'] if i in users else ''}
-        for i in data.keys()
+        (calendar.day_abbr[weekday], interval)
+        for weekday, interval in enumerate(stats.mean_intervals())
     ]
 
 
-@app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
-@jsonify
-def mean_time_weekday_view(user_id):
-    """
-    Returns mean presence time of given user grouped by weekday.
+def presence_weekday(stats):
     """
-    data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
-        abort(404)
+    Total presence time of user's entries grouped by weekday.
 
-    weekdays = group_by_weekday(data[user_id])
+    :param stats: WeekdayStats instance of user's entries
+    """
     result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
+        (calendar.day_abbr[weekday], interval)
+        for weekday, interval in enumerate(stats.total_intervals())
     ]
-
+    result.insert(0, ('Weekday', 'Presence (s)'))
     return result
 
 
-@app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
-@jsonify
-def presence_weekday_view(user_id):
+def presence_start_end(stats):
     """
-    Returns total presence time of given user grouped by weekday.
+    Mean start and end time of user's entries grouped by weekday.
+
+    :param stats: WeekdayStats instance of user's entries
     """
-    data = get_data()
-    if user_id not in data:
+    return [
+        (calendar.day_abbr[weekday], start, end)
+        for weekday, start, end in stats.mean_start_end()
+    ]
+
+
+METRICS = {
+    'mean_time_weekday': mean_time_weekday,
+    'presence_weekday': presence_weekday,
+    'presence_start_end': presence_start_end,
+}
+
+
+def date_range():
+    """
+    Reads optional 'from' and 'to' query parameters, both inclusive.
+
+    Aborts with 400 Bad Request when a date is not in YYYY-MM-DD format.
+    :return: (first, last) day ordinals, None for missing parameters
+    """
+    def ordinal(name):
+        """
+        Converts date in given query parameter to day ordinal.
+        """
+        value = request.args.get(name)
+        if not value:
+            return None
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').toordinal()
+        except ValueError:
+            log.debug('Invalid %s date: %s', name, value)
+            abort(400)
+
+    return ordinal('from'), ordinal('to')
+
+
+def check_user(user_id):
+    """
+    Aborts with 404 Not Found for unknown users.
+    """
+    if user_id not in get_data():
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
 
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+def check_user_range(user_id):
+    """
+    Validates date range and user of per-user endpoints.
+    """
+    date_range()
+    check_user(user_id)
+
+
+def get_user_stats(user_id):
+    """
+    Returns weekday totals of given user's entries in requested range.
+
+    Totals of a range come from user's prefix sums, entries are not
+    copied (see store.UserPresence.stats_between). Aborts with 400 Bad
+    Request for invalid range and with 404 Not Found for unknown users.
+    """
+    first, last = date_range()
+    check_user(user_id)
+    return get_data()[user_id].stats_between(first, last)
+
+
+@app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
+@jsonify(validate=check_user_range)
+def mean_time_weekday_view(user_id):
+    """
+    Returns mean presence time of given user grouped by weekday.
+
+    Optional 'from' and 'to' query parameters (YYYY-MM-DD) limit entries
+    to given range of days.
+    """
+    return mean_time_weekday(get_user_stats(user_id))
+
+
+@app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
+@jsonify(validate=check_user_range)
+def presence_weekday_view(user_id):
+    """
+    Returns total presence time of given user grouped by weekday.
+
+    Optional 'from' and 'to' query parameters (YYYY-MM-DD) limit entries
+    to given range of days.
+    """
+    return presence_weekday(get_user_stats(user_id))
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
-@jsonify
+@jsonify(validate=check_user_range)
 def presence_start_end_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
+
+    Optional 'from' and 'to' query parameters (YYYY-MM-DD) limit entries
+    to given range of days.
     """
-    data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
-        abort(404)
+    return presence_start_end(get_user_stats(user_id))
+
+
+def rollup_period(user_id):
+    """
+    Reads 'period' query parameter of rollup endpoint of given user.
+
+    Aborts with 400 Bad Request for unknown periods and with 404 Not Found
+    for unknown users.
+    """
+    period = request.args.get('period', 'month')
+    if period not in ('month', 'week'):
+        log.debug('Invalid period: %s', period)
+        abort(400)
+    check_user(user_id)
+    return period
+
+
+@app.route('/api/v1/rollup/<int:user_id>', methods=['GET'])
+@jsonify(validate=rollup_period)
+def rollup_view(user_id):
+    """
+    Returns weekday statistics of given user for every month or week.
+
+    Query parameters:
+     - period: 'month' (default) or 'week' (ISO weeks).
+
+    Only periods with presence entries are listed. Totals of every period
+    are taken from user's prefix sums (see store.PrefixSums).
+    """
+    period = rollup_period(user_id)
+    result = []
+    for label, first, last, stats in get_data()[user_id].rollup(period):
+        result.append({
+            'period': label,
+            'from': date.fromordinal(first).isoformat(),
+            'to': date.fromordinal(last).isoformat(),
+            'days': sum(stats.counts),
+            'presence': sum(stats.intervals),
+            'weekdays': [
+                (calendar.day_abbr[weekday], count, presence)
+                for weekday, (count, presence) in enumerate(
+                    zip(stats.counts, stats.intervals)
+                )
+            ],
+        })
+    return result
+
+
+def batch_args():
+    """
+    Reads query parameters of batch statistics endpoint.
+
+    Aborts with 400 Bad Request when they are invalid.
+    :return: (user ids, metric names) tuple
+    """
+    try:
+        user_ids = [
+            int(user_id)
+            for user_id in request.args.get('user_ids', '').split(',')
+        ]
+    except ValueError:
+        log.debug('Invalid user_ids: %s', request.args.get('user_ids'))
+        abort(400)
+
+    metrics = request.args.get('metrics')
+    metrics = metrics.split(',') if metrics else sorted(METRICS)
+    if not set(metrics).issubset(METRICS):
+        log.debug('Invalid metrics: %s', metrics)
+        abort(400)
+    return user_ids, metrics
 
-    week_stats = mean_start_end_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], start, end)
-        for weekday, start, end in week_stats
-    ]
+
+@app.route('/api/v1/batch_stats', methods=['GET'])
+@jsonify(validate=batch_args)
+def batch_stats_view():
+    """
+    Returns statistics of many users at once.
+
+    Query parameters:
+     - user_ids: comma separated list of user ids (required),
+     - metrics: comma separated list of metrics (defaults to all), see
+       METRICS for available ones.
+
+    Every entry has user_id and either one key per requested metric, with
+    the same value the per-user endpoint returns, or an error.
+    """
+    user_ids, metrics = batch_args()
+    data = get_data()
+    result = []
+    for user_id in user_ids:
+        entry = {'user_id': user_id}
+        if user_id in data:
+            for metric in metrics:
+                entry[metric] = METRICS[metric](data[user_id].stats)
+        else:
+            entry['error'] = 'User not found'
+        result.append(entry)
 
     return result
 
 
+def export_stats(data, fmt):
+    """
+    Yields weekday statistics of every user, one chunk per user.
+    """
+    if fmt == 'csv':
+        yield 'user_id,weekday,days,presence,mean_presence,' \
+            'mean_start,mean_end\r\n'
+    for user_id in sorted(data):
+        stats = data[user_id].stats
+        weekdays = [
+            {
+                'weekday': calendar.day_abbr[weekday],
+                'days': count,
+                'presence': stats.intervals[weekday],
+                'mean_presence': mean,
+                'mean_start': stats.starts[weekday] // count if count else 0,
+                'mean_end': stats.ends[weekday] // count if count else 0,
+            }
+            for weekday, (count, mean) in enumerate(
+                zip(stats.counts, stats.mean_intervals())
+            )
+        ]
+        if fmt == 'csv':
+            yield ''.join(
+                '{0},{weekday},{days},{presence},{mean_presence},'
+                '{mean_start},{mean_end}\r\n'.format(user_id, **weekday)
+                for weekday in weekdays
+            )
+        else:
+            yield dumps({'user_id': user_id, 'weekdays': weekdays}) + '\n'
+
+
+def export_rows(data, fmt):
+    """
+    Yields presence entries of every user, one chunk per user.
+
+    CSV rows follow the layout of DATA_CSV file.
+    """
+    for user_id in sorted(data):
+        rows = data[user_id].rows()
+        if fmt == 'csv':
+            yield ''.join(
+                '{0},{1},{2},{3}\r\n'.format(
+                    user_id, date.fromordinal(day).isoformat(),
+                    seconds_to_time(start), seconds_to_time(end)
+                )
+                for day, start, end in rows
+            )
+        else:
+            yield ''.join(
+                dumps({
+                    'user_id': user_id,
+                    'date': date.fromordinal(day).isoformat(),
+                    'start': start,
+                    'end': end,
+                }) + '\n'
+                for day, start, end in rows
+            )
+
+
+EXPORT_KINDS = {
+    'stats': export_stats,
+    'rows': export_rows,
+}
+
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+@app.route('/api/v1/export', methods=['GET'])
+def export_view():
+    """
+    Streams data of all users.
+
+    Query parameters:
+     - kind: 'stats' (default) for weekday statistics or 'rows' for
+       presence entries,
+     - format: 'ndjson' (default) or 'csv'.
+
+    Output is generated user by user while it is sent, so memory use does
+    not depend on the number of users or days.
+    """
+    kind = request.args.get('kind', 'stats')
+    fmt = request.args.get('format', 'ndjson')
+    if kind not in EXPORT_KINDS or fmt not in EXPORT_MIMETYPES:
+        log.debug('Invalid export: %s, %s', kind, fmt)
+        abort(400)
+
+    data = get_data()
+    return Response(
+        stream_with_context(EXPORT_KINDS[kind](data, fmt)),
+        mimetype=EXPORT_MIMETYPES[fmt]
+    )
+
+
+@app.route('/api/v1/_metrics', methods=['GET'])
+def metrics_view():
+    """
+    Returns request, cache and data loading metrics in Prometheus text
+    format, see presence_analyzer.metrics.
+    """
+    return Response(render_metrics(),
+                    mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/presence_weekday', methods=['GET'])
 def presence_weekday_renderer():
     """
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Warm-up of data and caches and their background refresh.
+
+With WARMUP option set, script.make_app loads data files, computes
+weekday totals of every user and renders /api/v1/users response before
+the server accepts traffic, so the first requests do not wait for it.
+Cumulative totals answering date range queries are still built on
+first use. Command line tools like bin/fetch-users do not warm up, and a
+data file which cannot be read is logged, not fatal.
+
+With REFRESH_INTERVAL option set, every server process runs a thread
+which reloads data files every that many seconds. Requests then always
+get already loaded data and never trigger a reload themselves. The
+interval should be shorter than get_data cache duration. The thread is
+started on the first request handled by the process, so pre-forked
+workers (see presence_analyzer.prefork) start their own.
+
+With WATCH_FILES option set, data files are reloaded when they change
+instead (see presence_analyzer.watcher). A reload waits until files were
+not written to for WATCH_DEBOUNCE seconds, so half-written exports are
+not loaded. New data replaces the old one at once, requests never see a
+mix of both. Cache duration of get_data then only is a safety net for
+changes the watcher missed.
+"""
+
+import os
+from threading import Event, Lock, Thread
+from timeit import default_timer
+
+from presence_analyzer.main import app
+from presence_analyzer import utils
+from presence_analyzer.lazy import LazyPresenceData
+from presence_analyzer.watcher import Watcher
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def prime_users_listing():
+    """
+    Renders /api/v1/users response into response cache.
+    """
+    with app.test_request_context('/api/v1/users'):
+        app.view_functions['users_view']()
+
+
+def warm_up(reload_data=False):
+    """
+    Loads data files, computes weekday totals and primes response cache.
+
+    Data files which cannot be read are logged and skipped, requests then
+    fail (or load them) the same way as without warm-up.
+    :param reload_data: drop cached data and load it again
+    """
+    started = default_timer()
+    if reload_data:
+        utils.get_data.cache_invalidate()
+    try:
+        data = utils.get_data()
+    except EnvironmentError as exc:
+        log.error('Warm-up could not load presence data: %s', exc)
+        data = {}
+    # weekday totals are computed on first access for snapshot data,
+    # lazily loaded users are not parsed until they are asked for
+    if not isinstance(data, LazyPresenceData):
+        for presence in data.itervalues():
+            presence.stats  # pylint: disable=pointless-statement
+    try:
+        utils.get_user_data()
+        prime_users_listing()
+    except EnvironmentError as exc:
+        log.error('Warm-up could not load users: %s', exc)
+    log.info('Warm-up of %d users took %.3fs', len(data),
+             default_timer() - started)
+
+
+def refresh():
+    """
+    Reloads changed data files and primes response cache.
+    """
+    utils.get_data.cache_refresh()
+    utils.USERS_LOADER.load(app.config['USERS_XML'])
+    prime_users_listing()
+
+
+class Refresher(Thread):
+    """
+    Thread calling refresh() every interval seconds until stopped.
+    """
+
+    def __init__(self, interval):
+        super(Refresher, self).__init__(name='presence-refresher')
+        self.daemon = True
+        self.interval = interval
+        self.stopped = Event()
+        self.pid = os.getpid()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                refresh()
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Refreshing data failed')
+
+    def stop(self):
+        """
+        Stops thread and waits for it.
+        """
+        self.stopped.set()
+        self.join()
+
+
+def watched_paths():
+    """
+    Returns data files (or glob patterns) watched for changes.
+    """
+    data_csv = app.config['DATA_CSV']
+    paths = [data_csv] if isinstance(data_csv, basestring) else \
+        list(data_csv)
+    paths.append(app.config['USERS_XML'])
+    if app.config.get('DATA_SNAPSHOT'):
+        paths.append(app.config['DATA_SNAPSHOT'])
+    return paths
+
+
+def make_refresher():
+    """
+    Returns file watcher or refresher thread, as configured.
+    """
+    if app.config.get('WATCH_FILES'):
+        return Watcher(
+            watched_paths(), refresh,
+            debounce=app.config.get('WATCH_DEBOUNCE', 1.0),
+            poll_interval=app.config.get('WATCH_POLL_INTERVAL', 1.0),
+        )
+    return Refresher(app.config['REFRESH_INTERVAL'])
+
+
+REFRESHER_LOCK = Lock()
+REFRESHER = {'thread': None}
+
+
+@app.before_request
+def start_refresher():
+    """
+    Starts refresher thread of this process unless it already runs.
+    """
+    if not app.config.get('WATCH_FILES') and \
+            not app.config.get('REFRESH_INTERVAL'):
+        return
+    thread = REFRESHER['thread']
+    # threads do not survive fork, forked processes start their own
+    if thread is not None and thread.pid == os.getpid():
+        return
+    with REFRESHER_LOCK:
+        thread = REFRESHER['thread']
+        if thread is None or thread.pid != os.getpid():
+            # make sure data is loaded before requests skip the checks
+            refresh()
+            thread = REFRESHER['thread'] = make_refresher()
+            thread.start()
+            utils.BACKGROUND_REFRESH.set()
+            log.info('Started %s in process %d', thread.name, thread.pid)
+
+
+def stop_refresher():
+    """
+    Stops refresher thread of this process, if any.
+    """
+    with REFRESHER_LOCK:
+        thread = REFRESHER['thread']
+        REFRESHER['thread'] = None
+    if thread is not None and thread.pid == os.getpid():
+        utils.BACKGROUND_REFRESH.clear()
+        thread.stop()
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Watching data files for changes.
+
+On Linux changes are reported by inotify, elsewhere (or when inotify is
+not available) files are polled with stat(). Parent directories are
+watched rather than files themselves, so files replaced by rename are
+noticed as well. Paths may be glob patterns, then files created later
+are watched too.
+"""
+
+import os
+import glob
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+from fnmatch import fnmatchcase
+from threading import Event, Thread
+from timeit import default_timer
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE
+EVENT = struct.Struct('iIII')
+
+
+class InotifySource(object):
+    """
+    Reports changes of files using inotify.
+
+    :raise: OSError when inotify is not available
+    """
+
+    def __init__(self, paths):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, 'libc not found')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify not available')
+
+        self.descriptor = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.descriptor < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # watch descriptor -> name patterns of watched files in directory
+        self.names = {}
+        try:
+            directories = {}
+            for path in paths:
+                directory, name = os.path.split(os.path.abspath(path))
+                directories.setdefault(directory, set()).add(name)
+            for directory, names in directories.iteritems():
+                watch = libc.inotify_add_watch(self.descriptor, directory,
+                                               WATCH_MASK)
+                if watch < 0:
+                    raise OSError(ctypes.get_errno(),
+                                  'Cannot watch {0}'.format(directory))
+                self.names[watch] = names
+        except OSError:
+            self.close()
+            raise
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for changes.
+
+        :return: True if any watched file changed
+        """
+        try:
+            readable, _, _ = select.select([self.descriptor], [], [], timeout)
+        except select.error as exc:
+            if exc.args[0] == errno.EINTR:
+                return False
+            raise
+        if not readable:
+            return False
+
+        changed = False
+        while True:
+            try:
+                buf = os.read(self.descriptor, 64 * 1024)
+            except OSError as exc:
+                if exc.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            offset = 0
+            while offset < len(buf):
+                watch, _, _, length = EVENT.unpack_from(buf, offset)
+                offset += EVENT.size
+                name = buf[offset:offset + length].rstrip('\0')
+                offset += length
+                if any(fnmatchcase(name, pattern)
+                       for pattern in self.names.get(watch, ())):
+                    changed = True
+        return changed
+
+    def close(self):
+        """
+        Releases inotify descriptor.
+        """
+        if self.descriptor >= 0:
+            os.close(self.descriptor)
+            self.descriptor = -1
+
+
+class PollingSource(object):
+    """
+    Reports changes of files by comparing their stat() results.
+    """
+
+    def __init__(self, paths, stopped=None):
+        self.paths = list(paths)
+        self.stopped = stopped or Event()
+        self.states = self.stat()
+
+    def stat(self):
+        """
+        Returns (path, inode, size, mtime) of every file, None for missing
+        ones.
+        """
+        states = []
+        for pattern in self.paths:
+            paths = sorted(glob.glob(pattern)) if glob.has_magic(pattern) \
+                else [pattern]
+            for path in paths:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    states.append(None)
+                else:
+                    states.append((path, stat.st_dev, stat.st_ino,
+                                   stat.st_size, stat.st_mtime))
+        return states
+
+    def wait(self, timeout):
+        """
+        Sleeps timeout seconds and checks files.
+
+        :return: True if any watched file changed
+        """
+        self.stopped.wait(timeout)
+        states = self.stat()
+        changed = states != self.states
+        self.states = states
+        return changed
+
+    def close(self):
+        """
+        Nothing to release.
+        """
+
+
+class Watcher(Thread):
+    """
+    Thread calling callback after watched files change.
+
+    Callback is called once writes settle, i.e. no change was seen for
+    debounce seconds, but at least every max_delay seconds while files
+    keep changing, so a long export is loaded in steps.
+    :param paths: files to watch
+    :param callback: function called without arguments
+    :param poll_interval: seconds between checks when polling
+    :param use_inotify: False to always poll
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, paths, callback, debounce=1.0, max_delay=10.0,
+                 poll_interval=1.0, use_inotify=True):
+        # pylint: disable=too-many-arguments
+        super(Watcher, self).__init__(name='presence-watcher')
+        self.daemon = True
+        self.paths = list(paths)
+        self.callback = callback
+        self.debounce = debounce
+        self.max_delay = max(max_delay, debounce)
+        self.poll_interval = poll_interval
+        self.stopped = Event()
+        self.pid = os.getpid()
+        self.source = None
+        if use_inotify:
+            try:
+                self.source = InotifySource(self.paths)
+            except OSError:
+                log.info('inotify not available, polling files',
+                         exc_info=True)
+        if self.source is None:
+            self.source = PollingSource(self.paths, self.stopped)
+
+    def run(self):
+        first_change = last_change = None
+        try:
+            while not self.stopped.is_set():
+                timeout = self.poll_interval
+                if last_change is not None:
+                    timeout = min(timeout, max(0, min(
+                        last_change + self.debounce,
+                        first_change + self.max_delay
+                    ) - default_timer()))
+                changed = self.source.wait(timeout)
+
+                now = default_timer()
+                if changed:
+                    last_change = now
+                    if first_change is None:
+                        first_change = now
+                if first_change is None or self.stopped.is_set():
+                    continue
+                if now - last_change >= self.debounce or \
+                        now - first_change >= self.max_delay:
+                    first_change = last_change = None
+                    try:
+                        self.callback()
+                    except Exception:  # pylint: disable=broad-except
+                        log.exception('Reloading changed files failed')
+        finally:
+            self.source.close()
+
+    def stop(self):
+        """
+        Stops thread and waits for it.
+        """
+        self.stopped.set()
+        self.join()